@@ -0,0 +1,138 @@
+"""Packing the sprites of a tile set into a few big images (texture atlases)."""
+import math
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from . import profiling
+from .images import SUFFIXES, ImageWriter
+
+# Sheets wider than this get more rows instead.
+MAX_WIDTH = 4096
+# Sheets higher than this get split, if the tile set allows it.
+MAX_HEIGHT = 16384
+
+
+@dataclass
+class Placement:
+    """Where a sprite ended up."""
+    sheet: Path
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+@dataclass
+class Sheet:
+    """A single atlas image."""
+    path: Path
+    width: int
+    height: int
+    columns: int
+
+
+@dataclass
+class Atlas:
+    """All sheets of a tile set and where each sprite is on them.
+
+    If `grid` is set, there is a single sheet of equally sized cells
+    and sprite i is in cell i+1, so tile ids stay the same as in an image collection.
+    """
+    grid: bool
+    sheets: dict[Path, Sheet]
+    placements: list[Placement | None]
+
+
+def atlas_dir(tile_set: Path) -> Path:
+    """Where the sheets of a tile set (".tsx") go."""
+    return tile_set.parent / ".atlas" / tile_set.stem
+
+
+def remove_atlas(tile_set: Path):
+    """Delete the sheets of a tile set, e.g. once it is written without them."""
+    directory = atlas_dir(tile_set)
+    if not directory.exists():
+        return
+    shutil.rmtree(directory)
+    if not any(directory.parent.iterdir()):
+        directory.parent.rmdir()
+
+
+def pack_atlas(sprites: list[Path | None], output: Path,
+               writer: ImageWriter | None = None) -> Atlas:
+    """Pack the sprites into sheets inside the `output`-directory, grouped by size.
+
+    Old sheets in that directory are removed.
+    """
+    writer = writer or ImageWriter()
+    with profiling.span("decode", sprites=len(sprites)):
+        images = [_read(x) if x else None for x in sprites]
+    by_size: dict[tuple[int, int], list[int]] = {}
+    for (i, img) in enumerate(images):
+        if img is not None:
+            by_size.setdefault(img.shape[:2], []).append(i)
+
+    output.mkdir(parents=True, exist_ok=True)
+    atlas = Atlas(len(by_size) == 1, {}, [None] * len(images))
+    if atlas.grid:
+        ((height, width), indices) = next(iter(by_size.items()))
+        columns = _columns(width, len(images) + 1)
+        if math.ceil((len(images) + 1) / columns) * height > MAX_HEIGHT:
+            atlas.grid = False
+
+    if atlas.grid:
+        # Cell 0 stays empty, image collections start at tile id 1.
+        # Tombstones and unreadable sprites leave their cell empty as well.
+        cells = [None] + [None if img is None else i for (i, img) in enumerate(images)]
+        _pack_sheet(atlas, images, cells, output / f"{width}x{height}{writer.suffix}", writer)
+    else:
+        for ((height, width), indices) in by_size.items():
+            columns = _columns(width, len(indices))
+            per_sheet = columns * max(1, MAX_HEIGHT // height)
+            for start in range(0, len(indices), per_sheet):
+                suffix = f"_{start // per_sheet}" if start else ""
+                _pack_sheet(atlas, images, indices[start:start + per_sheet],
+                            output / f"{width}x{height}{suffix}{writer.suffix}", writer)
+
+    for old in output.iterdir():
+        if old.suffix in SUFFIXES and old not in atlas.sheets:
+            old.unlink()
+    return atlas
+
+
+def _columns(width: int, count: int) -> int:
+    """How many sprites fit next to each other."""
+    return max(1, min(count, MAX_WIDTH // width))
+
+
+def _pack_sheet(atlas: Atlas, images: list[np.ndarray | None],
+                cells: list[int | None], path: Path, writer: ImageWriter):
+    """Put the given images (None for empty cells) onto one sheet and save it."""
+    first = images[next(x for x in cells if x is not None)]
+    (height, width) = first.shape[:2]
+    columns = _columns(width, len(cells))
+    rows = math.ceil(len(cells) / columns)
+
+    sheet = np.zeros((rows * height, columns * width, 4), dtype=np.uint8)
+    for (cell, i) in enumerate(cells):
+        if i is None:
+            continue
+        (y, x) = ((cell // columns) * height, (cell % columns) * width)
+        sheet[y:y + height, x:x + width] = images[i]
+        atlas.placements[i] = Placement(path, x, y, width, height)
+
+    writer.write(path, sheet)
+    atlas.sheets[path] = Sheet(path, sheet.shape[1], sheet.shape[0], columns)
+
+
+def _read(path: Path) -> np.ndarray | None:
+    """Read a sprite as BGRA."""
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    profiling.count("images_decoded")
+    if img is not None and img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+    return img
@@ -0,0 +1,153 @@
+"""Benchmarks, e.g. `python3 -m ss14_tiled.bench stages -o before.json`."""
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+from .generate.decals import create_decals
+from .generate.entities import create_entities, find_entities
+from .generate.prototypes import PrototypeIndex
+from .generate.rules import ancestor_index, filter_entities, group_entities
+from .generate.tiles import create_tiles
+from .shared import BuildManifest, Options, add_transparent_image, composite_layers
+from .synthetic import make_tree
+
+
+def bench_composite(number: int):
+    """Compare compositing layer stacks one layer at a time with the whole stack at once."""
+    rng = np.random.default_rng(0)
+    print(f"{'size':>6} {'layers':>6} {'per layer':>11} {'stack':>11} {'speedup':>8}")
+    for size in (32, 64):
+        # Machines and airlocks have around 2-8 layers.
+        for count in (2, 4, 8):
+            layers = [rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+                      for _ in range(count)]
+
+            def per_layer(layers=layers):
+                img = layers[0].copy()
+                for layer in layers[1:]:
+                    add_transparent_image(img, layer)
+                return img
+
+            def stack(layers=layers):
+                return composite_layers(layers)
+
+            old = min(timeit.repeat(per_layer, number=number, repeat=3)) / number
+            new = min(timeit.repeat(stack, number=number, repeat=3)) / number
+            print(f"{size:>6} {count:>6} {old * 1e6:>9.1f}us {new * 1e6:>9.1f}us "
+                  f"{old / new:>7.1f}x")
+
+
+def bench_stages(scales: list[int], jobs: int, repeat: int) -> dict:
+    """Time every stage of the generation on synthetic trees of the given scales."""
+    results = {"commit": _git("rev-parse", "HEAD"), "dirty": bool(_git("status", "--porcelain")),
+               "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+               "python": platform.python_version(), "platform": platform.platform(),
+               "jobs": jobs, "scales": []}
+    print(f"{'scale':>5} {'stage':<16} {'seconds':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            root = Path(tmp) / f"x{scale}"
+            counts = make_tree(root, scale)
+            stages: dict[str, float] = {}
+            for _ in range(repeat):
+                for (stage, seconds) in _run_stages(root, jobs).items():
+                    stages[stage] = min(seconds, stages.get(stage, seconds))
+            for (stage, seconds) in stages.items():
+                print(f"{scale:>5} {stage:<16} {seconds:>8.3f}")
+            results["scales"].append({"scale": scale, "counts": counts, "stages": stages})
+            shutil.rmtree(root)
+    return results
+
+
+def _run_stages(root: Path, jobs: int) -> dict[str, float]:
+    """Run every stage once, each of the generators into an empty output directory."""
+    options = Options(jobs=jobs)
+    timings = {}
+
+    def timed(stage: str, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    prototypes = timed("load_prototypes", PrototypeIndex.from_root, root, jobs)
+    entities = timed("find_entities", find_entities, prototypes)
+    ancestors = ancestor_index(entities)
+    kept = timed("filter_entities", filter_entities, entities)
+    timed("group_entities", group_entities, kept, None, ancestors)
+
+    out = root / "dist"
+    for create in (create_entities, create_decals, create_tiles):
+        shutil.rmtree(out, ignore_errors=True)
+        out.mkdir()
+        timed(create.__name__, create, root, out, prototypes, BuildManifest(), options)
+    shutil.rmtree(out)
+    return timings
+
+
+def compare(old: dict, new: dict):
+    """Print how much faster (or slower) each stage got."""
+    print(f"old: {old['commit']} ({old['date']})\nnew: {new['commit']} ({new['date']})")
+    print(f"{'scale':>5} {'stage':<16} {'old':>8} {'new':>8} {'change':>8}")
+    old_scales = {x["scale"]: x["stages"] for x in old["scales"]}
+    for entry in new["scales"]:
+        for (stage, seconds) in entry["stages"].items():
+            before = old_scales.get(entry["scale"], {}).get(stage)
+            if not before:
+                continue  # New stage, or too fast to measure.
+            print(f"{entry['scale']:>5} {stage:<16} {before:>8.3f} {seconds:>8.3f} "
+                  f"{(seconds - before) / before:>+8.0%}")
+
+
+def _git(*args: str) -> str | None:
+    """Output of a git command in the repository, None outside of one."""
+    try:
+        return subprocess.run(["git", *args], capture_output=True, check=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run a benchmark."""
+    parser = argparse.ArgumentParser(prog="python3 -m ss14_tiled.bench",
+                                     description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    composite = subparsers.add_parser("composite", help=bench_composite.__doc__)
+    composite.add_argument("-n", "--number", type=int, default=500,
+                           help="how often to run each case (default: %(default)s)")
+    stages = subparsers.add_parser("stages", help=bench_stages.__doc__)
+    stages.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100],
+                        help="sizes of the synthetic trees (default: %(default)s)")
+    stages.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to use (default: %(default)s)")
+    stages.add_argument("-r", "--repeat", type=int, default=1,
+                        help="take the fastest of that many runs (default: %(default)s)")
+    stages.add_argument("-o", "--output", type=Path, metavar="results.json",
+                        help="save the results, e.g. to compare them later")
+    comparison = subparsers.add_parser("compare", help=compare.__doc__)
+    comparison.add_argument("old", type=Path, metavar="old.json")
+    comparison.add_argument("new", type=Path, metavar="new.json")
+    args = parser.parse_args()
+
+    if args.benchmark == "composite":
+        bench_composite(args.number)
+    elif args.benchmark == "stages":
+        results = bench_stages(args.scales, max(1, args.jobs), max(1, args.repeat))
+        if args.output:
+            args.output.write_text(json.dumps(results, indent=2), "UTF-8")
+    elif args.benchmark == "compare":
+        compare(json.loads(args.old.read_text("UTF-8")), json.loads(args.new.read_text("UTF-8")))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,155 @@
 """Everything CLI."""
+import argparse
+import os
 import sys
+import xml.etree.ElementTree as ET
 from pathlib import Path
 
-from .generate import generate
-from .shared import eprint
+import yaml
+
+from . import profiling
+from .generate import GENERATORS, generate
+from .generate.rules import OTHER_GROUP, group_rules, load_rules
+from .generate.watch import watch
+from .images import ENCODINGS
+from .indexes import check_indexes
+from .maps import export_map, import_map
+from .shared import Options, Selection, eprint
 
 
 def main():
     """Main entrypoint."""
-    if len(sys.argv) != 2:
-        if sys.argv[0].endswith("/ss14-tiled"):
-            eprint("Usage: ss14-tiled </path/to/ss14.git/>")
-        else:
-            eprint("Usage: python3 -m ss14_tiled </path/to/ss14.git/>")
-        sys.exit(1)
+    prog = "ss14-tiled"
+    if not sys.argv[0].endswith("/ss14-tiled"):
+        prog = "python3 -m ss14_tiled"
+    commands = {"export": export, "import": import_, "indexes": indexes}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        commands[sys.argv[1]](f"{prog} {sys.argv[1]}", sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        prog=prog, description="Create Tiled tile sets from the SS14 resources.",
+        epilog=f"To convert maps between SS14 and Tiled, see '{prog} import --help' "
+        f"and '{prog} export --help'. To check the tile sets, see '{prog} indexes --help'.")
+    parser.add_argument("root", type=Path, metavar="/path/to/ss14.git/",
+                        help="Source code of SS14 (or a fork).")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of processes to use (default: number of CPUs).")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Re-render all images, even if their inputs did not change.")
+    parser.add_argument("--atlas", action="store_true",
+                        help="Pack the sprites of each tile set into a few big images.")
+    parser.add_argument("--encoding", choices=ENCODINGS, default="default",
+                        help="How to encode the images: fast for local iteration, "
+                        "max (compression) or webp (lossless) for releases.")
+    parser.add_argument("--profile", nargs="?", const=Path("profile"), type=Path,
+                        metavar="PREFIX", help="Write timings and counters to PREFIX.json and "
+                        "a Chrome trace to PREFIX.trace.json (default: profile).")
+    parser.add_argument("--only", action="append", choices=GENERATORS, default=[],
+                        help="Only run this generator (repeatable, default: all of them).")
+    parser.add_argument("--group", action="append", default=[], metavar="NAME",
+                        help="Only generate this entity tile set, e.g. Walls (repeatable).")
+    parser.add_argument("--id", action="append", default=[], metavar="PATTERN",
+                        help="Only generate the prototypes with matching ids, "
+                        "e.g. 'Wall*' (repeatable).")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and regenerate whatever changes to the prototypes "
+                        "and textures affect.")
+    parser.add_argument("--rules", type=Path, metavar="rules.yml",
+                        help="YAML file with extra rules, e.g. which entities to exclude.")
+    args = parser.parse_args()
+
+    try:
+        rules = load_rules(args.rules)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    groups = {x.name for x in group_rules(rules)} | {OTHER_GROUP}
+    for name in args.group:
+        if name not in groups:
+            parser.error(f"Unknown group '{name}', expected one of {', '.join(sorted(groups))}.")
+    only = None
+    if args.only or args.group or args.id:
+        only = Selection(frozenset(args.only), frozenset(args.group), tuple(args.id))
+
+    if args.profile:
+        profiling.enable()
+    options = Options(jobs=max(1, args.jobs), force=args.force, rules=rules, atlas=args.atlas,
+                      encoding=args.encoding, only=only)
+    with profiling.span("generate"):
+        (watch if args.watch else generate)(args.root.expanduser(), options)
+    if args.profile:
+        (summary_out, trace_out) = profiling.write(args.profile)
+        print(f"Profile written to '{summary_out}' and '{trace_out}'.")
+
+
+def export(prog: str, argv: list[str]):
+    """Convert a Tiled map to an SS14 map."""
+    parser = argparse.ArgumentParser(
+        prog=prog, description="Convert a Tiled map (using the generated tile sets) to SS14.")
+    parser.add_argument("tmx", type=Path, metavar="map.tmx")
+    parser.add_argument("output", type=Path, nargs="?", metavar="map.yml",
+                        help="Where to write the SS14 map (default: next to map.tmx).")
+    args = parser.parse_args(argv)
 
-    generate(Path(sys.argv[1]).expanduser())
+    output = args.output or args.tmx.with_suffix(".yml")
+    try:
+        result = export_map(args.tmx, output)
+    except (OSError, ValueError, ET.ParseError) as e:
+        parser.error(str(e))
+    if result.unknown:
+        eprint(f"Skipped {result.unknown} tiles that are not from the generated tile sets.")
+    print(f"Exported {len(result.chunks)} chunks, "
+          f"{sum(len(x) for x in result.entities.values())} entities and "
+          f"{sum(len(x) for x in result.decals.values())} decals to '{output}'.")
+
+
+def import_(prog: str, argv: list[str]):
+    """Convert an SS14 map to a Tiled map."""
+    parser = argparse.ArgumentParser(
+        prog=prog, description="Convert an SS14 map to Tiled (using the generated tile sets).")
+    parser.add_argument("yml", type=Path, metavar="map.yml")
+    parser.add_argument("output", type=Path, nargs="?", metavar="map.tmx",
+                        help="Where to write the Tiled map (default: next to map.yml).")
+    parser.add_argument("--dist", type=Path, default=Path("dist"),
+                        help="Directory with the generated tile sets (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    output = args.output or args.yml.with_suffix(".tmx")
+    try:
+        result = import_map(args.yml, output, args.dist)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        parser.error(str(e))
+    if result.unknown:
+        eprint(f"Skipped {result.unknown} tiles, decals and entities "
+               "that are not in the generated tile sets.")
+    if result.contained:
+        eprint(f"Skipped {result.contained} entities inside of other entities.")
+    if result.rotated:
+        eprint(f"Ignored the rotation of {result.rotated} grids.")
+    print(f"Imported {result.chunks} chunks, {result.entities} entities and "
+          f"{result.decals} decals to '{output}'.")
+
+
+def indexes(prog: str, argv: list[str]):
+    """Check or repair the indexes of the generated tile sets."""
+    parser = argparse.ArgumentParser(
+        prog=prog, description="Check (verify) or repair (compact) the indexes of the "
+        "generated tile sets. Tile ids never change, so existing maps keep working.")
+    parser.add_argument("action", choices=["verify", "compact"])
+    parser.add_argument("--dist", type=Path, default=Path("dist"),
+                        help="Directory with the generated tile sets (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    try:
+        problems = check_indexes(args.dist, fix=args.action == "compact")
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+    for problem in problems:
+        print(problem)
+    if args.action == "compact":
+        print(f"Fixed {len(problems)} problems, generate the tile sets again to update them.")
+    elif problems:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
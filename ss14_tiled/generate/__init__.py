@@ -1,16 +1,57 @@
 """Expose a "generate"-function."""
 from pathlib import Path
 
+from .. import profiling
+from ..images import WriteStats
+from ..indexes import remove_unused_images
+from ..shared import BuildManifest, Options
 from .decals import create_decals
 from .entities import create_entities
+from .prototypes import PrototypeIndex
 from .tiles import create_tiles
 
+# Every generator, with the types of prototypes it reads.
+GENERATORS = {
+    "decals": (create_decals, frozenset({"decal", "palette"})),
+    "entities": (create_entities, frozenset({"entity"})),
+    "tiles": (create_tiles, frozenset({"tile"})),
+}
 
-def generate(root: Path):
+
+def generate(root: Path, options: Options | None = None):
     """Create tile-sets for Tiled."""
+    options = options or Options()
     out = Path("dist")
     out.mkdir(exist_ok=True)
 
-    create_decals(root, out)
-    create_entities(root, out)
-    create_tiles(root, out)
+    # Remembers what every image was made from, so unchanged ones are skipped.
+    manifest = BuildManifest.from_json(out / ".data" / "manifest.json")
+
+    # Parsed once and shared, some bases are outside the "Entities" directory.
+    # A selective build only parses the files with prototypes it needs.
+    types = None
+    if options.only is not None:
+        types = frozenset().union(*(x for (name, (_, x)) in GENERATORS.items()
+                                    if options.only.runs(name)))
+    with profiling.span("load_prototypes"):
+        prototypes = PrototypeIndex.from_root(root, options.jobs, types,
+                                              out / ".data" / "prototypes.pickle")
+    print(build(root, out, prototypes, manifest, options))
+
+
+def build(root: Path, out: Path, prototypes: PrototypeIndex, manifest: BuildManifest,
+          options: Options) -> WriteStats:
+    """Run all the generators, saving the manifest after each of them.
+
+    Images that no tile uses anymore (e.g. as they changed) are removed at the end.
+    """
+    stats = WriteStats()
+    for (name, (create, _)) in GENERATORS.items():
+        if options.only is not None and not options.only.runs(name):
+            continue
+        with profiling.span(create.__name__):
+            stats.add(create(root, out, prototypes, manifest, options))
+        manifest.write_json(out / ".data" / "manifest.json")
+    with profiling.span("remove_unused_images"):
+        profiling.count("images_removed", remove_unused_images(out))
+    return stats
@@ -1,66 +1,123 @@
 """Everything for the "decal"-tiles."""
-import json
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import cv2
-import yaml
+import numpy as np
 
-from ..shared import CacheJSON, Image, create_tsx, remove_prefix
+from .. import profiling
+from ..images import IO_THREADS, ImageWriter, WriteStats, prefetch
+from ..shared import (BuildManifest, CacheJSON, FileHasher, Image, Options,
+                      create_tsx, eprint, hash_object, remove_prefix)
+from .prototypes import PrototypeIndex
 
+_CHANNELS = np.arange(4)
 
-def create_decals(root: Path, out: Path):
-    """Create the "decals"-tiles."""
-    _create_decals(root, out)
-    for (name, color) in get_colors(root):
-        _create_decals(root, out, name, color)
 
+@dataclass
+class DecalSet:
+    """One tile set of decals, tinted with a single color."""
+    name: str
+    color: str
+    existing: CacheJSON = field(default_factory=lambda: CacheJSON([], []))
 
-def _create_decals(root: Path, out: Path, name: str = "", color: str = "#FFF"):
-    """(Internal) Create the "decals"-tiles."""
-    dir_name = "decals"
-    title = "Decals"
-    if name:
-        dir_name = f"decals_{name}"
-        title = f"Decals - {name}"
+    @property
+    def dir_name(self) -> str:
+        """Name of the image directory and of the files."""
+        return f"decals_{self.name}" if self.name else "decals"
 
-    existing_out = out / ".data" / f"{dir_name}.json"
-    existing = CacheJSON.from_json(existing_out)
+    @property
+    def title(self) -> str:
+        """Name of the tile set."""
+        return f"Decals - {self.name}" if self.name else "Decals"
 
-    decals_out = out / ".images" / dir_name
-    decals_out.mkdir(parents=True, exist_ok=True)
 
+def create_decals(root: Path, out: Path, prototypes: PrototypeIndex,
+                  manifest: BuildManifest, options: Options) -> WriteStats:
+    """Create the "decals"-tiles.
+
+    Every sprite is only decoded once and tinted for all colors in one go.
+    """
+    sets = _decal_sets(out, prototypes)
+    hasher = options.caches.hasher if options.caches else FileHasher()
+    writer = ImageWriter(options.encoding, IO_THREADS)
     resources_dir = root / "Resources"
-    yml_dir = resources_dir / "Prototypes/Decals"
-    files = [x for x in yml_dir.glob("**/*.yml") if x.is_file()]
-
-    for file in files:
-        data = yaml.safe_load(file.read_text("UTF-8"))
-        for decal in data:
-            if decal["type"] != "decal":
-                continue  # alias?
-            sprite: Path = resources_dir / "Textures" / \
-                remove_prefix(decal["sprite"]["sprite"], "/Textures/") / \
-                (str(decal["sprite"]["state"]) + ".png")
-            dest: Path = decals_out / (str(decal["id"]) + sprite.suffix)
-            img = cv2.imread(sprite, cv2.IMREAD_UNCHANGED)
-            height, width, dim = img.shape
-            if dim == 3:
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
-                dim = 4
-
-            img = decal_colors(img, color)
-            cv2.imwrite(dest, img)
-
-            # Update the sprite but not the index.
-            if decal["id"] in existing.ids:
-                continue
-            existing.ids.append(decal["id"])
-            existing.images.append(
-                Image(f"./.images/{dir_name}/{dest.name}", str(width), str(height)))
-
-    existing_out.write_text(json.dumps(existing, default=vars), "UTF-8")
-    create_tsx(existing, title, out /
-               f"{dir_name}.tsx", {"color_name": name, "color_value": color})
+    touched: set[int] = set()
+    jobs = []
+    for decal in prototypes.of_type("decal"):
+        keys = [f"{x.dir_name}/{decal['id']}" for x in sets]
+        if not any(map(options.selected, keys)):
+            continue
+        sprite: Path = resources_dir / "Textures" / \
+            remove_prefix(decal["sprite"]["sprite"], "/Textures/") / \
+            (str(decal["sprite"]["state"]) + ".png")
+        if not sprite.is_relative_to(resources_dir):
+            eprint(f"Decal '{decal['id']}' has a sprite outside of the resources!")
+            continue
+        inputs = {"prototype": hash_object(decal),
+                  sprite.relative_to(resources_dir).as_posix(): hasher(sprite),
+                  "encoding": writer.encoding}
+        stale = [(i, key, inputs | {"color": x.color})
+                 for (i, (key, x)) in enumerate(zip(keys, sets)) if options.selected(key)]
+        if not options.force:
+            stale = [(i, key, x) for (i, key, x) in stale
+                     if not manifest.is_current(key, x, sets[i].existing, out)]
+        profiling.count("decals_skipped", len(sets) - len(stale))
+        touched.update(i for (i, _, _) in stale)
+        if stale:
+            profiling.count("decals_rendered", len(stale))
+            jobs.append((decal, sprite, stale))
+
+    _tint_decals(jobs, sets, writer, manifest, out)
+    writer.flush()
+
+    for (i, decal_set) in enumerate(sets):
+        if options.only is not None and i not in touched:
+            continue  # Nothing changed.
+        existing_out = out / ".data" / f"{decal_set.dir_name}.json"
+        decal_set.existing.write_json(existing_out)
+        create_tsx(decal_set.existing, decal_set.title, out / f"{decal_set.dir_name}.tsx",
+                   {"color_name": decal_set.name, "color_value": decal_set.color},
+                   writer if options.atlas else None)
+    return writer.stats
+
+
+def _decal_sets(out: Path, prototypes: PrototypeIndex) -> list[DecalSet]:
+    """The untinted set, followed by one per palette color, with their indexes loaded."""
+    sets = [DecalSet(name, color) for (name, color) in [("", "#FFF")] + get_colors(prototypes)]
+    for decal_set in sets:
+        decal_set.existing = CacheJSON.from_json(out / ".data" / f"{decal_set.dir_name}.json")
+    return sets
+
+
+def _tint_decals(jobs: list[tuple[dict, Path, list]], sets: list[DecalSet],
+                 writer: ImageWriter, manifest: BuildManifest, out: Path):
+    """Decode, tint and store the stale decals, in all their colors at once.
+
+    Decoded in reader threads, tinted here, encoded and written in writer threads.
+    """
+    images_out = out / ".images"
+    images_out.mkdir(exist_ok=True)
+    luts = color_luts([x.color for x in sets])
+    for ((decal, _, stale), img) in prefetch(jobs, lambda x: _read_decal(x[1])):
+        (height, width) = img.shape[:2]
+        with profiling.span("tint", colors=len(stale)):
+            tinted = decal_colors(img, luts[[i for (i, _, _) in stale]])
+        for ((i, key, inputs), variant) in zip(stale, tinted):
+            # Colors that do not change the sprite (e.g. white) share the image.
+            source = "./" + writer.store_later(images_out, variant).relative_to(out).as_posix()
+            manifest.record(key, inputs, {decal["id"]: source})
+            sets[i].existing.put(decal["id"], Image(source, str(width), str(height)))
+
+
+def _read_decal(sprite: Path) -> np.ndarray:
+    """Decode the sprite of a decal as BGRA."""
+    with profiling.span("decode"):
+        img = cv2.imread(sprite, cv2.IMREAD_UNCHANGED)
+    profiling.count("images_decoded")
+    if img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
+    return img
 
 
 def parse_hex(color: str):
@@ -90,37 +147,36 @@ def parse_hex(color: str):
     raise ValueError("Unknown hex format.")
 
 
-def decal_colors(img: cv2.Mat, color: str):
-    """Scale the colors of an image."""
-    (red, green, blue, alpha) = parse_hex(color)
-    b, g, r, a = cv2.split(img)
-    b = b * (blue / 255)
-    g = g * (green / 255)
-    r = r * (red / 255)
-    a = a * (alpha / 255)
-    return cv2.merge((b, g, r, a))
+def color_luts(colors: list[str]) -> np.ndarray:
+    """Lookup tables that scale every BGRA channel by the given colors.
+
+    Returns an array of shape (colors, 4, 256).
+    """
+    scales = np.array([(b, g, r, a) for (r, g, b, a) in map(parse_hex, colors)],
+                      dtype=np.uint16).reshape((-1, 4, 1))
+    # 255 * 255 + 127 still fits into 16 bits, +127 rounds to the nearest.
+    return ((np.arange(256, dtype=np.uint16) * scales + 127) // 255).astype(np.uint8)
+
 
+def decal_colors(img: np.ndarray, luts: np.ndarray) -> np.ndarray:
+    """Scale the colors of a BGRA image by all the lookup tables at once.
 
-def get_colors(root: Path) -> list[(str, str)]:
+    Returns an array of shape (colors, height, width, 4).
+    """
+    return luts[:, _CHANNELS, img]
+
+
+def get_colors(prototypes: PrototypeIndex) -> list[(str, str)]:
     """Get all color names and values (for decals).
 
     Returns [("palette_color", "#value")]
     """
-    resources_dir = root / "Resources"
-    yml_dir = resources_dir / "Prototypes/Palettes"
-    glob = yml_dir.glob("**/*")
-    files = [x for x in glob if x.is_file()]
-
     results = []
-    for file in files:
-        data = yaml.safe_load(file.read_text("UTF-8"))
-        for palette in data:
-            if palette["type"] != "palette":
-                continue  # alias?
-            for color in palette["colors"]:
-                results.append((
-                    palette["name"] + "_" + color,
-                    palette["colors"][color]
-                ))
+    for palette in prototypes.of_type("palette"):
+        for color in palette["colors"]:
+            results.append((
+                palette["name"] + "_" + color,
+                palette["colors"][color]
+            ))
 
     return results
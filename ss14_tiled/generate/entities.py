@@ -1,267 +1,503 @@
 """Everything for the "entity"-tiles."""
-import copy
-import json
+import io
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr
+from itertools import repeat
 from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
 
 import cv2
-import yaml
+import numpy as np
+
+from .. import profiling
+from ..images import IO_THREADS, ImageWriter, WriteStats, prefetch
+from ..shared import (BuildManifest, CacheJSON, FileHasher, Image, Options, create_tsx,
+                      eprint, hash_object)
+from .prototypes import PrototypeIndex
+from .rsi import RSICache, RSIMeta
+from .rules import ancestor_index, filter_entities, group_entities, select_entities
+
+DIRECTIONS = ("S", "N", "E", "W", "SE", "SW", "NE", "NW")
+
+
+def create_entities(root: Path, out: Path, prototypes: PrototypeIndex,
+                    manifest: BuildManifest, options: Options) -> WriteStats:
+    """Create the "entities"-tiles.
+
+    Without caches that outlive the build, the entity prototypes are dropped from
+    `prototypes` as soon as the render specs are extracted.
+    """
+    images_out = out / ".images"
+    images_out.mkdir(exist_ok=True)
+    groups = _group_specs(prototypes, options)
+
+    hasher = options.caches.hasher if options.caches else FileHasher()
+    rsis = options.caches.rsis if options.caches else RSICache(root / "Resources")
+    writer = ImageWriter(options.encoding, IO_THREADS)
+    with profiling.span("hash_inputs"):
+        (tile_sets, jobs, touched) = _find_jobs(
+            groups, out, manifest, options,
+            lambda spec: entity_inputs(spec, rsis, hasher) | {"encoding": writer.encoding})
+    profiling.count("entities_skipped", sum(len(x) for (_, x) in groups) - len(jobs))
+    profiling.count("entities_rendered", len(jobs))
+
+    with profiling.span("render_entities"):
+        rendered = render_entities([x[1] for x in jobs], rsis, images_out, writer, options.jobs)
+        _record_results(rendered, jobs, out, manifest)
+        writer.flush()
+    for (name, value) in rsis.stats().items():
+        profiling.count(name, value)
+
+    for (g_name, existing) in tile_sets:
+        if options.only is not None and g_name not in touched:
+            continue  # Nothing changed.
+        existing.write_json(out / ".data" / f"entities_{g_name}.json")
+        create_tsx(existing, f"Entities - {g_name}",
+                   out / f"entities_{g_name}.tsx", atlas=writer if options.atlas else None)
+    return writer.stats
+
+
+def _group_specs(prototypes: PrototypeIndex,
+                 options: Options) -> list[tuple[str, list["RenderSpec"]]]:
+    """The render specs of the selected entities, by tile set."""
+    with profiling.span("find_entities"):
+        entities = entity_prototypes(prototypes)
+        # Before filtering, the abstract bases are still needed.
+        ancestors = ancestor_index(entities)
+        if options.only is not None:
+            entities = select_entities(entities, ancestors, options.only, options.rules)
+        entities = resolve_entities(entities)
+    with profiling.span("filter_entities"):
+        entities = filter_entities(entities, options.rules)
+    with profiling.span("group_entities"):
+        groups = group_entities(entities, options.rules, ancestors)
+    with profiling.span("render_specs"):
+        shared = {}
+        groups = [(name, [RenderSpec.of(x, shared) for x in group.values()])
+                  for (name, group) in groups]
+        if options.caches is None:
+            prototypes.forget("entity")
+    return groups
+
+
+def _find_jobs(groups: list[tuple[str, list["RenderSpec"]]], out: Path, manifest: BuildManifest,
+               options: Options, inputs_of: Callable[["RenderSpec"], dict]):
+    """Load the selected tile sets and find the entities that need rendering.
+
+    Returns the tile sets, the jobs (tile set, spec, manifest key, inputs)
+    and the names of the tile sets with jobs.
+    """
+    tile_sets = []
+    jobs = []
+    touched = set()
+    for g_name, group in groups:
+        if options.only is not None and options.only.groups and \
+                g_name not in options.only.groups:
+            continue
+        existing = CacheJSON.from_json(out / ".data" / f"entities_{g_name}.json")
+        tile_sets.append((g_name, existing))
 
-from ..shared import (CacheJSON, Image, add_transparent_image, create_tsx,
-                      eprint, remove_prefix)
+        for spec in sorted(group, key=lambda x: x.id):
+            key = f"entities/{spec.id}"
+            if not options.selected(key):
+                continue
+            inputs = inputs_of(spec)
+            if options.force or not manifest.is_current(key, inputs, existing, out):
+                jobs.append((existing, spec, key, inputs))
+                touched.add(g_name)
+    return (tile_sets, jobs, touched)
+
+
+def _record_results(rendered: Iterator[list[tuple[str, Path, int, int]]], jobs: list[tuple],
+                    out: Path, manifest: BuildManifest):
+    """Put the rendered images into their tile sets and the manifest."""
+    # Rendered first, so it runs to the end (and adds up the write stats).
+    for (results, (existing, _, key, inputs)) in zip(rendered, jobs):
+        outputs = {}
+        for (tile_id, dest, width, height) in results:
+            source = "./" + dest.relative_to(out).as_posix()
+            outputs[tile_id] = source
+            existing.put(tile_id, Image(source, str(width), str(height)))
+        if outputs:
+            manifest.record(key, inputs, outputs)
+
+
+def render_entities(entities: list["RenderSpec"], rsis: RSICache, images_out: Path,
+                    writer: ImageWriter,
+                    jobs: int = 1) -> Iterator[list[tuple[str, Path, int, int]]]:
+    """Render many entities, in a process pool if there is more than one job.
+
+    The results (and warnings) come in the same order as the entities,
+    the write stats of the workers end up in the `writer` once all are taken.
+    """
+    if jobs <= 1 or len(entities) <= 1:
+        # Reader threads load the RSIs ahead, the writer threads encode and write.
+        for (entity, _) in prefetch(entities, lambda x: _load_rsis(x, rsis)):
+            with profiling.span("render_entity", id=entity.id):
+                results = render_entity(entity, rsis, images_out, writer)
+            yield results
+        return
+
+    # Each process gets its own cache, in sum about as big as the one of a single process.
+    max_bytes = max(rsis.sheets.max_size // jobs, 64 * 1024 * 1024)
+    # Neighbours (sorted by id) tend to share RSIs, so keep them together.
+    chunksize = max(1, min(64, len(entities) // (jobs * 8)))
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(rsis.resources_dir, max_bytes, writer.encoding,
+                                       profiling.enabled())) as executor:
+        (total, images, stored) = (WriteStats(), 0, set())
+        for (results, warnings, stats, profile) in executor.map(
+                _render_job, entities, repeat(images_out), chunksize=chunksize):
+            sys.stderr.write(warnings)
+            total.add(stats)
+            images += len(results)
+            stored.update(x[1] for x in results)
+            profiling.merge(profile)
+            yield results
+
+    # A process does not know what the others stored, so everything that was not written
+    # is sorted into unchanged images and duplicates here.
+    total.deduplicated = images - len(stored)
+    total.skipped = max(len(stored) - total.written, 0)
+    total.bytes_skipped = max(sum(x.stat().st_size for x in stored) - total.bytes_written, 0)
+    writer.stats.add(total)
+
+
+_WORKER_RSIS: RSICache | None = None
+# One per process, so it knows the images the process stored before.
+_WORKER_WRITER: ImageWriter | None = None
+
+
+def _init_worker(resources_dir: Path, max_bytes: int, encoding: str, profile: bool):
+    """Set up the RSI cache, image writer (and profiling) of a worker process."""
+    global _WORKER_RSIS, _WORKER_WRITER  # pylint: disable=global-statement
+    _WORKER_RSIS = RSICache(resources_dir, max_bytes)
+    _WORKER_WRITER = ImageWriter(encoding)
+    if profile:
+        profiling.enable()
+
+
+def _render_job(entity: "RenderSpec",
+                images_out: Path) -> tuple[list, str, WriteStats, tuple | None]:
+    """Render an entity in a worker process.
+
+    The warnings, write stats and profile are returned instead of printed or kept.
+    """
+    writer = _WORKER_WRITER
+    writer.stats = WriteStats()
+    before = _WORKER_RSIS.stats() if profiling.enabled() else {}
+    with io.StringIO() as warnings, redirect_stderr(warnings):
+        with profiling.span("render_entity", id=entity.id):
+            results = render_entity(entity, _WORKER_RSIS, images_out, writer)
+        # The caches live on, only send what this entity added.
+        for (name, value) in before.items():
+            profiling.count(name, _WORKER_RSIS.stats()[name] - value)
+        return (results, warnings.getvalue(), writer.stats, profiling.drain())
+
+
+def sprite_layers(entity: dict) -> tuple[dict, list[dict]] | None:
+    """The sprite component and its layers, or None if there is nothing to draw."""
+    sprite = next(
+        (x for x in entity["components"] if x["type"] == "Sprite"), None)
+    icon = next(
+        (x for x in entity["components"] if x["type"] == "Icon"), None)
+    if not sprite:
+        return None
 
+    if "layers" in sprite:
+        return sprite, sprite["layers"]
+    if "sprite" in sprite and "state" in sprite:
+        return sprite, [{"sprite": sprite["sprite"], "state": sprite["state"]}]
+    if icon is not None and "sprite" in icon and "state" in icon:
+        return sprite, [{"sprite": icon["sprite"], "state": icon["state"]}]
+    return None
+
+
+class Layer(NamedTuple):
+    """A visible layer of a sprite."""
+    rsi: str | None
+    state: object  # Usually a string, but YAML turns some into booleans.
+    has_state: bool
+    custom: bool  # Uses a map or a custom type, so it can go without a state.
+
+
+class RenderSpec:
+    """Everything needed to render an entity, a lot smaller than the merged prototype.
+
+    The strings are interned and equal layer stacks shared between the entities.
+    """
+    __slots__ = ("id", "diagonal", "layers")
+
+    def __init__(self, entity_id: str, diagonal: bool, layers: tuple[Layer, ...] | None):
+        self.id = entity_id
+        self.diagonal = diagonal
+        self.layers = layers  # None without a sprite.
+
+    @staticmethod
+    def of(entity: dict, shared: dict | None = None) -> "RenderSpec":
+        """Extract the spec of a (merged) entity, `shared` dedupes the layer stacks."""
+        layers = sprite_layers(entity)
+        if layers is not None:
+            (sprite, layers) = layers
+            layers = tuple(Layer(
+                _intern(x["sprite"] if "sprite" in x else sprite.get("sprite")),
+                _intern(x.get("state")), "state" in x, "map" in x or "type" in x)
+                for x in layers if "visible" not in x or x["visible"])
+            if shared is not None:
+                layers = shared.setdefault(layers, layers)
+        diagonal = "suffix" in entity and "diagonal" in str(entity["suffix"]).lower()
+        return RenderSpec(_intern(entity["id"]), diagonal, layers)
+
+    def digest(self) -> str:
+        """Hash of the spec, changes whenever the rendered images could."""
+        return hash_object([self.id, self.diagonal, self.layers])
+
+
+def _intern(value):
+    """Intern strings, anything else stays as it is."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _load_rsis(entity: RenderSpec, rsis: RSICache):
+    """Load everything an entity needs into the cache, e.g. in a reader thread."""
+    for layer in entity.layers or ():
+        meta = rsis.meta(layer.rsi) if layer.rsi is not None and layer.has_state else None
+        state = meta.find_state(layer.state) if meta else None
+        if state:
+            rsis.sheet(meta, state)
+
+
+def entity_inputs(entity: RenderSpec, rsis: RSICache, hasher: FileHasher) -> dict:
+    """Hashes of everything that goes into rendering an entity."""
+    inputs = {"prototype": entity.digest()}
+    for layer in entity.layers or ():
+        if layer.rsi is None or not layer.has_state:
+            continue
+        rsi_dir = rsis.rsi_dir(layer.rsi)
+        name = rsis.rsi_name(layer.rsi)
+        inputs[f"{name}/meta.json"] = hasher(rsi_dir / "meta.json")
+
+        rsi_meta = rsis.meta(layer.rsi)
+        state = rsi_meta.find_state(layer.state) if rsi_meta else None
+        if state:
+            inputs[f"{name}/{state['name']}.png"] = hasher(rsi_dir / (state["name"] + ".png"))
+    return inputs
+
+
+def render_entity(entity: RenderSpec, rsis: RSICache, images_out: Path,
+                  writer: ImageWriter) -> list[tuple[str, Path, int, int]]:
+    """Render all directions of an entity, identical images are stored once.
+
+    Returns [("tile-id", destination, width, height)]
+    """
+    if entity.layers is None:
+        eprint(f"Entity '{entity.id}' has no sprite!")
+        return []
+
+    # Invisible layers are not even in the spec.
+    layers = [x for x in (_layer_state(entity, layer, rsis) for layer in entity.layers) if x]
+    max_directions = max([4 if entity.diagonal else 1] +
+                         [state.get("directions", 1) for (_, state) in layers])
+
+    rendered = []
+    misses = rsis.composites.misses
+    for d, direction in enumerate(DIRECTIONS[:max_directions]):
+        stack = [x for x in (_layer_tile(entity, meta, state, rsis, (d, max_directions))
+                             for (meta, state) in layers) if x]
+        if not stack:
+            eprint(f"Entity '{entity.id}' has no valid layers!")
+            continue
+        # Smaller layers get centered, as the only entity that uses this is the gravity-gen.
+        shape = (max(x.shape[0] for (_, x) in stack), max(x.shape[1] for (_, x) in stack))
+        img = rsis.composite(stack, shape)
 
-def create_entities(root: Path, out: Path):
-    """Create the "entities"-tiles."""
-    entities_out = out / ".images" / "entities"
-    entities_out.mkdir(parents=True, exist_ok=True)
+        if entity.diagonal:
+            img = _rotate(img, d)
+        dest = writer.store_later(images_out, img)
 
-    entities = find_entities(root)
-    entities = filter_entities(entities)
-    groups = group_entities(entities)
+        (height, width) = img.shape[:2]
+        rendered.append((entity.id + f"_{direction}", dest, width, height))
 
-    resources_dir = root / "Resources"
-    for g_name, group in groups:
-        existing_out = out / ".data" / f"entities_{g_name}.json"
-        existing = CacheJSON.from_json(existing_out)
-
-        for entity in sorted(group.values(), key=lambda x: x["id"]):
-            sprite = next(
-                (x for x in entity["components"] if x["type"] == "Sprite"), None)
-            icon = next(
-                (x for x in entity["components"] if x["type"] == "Icon"), None)
-            if not sprite:
-                eprint(f"Entity '{entity['id']}' has no sprite!")
-                continue
+    if rendered and rsis.composites.misses == misses:
+        profiling.count("entities_from_composite_cache")
+        # Only ever counted by this thread, the writer threads leave it alone.
+        writer.stats.from_composite_cache += 1
+    return rendered
 
-            max_directions = 1
-            diagonal = "suffix" in entity and "diagonal" in str(entity["suffix"]).lower()
-            if diagonal:
-                max_directions = 4
-            for d, direction in enumerate(("S", "N", "E", "W", "SE", "SW", "NE", "NW")):
-                if d >= max_directions:
-                    break
-
-                dest: Path = entities_out / (str(entity["id"]) + f"_{direction}.png")
-                img = None
-                if "layers" not in sprite:
-                    if "sprite" in sprite and "state" in sprite:
-                        sprite["layers"] = [{
-                            "sprite": sprite["sprite"],
-                            "state": sprite["state"]
-                        }]
-                    elif icon is not None and "sprite" in icon and "state" in icon:
-                        sprite["layers"] = [{
-                            "sprite": icon["sprite"],
-                            "state": icon["state"]
-                        }]
-                    else:
-                        eprint(f"Entity '{entity['id']}' has no sprite!")
-                        continue
-
-                for layer in sprite["layers"]:
-                    # Skip layers that are invisible by default.
-                    if "visible" in layer and not layer["visible"]:
-                        continue
-
-                    if "sprite" not in layer:
-                        if "sprite" in sprite:
-                            layer["sprite"] = sprite["sprite"]
-                        else:
-                            eprint(
-                                f"Entity '{entity['id']}' is missing a sprite!")
-                            continue
-                    if "state" not in layer:
-                        if "map" not in layer and not "type" in layer:
-                            # Simply ignore if the layer uses a map or custom type.
-                            eprint(
-                                f"Entity '{entity['id']}' is missing a state!")
-                        continue
-
-                    layer_rsi_file: Path = resources_dir / "Textures" / \
-                        remove_prefix(layer["sprite"], "/Textures/") / "meta.json"
-                    if not layer_rsi_file.exists():
-                        eprint(f"Entity '{entity['id']}' is missing RSI!")
-                        continue
-
-                    # Some files have a BOM for some reason...
-                    json_text = layer_rsi_file.read_text("UTF-8").replace("\uFEFF", "")
-                    layer_rsa = json.loads(json_text)
-
-                    # YAML has some eager boolean parsing...
-                    if layer["state"] is True:
-                        yes = ["y", "yes", "true", "on"]
-                        state = next(
-                            (x for x in layer_rsa["states"]
-                             if x["name"].lower() in yes), None)
-                    elif layer["state"] is False:
-                        no = ["n", "no", "false", "off"]
-                        state = next(
-                            (x for x in layer_rsa["states"]
-                             if x["name"].lower() in no), None)
-                    else:
-                        state = next(
-                            (x for x in layer_rsa["states"]
-                             if x["name"] == str(layer["state"])), None)
-
-                    if not state:
-                        eprint(f"Entity '{entity['id']}' is missing state '{layer['state']}!")
-                        continue
-
-                    tile_width = layer_rsa["size"]["x"]
-                    tile_height = layer_rsa["size"]["y"]
-
-                    directions = 1
-                    if "directions" in state:
-                        directions = state["directions"]
-                        max_directions = max(max_directions, directions)
-
-                    if directions not in (1, 4, 8):
-                        eprint(f"Entity '{entity['id']} wants {directions} directions!")
-                        continue
-
-                    per_direction = 1
-                    if "delays" in state:
-                        per_direction = len(state["delays"][0])
-
-                    layer_image_file = layer_rsi_file.parent / (state["name"] + ".png")
-                    layer_image = cv2.imread(layer_image_file, cv2.IMREAD_UNCHANGED)
-                    height, width, dim = layer_image.shape
-                    if dim == 3:
-                        layer_image = cv2.cvtColor(layer_image, cv2.COLOR_RGB2RGBA)
-                        dim = 4
-
-                    if directions == 1:
-                        index = 0
-                    elif directions == max_directions:
-                        index = per_direction * d
-                    else:
-                        eprint(f"Entity '{entity['id']} has incompatible directions!")
-                        continue
-
-                    tiles_x = width // tile_width
-                    y_offset = (index // tiles_x) * tile_height
-                    x_offset = (index % tiles_x) * tile_width
-
-                    layer_image = layer_image[
-                        y_offset:y_offset+tile_height,
-                        x_offset:x_offset+tile_width
-                    ]
-                    height, width, dim = layer_image.shape
-
-                    if img is None:
-                        img = layer_image
-                    else:
-                        e_height, e_width, e_dim = img.shape
-                        if e_dim != dim:
-                            eprint(f"Entity '{entity['id']}' has a different number of dimensions!")
-                            continue
-
-                        # Expand canvas so that both are the same size.
-                        # Just center it, as the only entity that uses this is the gravity-gen.
-                        m_height = max(e_height, height)
-                        m_width = max(e_width, width)
-                        img = cv2.copyMakeBorder(img,
-                                                 (m_height - e_height) // 2,
-                                                 (m_height - e_height) // 2,
-                                                 (m_width - e_width) // 2,
-                                                 (m_width - e_width) // 2,
-                                                 cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
-                        layer_image = cv2.copyMakeBorder(layer_image,
-                                                         (m_height - height) // 2,
-                                                         (m_height - height) // 2,
-                                                         (m_width - width) // 2,
-                                                         (m_width - width) // 2,
-                                                         cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
-                        add_transparent_image(img, layer_image)
-
-                if img is None:
-                    eprint(f"Entity '{entity['id']}' has no valid layers!")
-                    continue
 
-                if diagonal:
-                    if not d:     # S
-                        pass
-                    elif d == 1:  # N
-                        img = cv2.rotate(img, cv2.ROTATE_180)
-                    elif d == 2:  # E
-                        img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-                    elif d == 3:  # W
-                        img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-                    else:
-                        raise ValueError(f"Expected d to be 0-3, not '{d}'.")
-                cv2.imwrite(dest, img)
-
-                # Update the sprite but not the index.
-                if entity["id"] + f"_{directions}" in existing.ids:
-                    continue
+def _layer_state(entity: RenderSpec, layer: Layer,
+                 rsis: RSICache) -> tuple[RSIMeta, dict] | None:
+    """The RSI and state of a layer, None (and a warning, if it is a problem) without."""
+    if layer.rsi is None:
+        eprint(f"Entity '{entity.id}' is missing a sprite!")
+        return None
+    if not layer.has_state:
+        if not layer.custom:
+            # Simply ignore if the layer uses a map or custom type.
+            eprint(f"Entity '{entity.id}' is missing a state!")
+        return None
 
-                height, width, dim = img.shape
-                existing.ids.append(entity["id"] + f"_{direction}")
-                existing.images.append(
-                    Image(f"./.images/entities/{dest.name}", str(width), str(height)))
+    meta = rsis.meta(layer.rsi)
+    if meta is None:
+        eprint(f"Entity '{entity.id}' is missing RSI!")
+        return None
 
-        existing_out.write_text(json.dumps(existing, default=vars), "UTF-8")
-        create_tsx(existing, f"Entities - {g_name}",
-                   out / f"entities_{g_name}.tsx")
-
-
-def find_entities(root: Path) -> list[dict]:
-    """Find and return all entities."""
-
-    # Some bases are outside the "Entities" directory,
-    # so we have to go over everything.
-    yml_dir = root / "Resources/Prototypes"
-    files = [x for x in yml_dir.glob("**/*.yml") if x.is_file()]
-
-    children = []
-    adults = {}
-    for file in files:
-        for entity in yaml.load(file.read_text("UTF-8"), Loader=SafeLoadIgnoreUnknown) or []:
-            if entity["type"] != "entity":
-                continue  # alias?
-            if "parent" in entity:
-                if isinstance(entity["parent"], str):
-                    entity["parent"] = [entity["parent"]]
-                children.append(entity)
-            else:
-                entity["parent"] = []
-                adults[entity["id"]] = entity
-
-    while len(children) > 0:
-        still_children = []
-        for child in children:
-            parents = child["parent"]
-            if isinstance(parents, str):
-                parents = [parents]
-
-            if all(parent in adults for parent in parents):
-                merged = adults[parents[0]]
-                for parent in parents[1:]:
-                    merged = merge_entity(adults[parent], merged)
-                adults[child["id"]] = merge_entity(child, merged)
-            else:
-                still_children.append(child)
-
-        children = still_children
-
-    return adults
-
-
-class SafeLoadIgnoreUnknown(yaml.SafeLoader):
-    """YAML-Loader that ignores unknown constructors."""
-
-    def ignore_unknown(self, _node):
-        """Returns None no matter the node."""
+    state = meta.find_state(layer.state)
+    if not state:
+        eprint(f"Entity '{entity.id}' is missing state '{layer.state}!")
+        return None
+    return (meta, state)
+
+
+def _layer_tile(entity: RenderSpec, meta: RSIMeta, state: dict, rsis: RSICache,
+                direction: tuple[int, int]) -> tuple[tuple, np.ndarray] | None:
+    """The (composite cache key, image) of a layer in direction (d, of max_directions)."""
+    (d, max_directions) = direction
+    directions = state.get("directions", 1)
+    if directions not in (1, 4, 8):
+        eprint(f"Entity '{entity.id} wants {directions} directions!")
         return None
 
+    per_direction = 1
+    if "delays" in state:
+        per_direction = len(state["delays"][0])
 
-SafeLoadIgnoreUnknown.add_constructor(
-    None, SafeLoadIgnoreUnknown.ignore_unknown)
+    layer_image = rsis.sheet(meta, state)
+    if layer_image is None:
+        eprint(f"Entity '{entity.id}' is missing the image of '{state['name']}'!")
+        return None
+
+    if directions == 1:
+        index = 0
+    elif directions == max_directions:
+        index = per_direction * d
+    else:
+        eprint(f"Entity '{entity.id} has incompatible directions!")
+        return None
+
+    tiles_x = layer_image.shape[1] // meta.width
+    y_offset = (index // tiles_x) * meta.height
+    x_offset = (index % tiles_x) * meta.width
+    return ((str(meta.path), state["name"], index), layer_image[
+        y_offset:y_offset+meta.height,
+        x_offset:x_offset+meta.width
+    ])
+
+
+def _rotate(img: np.ndarray, d: int) -> np.ndarray:
+    """Turn the south-facing sprite of a diagonal entity towards direction d."""
+    if not d:     # S
+        return img
+    if d == 1:  # N
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if d == 2:  # E
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if d == 3:  # W
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    raise ValueError(f"Expected d to be 0-3, not '{d}'.")
+
+
+def find_entities(prototypes: PrototypeIndex) -> dict[str, dict]:
+    """Find and return all entities, with their parents merged in."""
+    return resolve_entities(entity_prototypes(prototypes))
+
+
+def entity_prototypes(prototypes: PrototypeIndex) -> dict[str, dict]:
+    """All entities as they are, with the parents always as a list."""
+    entities = {}
+    for entity in prototypes.of_type("entity"):
+        parents = entity.get("parent", [])
+        if isinstance(parents, str):
+            parents = [parents]
+        entities[entity["id"]] = entity | {"parent": list(parents)}
+    return entities
+
+
+def resolve_entities(entities: dict[str, dict]) -> dict[str, dict]:
+    """Merge the parents into all entities, each entity is only resolved once.
+
+    Entities with a missing parent or an inheritance cycle
+    (and everything that inherits from them) are reported and left out.
+    """
+    children: dict[str, list[str]] = {}
+    waiting: dict[str, int] = {}
+    ready = deque()
+    for (key, entity) in entities.items():
+        missing = [x for x in entity["parent"] if x not in entities]
+        if missing:
+            eprint(f"Entity '{key}' has a missing parent '{missing[0]}'!")
+            continue
+        parents = set(entity["parent"])
+        waiting[key] = len(parents)
+        for parent in parents:
+            children.setdefault(parent, []).append(key)
+        if not parents:
+            ready.append(key)
+
+    # Kahn's algorithm, an entity is ready once all of its parents are resolved.
+    resolved = {}
+    while ready:
+        key = ready.popleft()
+        entity = entities[key]
+        if not entity["parent"]:
+            resolved[key] = entity
+        else:
+            parents = entity["parent"]
+            merged = resolved[parents[0]]
+            for parent in parents[1:]:
+                merged = merge_entity(resolved[parent], merged)
+            resolved[key] = merge_entity(entity, merged)
+
+        for child in children.get(key, []):
+            waiting[child] -= 1
+            if not waiting[child]:
+                ready.append(child)
+
+    _report_unresolved(entities, resolved)
+    return resolved
+
+
+def _report_unresolved(entities: dict[str, dict], resolved: dict[str, dict]):
+    """Explain why some entities could not be resolved."""
+    unresolved = {k for k in entities if k not in resolved}
+    in_cycle = set()
+    visited = set()
+    path = []
+
+    def visit(key: str):
+        visited.add(key)
+        path.append(key)
+        for parent in entities[key]["parent"]:
+            if parent not in unresolved:
+                continue
+            if parent in path:
+                cycle = path[path.index(parent):]
+                in_cycle.update(cycle)
+                eprint(f"Entity '{parent}' has an inheritance cycle "
+                       f"({' -> '.join(cycle + [parent])})!")
+            elif parent not in visited:
+                visit(parent)
+        path.pop()
+
+    for key in sorted(unresolved):
+        if key not in visited:
+            visit(key)
+
+    for key in sorted(unresolved - in_cycle):
+        parent = next(x for x in entities[key]["parent"] if x not in resolved)
+        if parent in entities:
+            eprint(f"Entity '{key}' inherits from '{parent}', which could not be resolved!")
 
 
 def merge_entity(child: dict, parent: dict) -> dict:
-    """Merge entities."""
-    out = copy.deepcopy(parent)
+    """Merge entities.
+
+    Copy-on-write: everything the child does not override is shared with
+    the parent, so neither the result nor its parents may be modified.
+    """
+    out = dict(parent)
     for (key, value) in child.items():
         if key in ("components", "parent"):
             continue
@@ -272,107 +508,25 @@ def merge_entity(child: dict, parent: dict) -> dict:
     elif "abstract" in out:
         del out["abstract"]
 
-    out["parent"] = list(set(out["parent"] + child["parent"]))
+    out["parent"] = sorted(set(out["parent"] + child["parent"]))
 
     if "components" in child:
-        if not "components" in out:
+        if "components" not in out:
             out["components"] = child["components"]
         else:
+            components = list(out["components"])
+            by_type: dict[str, list[int]] = {}
+            for (i, component) in enumerate(components):
+                by_type.setdefault(component["type"], []).append(i)
+
             for child_comp in child["components"]:
-                found = False
-                for i, out_comp in enumerate(out["components"]):
-                    if child_comp["type"] != out_comp["type"]:
-                        continue
-                    found = True
-                    for (key, value) in child_comp.items():
-                        out_comp[key] = value
-                    out["components"][i] = out_comp
-                if not found:
-                    out["components"].append(child_comp)
+                indices = by_type.get(child_comp["type"])
+                if indices is None:
+                    by_type[child_comp["type"]] = [len(components)]
+                    components.append(child_comp)
+                    continue
+                for i in indices:
+                    components[i] = components[i] | child_comp
+            out["components"] = components
 
     return out
-
-
-def filter_entities(entities: dict) -> dict:
-    """Filter out some of the entities."""
-    entities = {k: v for k, v in entities.items()
-                if "abstract" not in v}
-    entities = {k: v for k, v in entities.items()
-                if "Sprite" in [x["type"] for x in v["components"]]}
-    entities = {k: v for k, v in entities.items()
-                if "TimedDespawn" not in [x["type"] for x in v["components"]]}
-    entities = {k: v for k, v in entities.items()
-                if "suffix" not in v or "DEBUG" not in str(v["suffix"])}
-    entities = {k: v for k, v in entities.items()
-                if "suffix" not in v or "Admeme" not in str(v["suffix"])}
-    entities = {k: v for k, v in entities.items()
-                if "suffix" not in v or "DO NOT MAP" not in str(v["suffix"])}
-    entities = {k: v for k, v in entities.items()
-                if "categories" not in v or "HideSpawnMenu" not in v["categories"]}
-    entities = {k: v for k, v in entities.items()
-                if "Input" not in [x["type"] for x in v["components"]]}
-    entities = {k: v for k, v in entities.items()
-                if "RandomHumanoidSpawner" not in [x["type"] for x in v["components"]]}
-
-    return entities
-
-
-def group_entities(entities: dict) -> list[tuple[str, dict[str, dict]]]:
-    """Split entities into groups."""
-    pipes = {}
-    window_doors = {}
-    eat_and_drink = {}
-    clothes = {}
-    closets = {}
-    airlocks = {}
-    windows = {}
-    walls = {}
-    computers = {}
-    markers = {}
-    signs = {}
-    other = {}
-
-    for key, value in entities.items():
-        parents = value["parent"]
-        if "GasPipeBase" in parents or "DisposalPipeBase" in parents:
-            pipes[key] = value
-        elif "BaseWindoor" in parents:
-            window_doors[key] = value
-        elif "FoodBase" in parents or "DrinkBase" in parents:
-            eat_and_drink[key] = value
-        elif "Clothing" in parents:
-            clothes[key] = value
-        elif "ClosetBase" in parents or "BaseWallCloset" in parents:
-            closets[key] = value
-        elif key == "Airlock" or "Airlock" in parents or "BaseFirelock" in parents:
-            airlocks[key] = value
-        elif key == "Window" or "Window" in parents \
-                or key == "WindowDirectional" or "WindowDirectional" in parents \
-                or "PlastitaniumWindowBase" in parents:
-            windows[key] = value
-        elif key == "WallShuttleDiagonal" or "WallShuttleDiagonal" in parents \
-                or key == "WallPlastitaniumDiagonalIndestructible" or "BaseWall" in parents:
-            walls[key] = value
-        elif "BaseComputer" in parents:
-            computers[key] = value
-        elif "MarkerBase" in parents:
-            markers[key] = value
-        elif "BaseSign" in parents:
-            signs[key] = value
-        else:
-            other[key] = value
-
-    return [
-        ("Pipes", pipes),
-        ("Windoors", window_doors),
-        ("Eat and Drink", eat_and_drink),
-        ("Clothes", clothes),
-        ("Closets and Lockers", closets),
-        ("Airlocks", airlocks),
-        ("Windows", windows),
-        ("Walls", walls),
-        ("Computers", computers),
-        ("Markers", markers),
-        ("Signs", signs),
-        ("Other", other),
-    ]
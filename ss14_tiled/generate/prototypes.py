@@ -0,0 +1,180 @@
+"""Everything for loading the YAML prototypes."""
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import repeat
+from pathlib import Path
+from typing import Iterable
+
+import yaml
+
+from .. import profiling
+from ..shared import FileHasher, eprint, write_atomic
+
+# Use libyaml if PyYAML was built with it, it is a lot faster.
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# Bump this whenever the parsing changes, so the cached prototypes are parsed again.
+CACHE_VERSION = 1
+
+
+class SafeLoadIgnoreUnknown(_SafeLoader):
+    """YAML-Loader that ignores unknown constructors."""
+
+    def ignore_unknown(self, _node):
+        """Returns None no matter the node."""
+        return None
+
+
+SafeLoadIgnoreUnknown.add_constructor(
+    None, SafeLoadIgnoreUnknown.ignore_unknown)
+
+
+def load_file(file: Path, types: frozenset[str] | None = None) -> list[dict]:
+    """Parse a single prototype file.
+
+    With `types`, files that do not mention any of them are not even parsed.
+    """
+    text = file.read_text("UTF-8")
+    if types is not None and not any(
+            x.group(1) in types for x in _PROTOTYPE_TYPE.finditer(text)):
+        return []
+    return yaml.load(text, Loader=SafeLoadIgnoreUnknown) or []
+
+
+# Prototypes have a "type: name" key (not necessarily the first one), components have
+# capitalized types. Finding too many only means a file is parsed for nothing,
+# finding too few would lose prototypes.
+_PROTOTYPE_TYPE = re.compile(r"^[\s-]*type:\s*[\"']?([a-z]\w*)", re.MULTILINE)
+
+
+def load_files(files: list[Path], jobs: int = 1,
+               types: frozenset[str] | None = None) -> list[list[dict]]:
+    """Parse all the given prototype files.
+
+    With more than one job the files are spread across a process pool.
+    The results are always in the same order as `files`.
+    """
+    profiling.count("files_parsed", len(files))
+    if jobs <= 1 or len(files) <= 1:
+        return [load_file(file, types) for file in files]
+
+    # Bigger chunks keep the inter-process chatter down.
+    chunksize = max(1, len(files) // (jobs * 4))
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(load_file, files, repeat(types), chunksize=chunksize))
+
+
+def load_cached(root: Path, files: list[Path], cache_file: Path, jobs: int = 1,
+                types: frozenset[str] | None = None) -> list[list[dict]]:
+    """Like `load_files`, but files that did not change since the last time are not parsed.
+
+    The parsed files are pickled into `cache_file`, keyed by their path. They count as
+    unchanged with the same modification time and size, or else the same content hash
+    (e.g. after switching branches back and forth).
+    """
+    entries = _read_cache(cache_file)
+    hasher = FileHasher()
+    names = [x.relative_to(root).as_posix() for x in files]
+    cached: dict[str, tuple] = {}
+    stale = []
+    for (file, name) in zip(files, names):
+        stat = file.stat()
+        entry = entries.get(name)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            cached[name] = entry
+        elif entry is not None and entry[1] == stat.st_size and entry[2] == hasher(file):
+            cached[name] = (stat.st_mtime_ns, *entry[1:])
+        else:
+            stale.append((file, name, stat))
+    profiling.count("files_cached", len(files) - len(stale))
+
+    parsed = {}
+    for ((file, name, stat), documents) in zip(
+            stale, load_files([x[0] for x in stale], jobs, types)):
+        parsed[name] = documents
+        if types is None or documents:  # Otherwise it might not have been parsed at all.
+            cached[name] = (stat.st_mtime_ns, stat.st_size, hasher(file), documents)
+
+    if cached != entries:  # Values are compared by identity first, this is quick.
+        with profiling.span("write_prototype_cache"):
+            write_atomic(cache_file, pickle.dumps((_cache_version(), cached),
+                                                  pickle.HIGHEST_PROTOCOL))
+    return [parsed[name] if name in parsed else cached[name][3] for name in names]
+
+
+def _cache_version() -> tuple:
+    """Everything that changes what the parsed files look like."""
+    return (CACHE_VERSION, yaml.__version__, _SafeLoader.__name__)
+
+
+def _read_cache(cache_file: Path) -> dict[str, tuple]:
+    """Path -> (mtime, size, hash, documents), nothing if the cache is missing or outdated."""
+    try:
+        with profiling.span("read_prototype_cache"):
+            (version, entries) = pickle.loads(cache_file.read_bytes())
+    except FileNotFoundError:
+        return {}
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError):
+        eprint(f"Could not read '{cache_file}', parsing all prototypes again.")
+        return {}
+    return entries if version == _cache_version() else {}
+
+
+def find_files(root: Path) -> list[Path]:
+    """Find all prototype files, sorted so the order does not depend on the file system."""
+    yml_dir = root / "Resources/Prototypes"
+    return sorted(x for x in yml_dir.glob("**/*.yml") if x.is_file())
+
+
+@dataclass
+class PrototypeIndex:
+    """All prototypes, parsed once and bucketed by their type."""
+    by_type: dict[str, list[dict]] = field(default_factory=dict)
+    by_id: dict[str, dict[str, dict]] = field(default_factory=dict)
+
+    @staticmethod
+    def from_root(root: Path, jobs: int = 1, types: frozenset[str] | None = None,
+                  cache_file: Path | None = None) -> "PrototypeIndex":
+        """Parse all the prototypes of an SS14 checkout (or the files with any of the `types`).
+
+        With a `cache_file`, only the files that changed since the last time are parsed.
+        """
+        files = find_files(root)
+        with profiling.span("parse_prototypes", files=len(files)):
+            if cache_file is None:
+                documents = load_files(files, jobs, types)
+            else:
+                documents = load_cached(root, files, cache_file, jobs, types)
+        return PrototypeIndex.from_documents(documents)
+
+    @staticmethod
+    def from_documents(documents: Iterable[list[dict]]) -> "PrototypeIndex":
+        """Index already parsed prototype files, in the order of `find_files`."""
+        index = PrototypeIndex()
+        for prototype in (x for file in documents for x in file):
+            index.add(prototype)
+        profiling.count("prototypes", sum(len(x) for x in index.by_type.values()))
+        return index
+
+    def add(self, prototype: dict):
+        """Add a single prototype, a later one with the same id wins the lookup."""
+        if not isinstance(prototype, dict) or "type" not in prototype:
+            return
+        kind = prototype["type"]
+        self.by_type.setdefault(kind, []).append(prototype)
+        if "id" in prototype:
+            self.by_id.setdefault(kind, {})[prototype["id"]] = prototype
+
+    def forget(self, kind: str):
+        """Drop all prototypes of a type, e.g. once they are not needed anymore."""
+        self.by_type.pop(kind, None)
+        self.by_id.pop(kind, None)
+
+    def of_type(self, kind: str) -> list[dict]:
+        """All prototypes of a type, in file order."""
+        return self.by_type.get(kind, [])
+
+    def get(self, kind: str, prototype_id: str) -> dict | None:
+        """Look up a prototype by its type and id."""
+        return self.by_id.get(kind, {}).get(prototype_id)
@@ -0,0 +1,210 @@
+"""Cached access to RSIs (the sprite directories with a "meta.json")."""
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import Callable
+
+import cv2
+import numpy as np
+
+from .. import profiling
+from ..shared import composite_layers, remove_prefix
+
+# YAML has some eager boolean parsing...
+_YES = ("y", "yes", "true", "on")
+_NO = ("n", "no", "false", "off")
+
+
+@dataclass
+class RSIMeta:
+    """Parsed "meta.json" of an RSI, with the states indexed by name."""
+    path: Path
+    width: int
+    height: int
+    states: dict[str, dict]
+    booleans: dict[bool, dict]
+
+    @staticmethod
+    def from_json(path: Path) -> "RSIMeta":
+        """Parse a "meta.json"."""
+        # Some files have a BOM for some reason...
+        data = json.loads(path.read_text("UTF-8").replace("\uFEFF", ""))
+        states = {}
+        booleans = {}
+        for state in data["states"]:
+            # The first one wins, like a linear search would.
+            states.setdefault(state["name"], state)
+            if state["name"].lower() in _YES:
+                booleans.setdefault(True, state)
+            elif state["name"].lower() in _NO:
+                booleans.setdefault(False, state)
+        return RSIMeta(path.parent, data["size"]["x"], data["size"]["y"], states, booleans)
+
+    def find_state(self, state) -> dict | None:
+        """Find a state by its name, YAML booleans match "yes", "off" and so on."""
+        if isinstance(state, bool):
+            return self.booleans.get(state)
+        return self.states.get(str(state))
+
+
+@dataclass
+class LRUCache:
+    """Least recently used cache, bounded by the total size of the values.
+
+    Thread-safe, but two threads missing the same key at once both load it.
+    """
+    max_size: int
+    sizeof: Callable[[object], int] = lambda _: 1
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    _data: OrderedDict = field(default_factory=OrderedDict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get(self, key, load: Callable):
+        """Get a value, `load`-ing and caching it if it is missing."""
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key][0]
+            self.misses += 1
+
+        value = load()  # Without the lock, so other threads can load at the same time.
+        self.put(key, value)
+        return value
+
+    def peek(self, key):
+        """Get a value without counting a hit or miss, None if it is missing."""
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        """Add (or replace) a value."""
+        value_size = self.sizeof(value)
+        if value_size > self.max_size:
+            return  # Would evict everything else.
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (value, value_size)
+            self.size += value_size
+            while self.size > self.max_size:
+                (_, (_, evicted)) = self._data.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        """Forget all values."""
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def discard(self, key):
+        """Forget a single value."""
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        """Forget a single value, with the lock held."""
+        if key in self._data:
+            self.size -= self._data.pop(key)[1]
+
+
+class RSICache:
+    """Parsed "meta.json"-files, decoded state sheets and composited layer stacks.
+
+    Shared across entities (and threads).
+    """
+
+    def __init__(self, resources_dir: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.resources_dir = resources_dir
+        self.metas = LRUCache(16384)
+        self.sheets = LRUCache(max_bytes, lambda x: 0 if x is None else x.nbytes)
+        # Variants of an entity tend to only differ in their top layers.
+        self.composites = LRUCache(max_bytes // 4, lambda x: x.nbytes)
+
+    def rsi_dir(self, rsi: str) -> Path:
+        """Directory of an RSI, as used by the prototypes."""
+        return self.resources_dir / "Textures" / remove_prefix(rsi, "/Textures/")
+
+    @staticmethod
+    def rsi_name(rsi: str) -> str:
+        """Name of an RSI relative to the resources, e.g. for the manifest.
+
+        Not taken from `rsi_dir`, sprites outside of the textures end up outside of the
+        resources and are only reported when rendering.
+        """
+        return PurePosixPath("Textures", remove_prefix(rsi, "/Textures/")).as_posix()
+
+    def meta(self, rsi: str) -> RSIMeta | None:
+        """Metadata of an RSI, or None if it does not exist."""
+        meta_file = self.rsi_dir(rsi) / "meta.json"
+        return self.metas.get(
+            meta_file, lambda: RSIMeta.from_json(meta_file) if meta_file.exists() else None)
+
+    def sheet(self, meta: RSIMeta, state: dict) -> np.ndarray | None:
+        """The whole (read-only) BGRA image of a state, with all directions and frames."""
+        sheet_file = meta.path / (state["name"] + ".png")
+        return self.sheets.get(sheet_file, lambda: _read_sheet(sheet_file))
+
+    def composite(self, stack: list[tuple[tuple, np.ndarray]],
+                  shape: tuple[int, int]) -> np.ndarray:
+        """Composite the (key, layer) stack into an image of `shape`, read-only.
+
+        The key of a layer has to tell its pixels apart, e.g. (sheet, frame index).
+        Starts from the longest prefix of the stack that was composited before, and keeps
+        everything below the top layer for the next variant. As the compositor truncates
+        after every layer, that gives the same pixels as compositing the stack in one go.
+        """
+        keys = tuple(x for (x, _) in stack)
+
+        def load() -> np.ndarray:
+            (start, below) = next(
+                ((n, [x]) for n in range(len(stack) - 1, 0, -1)
+                 if (x := self.composites.peek((shape, keys[:n]))) is not None), (0, []))
+            layers = [x for (_, x) in stack]
+            if len(stack) - start > 1:
+                below = [self._composite(below + layers[start:-1], shape)]
+                self.composites.put((shape, keys[:-1]), below[0])
+            return self._composite(below + layers[-1:], shape)
+
+        return self.composites.get((shape, keys), load)
+
+    @staticmethod
+    def _composite(layers: list[np.ndarray], shape: tuple[int, int]) -> np.ndarray:
+        """Composite some layers into a read-only image."""
+        with profiling.span("composite", layers=len(layers)):
+            img = composite_layers(layers, shape)
+        img.flags.writeable = False
+        return img
+
+    def forget(self, path: Path):
+        """Load a "meta.json" or state sheet again the next time, e.g. after it changed."""
+        self.metas.discard(path)
+        self.sheets.discard(path)
+        self.composites.clear()  # Whatever used the sheet.
+
+    def stats(self) -> dict[str, int]:
+        """Hit and miss counters."""
+        return {"rsi_meta_hits": self.metas.hits, "rsi_meta_misses": self.metas.misses,
+                "rsi_sheet_hits": self.sheets.hits, "rsi_sheet_misses": self.sheets.misses,
+                "composite_hits": self.composites.hits,
+                "composite_misses": self.composites.misses}
+
+
+def _read_sheet(path: Path) -> np.ndarray | None:
+    """Decode a state sheet as BGRA."""
+    with profiling.span("decode"):
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+    profiling.count("images_decoded")
+    if img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
+    # It is shared, so nobody gets to draw on it.
+    img.flags.writeable = False
+    return img
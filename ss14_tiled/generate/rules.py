@@ -0,0 +1,214 @@
+"""Rules that decide which entities end up in the tile sets.
+
+Extra rules can be given in a YAML file, e.g.:
+
+    exclude:
+    - component: GhostRole
+    - suffix: Test
+      id: "Base*"  # all keys of a rule have to match
+    groups:
+    - name: Machines
+      ancestors: [BaseMachine, BaseMachinePowered]
+    - name: Walls  # extends the existing group
+      ids: [WallRock]
+"""
+import sys
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Callable
+
+import yaml
+
+from ..shared import Selection
+
+# Entities matching any of these are left out.
+DEFAULT_EXCLUDE = [
+    {"abstract": True},
+    {"missing_component": "Sprite"},
+    {"component": "TimedDespawn"},
+    {"suffix": "DEBUG"},
+    {"suffix": "Admeme"},
+    {"suffix": "DO NOT MAP"},
+    {"category": "HideSpawnMenu"},
+    {"component": "Input"},
+    {"component": "RandomHumanoidSpawner"},
+]
+
+
+# The first group an entity matches is the tile set it ends up in.
+DEFAULT_GROUPS = [
+    {"name": "Pipes", "ancestors": ["GasPipeBase", "DisposalPipeBase"]},
+    {"name": "Windoors", "ancestors": ["BaseWindoor"]},
+    {"name": "Eat and Drink", "ancestors": ["FoodBase", "DrinkBase"]},
+    {"name": "Clothes", "ancestors": ["Clothing"]},
+    {"name": "Closets and Lockers", "ancestors": ["ClosetBase", "BaseWallCloset"]},
+    {"name": "Airlocks", "ids": ["Airlock"], "ancestors": ["Airlock", "BaseFirelock"]},
+    {"name": "Windows", "ids": ["Window", "WindowDirectional"],
+     "ancestors": ["Window", "WindowDirectional", "PlastitaniumWindowBase"]},
+    {"name": "Walls", "ids": ["WallShuttleDiagonal", "WallPlastitaniumDiagonalIndestructible"],
+     "ancestors": ["WallShuttleDiagonal", "BaseWall"]},
+    {"name": "Computers", "ancestors": ["BaseComputer"]},
+    {"name": "Markers", "ancestors": ["MarkerBase"]},
+    {"name": "Signs", "ancestors": ["BaseSign"]},
+]
+# Everything that matches no group.
+OTHER_GROUP = "Other"
+
+
+@dataclass(frozen=True)
+class GroupRule:
+    """Entities with one of the ids or ancestors belong into the group."""
+    name: str
+    ids: frozenset[str]
+    ancestors: frozenset[str]
+
+    @staticmethod
+    def of(rule: dict) -> "GroupRule":
+        """Check and convert a group from a rules file."""
+        unknown = set(rule) - {"name", "ids", "ancestors"}
+        if unknown or "name" not in rule:
+            raise ValueError(f"Expected a group with a name, ids and ancestors, not {rule}.")
+        return GroupRule(str(rule["name"]), frozenset(rule.get("ids") or []),
+                         frozenset(rule.get("ancestors") or []))
+
+    def matches(self, key: str, ancestors: frozenset[str]) -> bool:
+        """Whether an entity belongs into this group."""
+        return key in self.ids or not self.ancestors.isdisjoint(ancestors)
+
+
+@dataclass(frozen=True)
+class EntityFacts:
+    """Everything the rules look at, computed once per entity."""
+    id: str
+    abstract: bool
+    components: frozenset[str]
+    suffix: str
+    categories: frozenset[str]
+
+    @staticmethod
+    def of(entity: dict) -> "EntityFacts":
+        """Gather the facts of a (merged) entity."""
+        return EntityFacts(
+            str(entity["id"]),
+            "abstract" in entity,
+            frozenset(x["type"] for x in entity.get("components") or []),
+            str(entity["suffix"]) if "suffix" in entity else "",
+            frozenset(entity.get("categories") or []))
+
+
+# Every key a rule can have, and how it is matched.
+_CONDITIONS: dict[str, Callable[[EntityFacts, object], bool]] = {
+    "abstract": lambda facts, value: facts.abstract == bool(value),
+    "component": lambda facts, value: value in facts.components,
+    "missing_component": lambda facts, value: value not in facts.components,
+    "suffix": lambda facts, value: value in facts.suffix,
+    "category": lambda facts, value: value in facts.categories,
+    "id": lambda facts, value: fnmatchcase(facts.id, value),
+}
+
+
+def load_rules(path: Path | None) -> dict:
+    """Load a rules file, or no extra rules at all without one."""
+    if path is None:
+        return {}
+    rules = yaml.safe_load(path.read_text("UTF-8")) or {}
+    if not isinstance(rules, dict):
+        raise ValueError(f"Expected a mapping in '{path}'.")
+    for key in ("exclude", "groups"):
+        # An empty key is None in YAML.
+        rules[key] = rules.get(key) or []
+        if not isinstance(rules[key], list) or \
+                not all(isinstance(x, dict) for x in rules[key]):
+            raise ValueError(f"Expected a list of rules for '{key}' in '{path}'.")
+    # Fail early on typos.
+    for rule in rules["exclude"]:
+        compile_rule(rule)
+    for rule in rules["groups"]:
+        GroupRule.of(rule)
+    return rules
+
+
+def compile_rule(rule: dict) -> Callable[[EntityFacts], bool]:
+    """Turn a rule into a function that tells if it matches."""
+    for key in rule:
+        if key not in _CONDITIONS:
+            raise ValueError(f"Unknown rule '{key}', expected one of {', '.join(_CONDITIONS)}.")
+    conditions = [(_CONDITIONS[key], value) for (key, value) in rule.items()]
+    return lambda facts: all(condition(facts, value) for (condition, value) in conditions)
+
+
+def filter_entities(entities: dict, rules: dict | None = None) -> dict:
+    """Filter out some of the entities, in a single pass."""
+    exclude = [compile_rule(x) for x in DEFAULT_EXCLUDE + ((rules or {}).get("exclude") or [])]
+    kept = {}
+    for (key, entity) in entities.items():
+        facts = EntityFacts.of(entity)
+        if not any(rule(facts) for rule in exclude):
+            kept[key] = entity
+    return kept
+
+
+def ancestor_index(entities: dict[str, dict]) -> dict[str, frozenset[str]]:
+    """All (transitive) ancestors of every entity.
+
+    The parents do not have to be in `entities` themselves,
+    but only the ones that are can contribute their own ancestors.
+    """
+    index: dict[str, frozenset[str]] = {}
+
+    def ancestors(key: str) -> frozenset[str]:
+        if key not in index:
+            index[key] = frozenset()  # Guards against cycles.
+            result = set()
+            for parent in entities[key]["parent"]:
+                parent = sys.intern(parent)
+                result.add(parent)
+                if parent in entities:
+                    result.update(ancestors(parent))
+            index[key] = frozenset(result)
+        return index[key]
+
+    for key in entities:
+        ancestors(key)
+    return index
+
+
+def group_entities(entities: dict, rules: dict | None = None,
+                   ancestors: dict[str, frozenset[str]] | None = None
+                   ) -> list[tuple[str, dict[str, dict]]]:
+    """Split entities into groups.
+
+    `ancestors` should come from all entities, including the filtered out bases.
+    """
+    if ancestors is None:
+        ancestors = ancestor_index(entities)
+    table = group_rules(rules)
+    groups: dict[str, dict[str, dict]] = {x.name: {} for x in table}
+    groups[OTHER_GROUP] = {}
+
+    for (key, value) in entities.items():
+        groups[group_of(key, ancestors[key], table)][key] = value
+
+    # Keep "Other" last, even if a rules file mentions it.
+    return [x for x in groups.items() if x[0] != OTHER_GROUP] + [(OTHER_GROUP, groups[OTHER_GROUP])]
+
+
+def group_rules(rules: dict | None = None) -> list[GroupRule]:
+    """The default groups, followed by the ones from the rules."""
+    return [GroupRule.of(x) for x in DEFAULT_GROUPS + ((rules or {}).get("groups") or [])]
+
+
+def group_of(key: str, ancestors: frozenset[str], table: list[GroupRule]) -> str:
+    """Name of the group an entity belongs into."""
+    return next((x.name for x in table if x.matches(key, ancestors)), OTHER_GROUP)
+
+
+def select_entities(entities: dict[str, dict], ancestors: dict[str, frozenset[str]],
+                    selection: Selection, rules: dict | None = None) -> dict[str, dict]:
+    """The selected (unresolved) entities and their ancestors, the rest needs no resolving."""
+    table = group_rules(rules)
+    wanted = [key for key in entities if selection(f"entities/{key}") and (
+        not selection.groups or group_of(key, ancestors[key], table) in selection.groups)]
+    needed = set(wanted).union(*(ancestors[x] for x in wanted))
+    return {k: v for (k, v) in entities.items() if k in needed}
@@ -1,47 +1,63 @@
 """Everything for the "tile"-tiles."""
-import json
 from pathlib import Path
 
 import cv2
-import yaml
 
-from ..shared import CacheJSON, Image, create_tsx, remove_prefix
+from .. import profiling
+from ..images import IO_THREADS, ImageWriter, WriteStats, prefetch
+from ..shared import (BuildManifest, CacheJSON, FileHasher, Image, Options,
+                      create_tsx, hash_object, remove_prefix)
+from .prototypes import PrototypeIndex
 
 
-def create_tiles(root: Path, out: Path):
+def create_tiles(root: Path, out: Path, prototypes: PrototypeIndex,
+                 manifest: BuildManifest, options: Options) -> WriteStats:
     """Create the "tile"-tiles. As in the floor."""
     existing_out = out / ".data" / "tiles.json"
     existing = CacheJSON.from_json(existing_out)
 
-    tiles_out = out / ".images" / "tiles"
-    tiles_out.mkdir(parents=True, exist_ok=True)
+    images_out = out / ".images"
+    images_out.mkdir(exist_ok=True)
 
     resources_dir = root / "Resources"
-    yml_dir = resources_dir / "Prototypes/Tiles"
-    files = [x for x in yml_dir.glob("**/*.yml") if x.is_file()]
-
-    for file in files:
-        for tile in yaml.safe_load(file.read_text("UTF-8")):
-            if tile["type"] != "tile":
-                continue  # alias
-            if not "sprite" in tile:
-                continue  # space
-            if not "variants" in tile:
-                tile["variants"] = 1
-
-            sprite = resources_dir / remove_prefix(tile["sprite"], "/")
-            dest: Path = tiles_out / (tile["id"] + sprite.suffix)
-            img = cv2.imread(sprite, cv2.IMREAD_UNCHANGED)
-            height, width = img.shape[:2]
-            width //= tile["variants"]  # only take the first variant
-            cv2.imwrite(dest, img[0:height, 0:width])
-
-            # Update the sprite but not the index.
-            if tile["id"] in existing.ids:
-                continue
-            existing.ids.append(tile["id"])
-            existing.images.append(
-                Image(f"./.images/tiles/{dest.name}", str(width), str(height)))
-
-    existing_out.write_text(json.dumps(existing, default=vars), "UTF-8")
-    create_tsx(existing, "Tiles", out / "tiles.tsx")
+    hasher = options.caches.hasher if options.caches else FileHasher()
+    writer = ImageWriter(options.encoding, IO_THREADS)
+    stale = []
+    for tile in prototypes.of_type("tile"):
+        if not "sprite" in tile or not options.selected(f"tiles/{tile['id']}"):
+            continue  # space, or not wanted
+
+        sprite = resources_dir / remove_prefix(tile["sprite"], "/")
+        key = f"tiles/{tile['id']}"
+        inputs = {"prototype": hash_object(tile),
+                  sprite.relative_to(resources_dir).as_posix(): hasher(sprite),
+                  "encoding": writer.encoding}
+        if not options.force and manifest.is_current(key, inputs, existing, out):
+            profiling.count("tiles_skipped")
+            continue
+        profiling.count("tiles_rendered")
+        stale.append((tile, sprite, key, inputs))
+
+    # Decoded in reader threads, encoded and written in writer threads.
+    for ((tile, _, key, inputs), img) in prefetch(stale, lambda x: _read_tile(x[1])):
+        height, width = img.shape[:2]
+        width //= tile.get("variants", 1)  # only take the first variant
+        dest = writer.store_later(images_out, img[0:height, 0:width])
+        source = "./" + dest.relative_to(out).as_posix()
+        manifest.record(key, inputs, {tile["id"]: source})
+        existing.put(tile["id"], Image(source, str(width), str(height)))
+    writer.flush()
+
+    if options.only is not None and not stale:
+        return writer.stats  # Nothing changed.
+    existing.write_json(existing_out)
+    create_tsx(existing, "Tiles", out / "tiles.tsx", atlas=writer if options.atlas else None)
+    return writer.stats
+
+
+def _read_tile(sprite: Path):
+    """Decode the sprite of a tile."""
+    with profiling.span("decode"):
+        img = cv2.imread(sprite, cv2.IMREAD_UNCHANGED)
+    profiling.count("images_decoded")
+    return img
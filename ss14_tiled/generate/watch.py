@@ -0,0 +1,240 @@
+"""Watch the resources and regenerate only what a change affects, with everything kept warm.
+
+Uses watchdog (inotify and friends) if it is installed and polls the files otherwise.
+"""
+import os
+import threading
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import Iterator
+
+import yaml
+
+from .. import profiling
+from ..images import WriteStats
+from ..shared import BuildManifest, Caches, FileHasher, Options, Selection, eprint
+from . import build
+from .decals import DecalSet, get_colors
+from .prototypes import PrototypeIndex, find_files, load_cached, load_file
+from .rsi import RSICache
+
+try:
+    import watchdog.observers
+except ImportError:  # Optional, polling works everywhere.
+    watchdog = None  # pylint: disable=invalid-name
+
+# Editors tend to write a couple of files at once, wait for the rest of them.
+SETTLE_SECONDS = 0.1
+POLL_SECONDS = 0.5
+# Starting a process pool for a handful of entities takes longer than rendering them.
+SERIAL_BELOW = 32
+
+
+class Session:
+    """The parsed prototypes, file hashes, RSIs and manifest, kept between builds."""
+
+    def __init__(self, root: Path, out: Path, options: Options):
+        self.root = root.resolve()
+        self.out = out
+        out.mkdir(exist_ok=True)
+        self.resources_dir = self.root / "Resources"
+        self.options = replace(options, caches=Caches(FileHasher(),
+                                                      RSICache(self.resources_dir)))
+        self.manifest = BuildManifest.from_json(out / ".data" / "manifest.json")
+        files = find_files(self.root)
+        with profiling.span("parse_prototypes", files=len(files)):
+            self.documents = dict(zip(files, load_cached(
+                self.root, files, out / ".data" / "prototypes.pickle", options.jobs)))
+        self.prototypes = PrototypeIndex.from_documents(self.documents.values())
+
+    def build(self, affected: set[str] | None = None) -> WriteStats:
+        """Generate everything, or only the outputs with the `affected` manifest keys."""
+        options = self.options
+        if affected is not None:
+            only = replace(options.only or Selection(), keys=frozenset(affected))
+            options = replace(options, only=only,
+                              jobs=1 if len(affected) < SERIAL_BELOW else options.jobs)
+        return build(self.root, self.out, self.prototypes, self.manifest, options)
+
+    def update(self, changed: set[Path]) -> set[str]:
+        """Take in changed files, returns the manifest keys of everything they affect."""
+        prototypes_dir = self.resources_dir / "Prototypes"
+        textures_dir = self.resources_dir / "Textures"
+        affected = set()
+        changed_ids: dict[str, set[str]] = {}
+        for path in sorted(changed):
+            if prototypes_dir in path.parents and path.suffix == ".yml":
+                try:
+                    new = load_file(path) if path.is_file() else []
+                except (OSError, yaml.YAMLError) as e:
+                    eprint(f"Could not parse '{path}': {e}")
+                    continue
+                old = self.documents.pop(path, [])
+                if path.is_file():
+                    self.documents[path] = new
+                for (kind, ids) in _changed_prototypes(old, new).items():
+                    changed_ids.setdefault(kind, set()).update(ids)
+            elif textures_dir in path.parents:
+                self.options.caches.hasher.forget(path)
+                self.options.caches.rsis.forget(path)
+                name = path.relative_to(self.resources_dir).as_posix()
+                affected.update(key for (key, entry) in self.manifest.entries.items()
+                                if name in entry.inputs)
+
+        if changed_ids:
+            # Same order as a full parse, later prototypes win.
+            self.documents = dict(sorted(self.documents.items()))
+            self.prototypes = PrototypeIndex.from_documents(self.documents.values())
+            affected |= self._affected_by(changed_ids)
+        return affected
+
+    def _affected_by(self, changed_ids: dict[str, set[str]]) -> set[str]:
+        """Manifest keys of the changed prototypes and of every entity inheriting from them."""
+        children: dict[str, list[str]] = {}
+        for entity in self.prototypes.of_type("entity"):
+            parents = entity.get("parent", [])
+            for parent in [parents] if isinstance(parents, str) else parents:
+                children.setdefault(parent, []).append(entity["id"])
+        entities = set()
+        pending = list(changed_ids.get("entity", ()))
+        while pending:
+            entity_id = pending.pop()
+            if entity_id not in entities:
+                entities.add(entity_id)
+                pending.extend(children.get(entity_id, ()))
+        affected = {f"entities/{x}" for x in entities}
+
+        decals = changed_ids.get("decal", set())
+        if "palette" in changed_ids:
+            decals = {x["id"] for x in self.prototypes.of_type("decal")}
+        sets = [DecalSet(name, color) for (name, color) in
+                [("", "#FFF")] + get_colors(self.prototypes)]
+        affected.update(f"{x.dir_name}/{decal}" for decal in decals for x in sets)
+        affected.update(f"tiles/{x}" for x in changed_ids.get("tile", ()))
+        return affected
+
+
+def _changed_prototypes(old: list[dict], new: list[dict]) -> dict[str, set[str]]:
+    """Ids of the prototypes that were added, removed or changed, by type."""
+    def by_id(documents: list[dict]) -> dict[tuple[str, str], dict]:
+        return {(x["type"], str(x["id"])): x for x in documents
+                if isinstance(x, dict) and "type" in x and "id" in x}
+
+    # Compared as they are, reformatting or reordering a file changes nothing.
+    (before, after) = (by_id(old), by_id(new))
+    changed: dict[str, set[str]] = {}
+    for key in before.keys() | after.keys():
+        if before.get(key) != after.get(key):
+            changed.setdefault(key[0], set()).add(key[1])
+    return changed
+
+
+def watch(root: Path, options: Options):
+    """Generate everything once, then whatever the changes to the resources affect."""
+    with profiling.span("load_prototypes"):
+        session = Session(root, Path("dist"), options)
+    print(session.build())
+
+    directories = [session.resources_dir / "Prototypes", session.resources_dir / "Textures"]
+    how = "watchdog" if watchdog else "polling"
+    print(f"Watching '{session.resources_dir}' ({how}), press Ctrl+C to stop.")
+    try:
+        for changed in watch_files(directories):
+            start = time.perf_counter()
+            affected = session.update(changed)
+            if not affected:
+                continue
+            stats = session.build(affected)
+            print(f"{len(changed)} files changed, {len(affected)} outputs affected, "
+                  f"done in {time.perf_counter() - start:.2f}s: {stats}")
+    except KeyboardInterrupt:
+        pass
+
+
+def watch_files(directories: list[Path]) -> Iterator[set[Path]]:
+    """Changed files below the directories, a set per burst of changes."""
+    if watchdog is None:
+        yield from _poll(directories)
+        return
+
+    collector = _Collector()
+    observer = watchdog.observers.Observer()
+    for directory in directories:
+        observer.schedule(collector, str(directory), recursive=True)
+    observer.start()
+    try:
+        while True:
+            collector.changed.wait()
+            time.sleep(SETTLE_SECONDS)
+            collector.changed.clear()
+            paths = collector.take()
+            if paths:
+                yield paths
+    finally:
+        observer.stop()
+        observer.join()
+
+
+class _Collector:
+    """Event handler for watchdog, collecting the paths."""
+
+    def __init__(self):
+        self.changed = threading.Event()
+        self._paths: set[Path] = set()
+        self._lock = threading.Lock()
+
+    def dispatch(self, event):
+        """Called by watchdog for every event."""
+        if event.is_directory:
+            return
+        with self._lock:
+            self._paths.add(Path(os.fsdecode(event.src_path)))
+            if getattr(event, "dest_path", ""):
+                self._paths.add(Path(os.fsdecode(event.dest_path)))
+        self.changed.set()
+
+    def take(self) -> set[Path]:
+        """The paths collected so far."""
+        with self._lock:
+            (paths, self._paths) = (self._paths, set())
+        return paths
+
+
+def _poll(directories: list[Path]) -> Iterator[set[Path]]:
+    """Compare the modification times and sizes of all files every now and then."""
+    before = _snapshot(directories)
+    while True:
+        time.sleep(POLL_SECONDS)
+        changed = set()
+        while True:  # Until the files stop changing, so half written ones are not read.
+            after = _snapshot(directories)
+            new = {x for x in before.keys() | after.keys() if before.get(x) != after.get(x)}
+            before = after
+            if not new:
+                break
+            changed |= new
+            time.sleep(SETTLE_SECONDS)
+        if changed:
+            yield {Path(x) for x in changed}
+
+
+def _snapshot(directories: list[Path]) -> dict[str, tuple[int, int]]:
+    """Modification time and size of every file, scandir is a lot faster than Path.rglob."""
+    files = {}
+    pending = [str(x) for x in directories]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue  # Removed in the meantime.
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue
+    return files
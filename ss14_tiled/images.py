@@ -0,0 +1,210 @@
+"""Encoding and writing the images, without touching unchanged files."""
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+
+import cv2
+import numpy as np
+
+from . import profiling
+
+# Name -> (file suffix, OpenCV parameters).
+ENCODINGS: dict[str, tuple[str, list[int]]] = {
+    "default": (".png", []),
+    # For local iteration.
+    "fast": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    # For releases.
+    "max": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 9]),
+    # Lossless above 100 (except the color of invisible pixels),
+    # Tiled needs the Qt WebP plugin for these.
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 101]),
+}
+# Every suffix an image can have, to clean up after switching encodings.
+SUFFIXES = frozenset(x for (x, _) in ENCODINGS.values())
+# OpenCV and file I/O release the GIL, so threads keep the disk (or network share) busy
+# while the main thread composites. These many per stage, with at most QUEUE_DEPTH images
+# waiting in each, which bounds the memory.
+IO_THREADS = 4
+QUEUE_DEPTH = 32
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class WriteStats:
+    """How many images (and bytes) were written or skipped as they did not change.
+
+    Duplicates are images that were already stored earlier during the same build.
+    Entities whose layer stacks were all composited before count as from the composite cache.
+    """
+    written: int = 0
+    skipped: int = 0
+    bytes_written: int = 0
+    bytes_skipped: int = 0
+    deduplicated: int = 0
+    from_composite_cache: int = 0
+
+    def add(self, other: "WriteStats"):
+        """Add the counters of another writer, e.g. from a worker process."""
+        for x in fields(self):
+            setattr(self, x.name, getattr(self, x.name) + getattr(other, x.name))
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Images per file, e.g. 1.25 if every fourth file is used twice."""
+        files = self.written + self.skipped
+        return (files + self.deduplicated) / files if files else 1.0
+
+    def __str__(self) -> str:
+        text = (f"{self.written} images written ({_mib(self.bytes_written)}), "
+                f"{self.skipped} unchanged ({_mib(self.bytes_skipped)}), "
+                f"{self.deduplicated} duplicates (dedup ratio {self.dedup_ratio:.2f})")
+        if self.from_composite_cache:
+            text += f", {self.from_composite_cache} entities from the composite cache"
+        return text
+
+
+class ImageWriter:
+    """Writes images with an encoding profile, files with the same bytes are left alone.
+
+    With `threads`, `write_later` encodes and writes in the background,
+    it blocks while QUEUE_DEPTH images are still waiting.
+    `store_later` names the files by their content, so identical images share one.
+    """
+
+    def __init__(self, encoding: str = "default", threads: int = 0):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding '{encoding}', "
+                             f"expected one of {', '.join(ENCODINGS)}.")
+        self.encoding = encoding
+        self.stats = WriteStats()
+        self.threads = threads
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending: deque[Future] = deque()
+        self._lock = threading.Lock()
+        self._stored: set[Path] = set()
+
+    @property
+    def suffix(self) -> str:
+        """File suffix of the encoding, e.g. ".png"."""
+        return ENCODINGS[self.encoding][0]
+
+    def store_later(self, images_dir: Path, img: np.ndarray) -> Path:
+        """Store an image in `images_dir` under its content hash, returns the file.
+
+        Images this writer already stored, or that exist from an earlier build,
+        are neither encoded nor written again. Like `write_later` otherwise.
+        """
+        digest = hashlib.blake2b(f"{self.encoding}:{img.shape}:{img.dtype}".encode("UTF-8"),
+                                 digest_size=16)
+        digest.update(np.ascontiguousarray(img))
+        name = digest.hexdigest()
+        path = images_dir / name[:2] / (name + self.suffix)
+        with self._lock:
+            duplicate = path in self._stored
+            self._stored.add(path)
+            if duplicate:
+                self.stats.deduplicated += 1
+        if duplicate:
+            profiling.count("images_deduplicated")
+            return path
+
+        # Same name, same bytes, as the encoders are deterministic.
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            path.parent.mkdir(exist_ok=True)
+            self.write_later(path, img)
+            return path
+        with self._lock:
+            self.stats.skipped += 1
+            self.stats.bytes_skipped += size
+        profiling.count("bytes_skipped", size)
+        return path
+
+    def write_later(self, path: Path, img: np.ndarray):
+        """Like `write`, but in the background. The image must not change afterwards."""
+        if self.threads <= 0:
+            self.write(path, img)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="write")
+        while len(self._pending) >= QUEUE_DEPTH:
+            self._pending.popleft().result()  # Backpressure, and errors surface early.
+        self._pending.append(self._executor.submit(self.write, path, img))
+
+    def flush(self):
+        """Wait for everything written in the background, e.g. before reading it back."""
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+    def write(self, path: Path, img: np.ndarray) -> bool:
+        """Encode and write an image, returns whether the file changed."""
+        with profiling.span("encode"):
+            (success, encoded) = cv2.imencode(self.suffix, img, ENCODINGS[self.encoding][1])
+        if not success:
+            raise ValueError(f"Could not encode '{path}'.")
+        data = encoded.tobytes()
+        profiling.count("images_encoded")
+
+        # Only read the old file if it could be the same.
+        if path.exists() and path.stat().st_size == len(data) and path.read_bytes() == data:
+            with self._lock:
+                self.stats.skipped += 1
+                self.stats.bytes_skipped += len(data)
+            profiling.count("bytes_skipped", len(data))
+            return False
+
+        with profiling.span("write"):
+            # Renamed into place, stored images are trusted as long as they exist.
+            tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                tmp.write_bytes(data)
+                os.replace(tmp, path)
+            finally:
+                tmp.unlink(missing_ok=True)
+        with self._lock:
+            self.stats.written += 1
+            self.stats.bytes_written += len(data)
+        profiling.count("bytes_written", len(data))
+        return True
+
+
+def prefetch(items: Iterable[T], load: Callable[[T], R],
+             threads: int = IO_THREADS) -> Iterator[tuple[T, R]]:
+    """`load` the items ahead of time in threads, yields them (in order) with the results.
+
+    At most QUEUE_DEPTH results are waiting to be taken at any time.
+    """
+    if threads <= 0:
+        yield from ((x, load(x)) for x in items)
+        return
+    executor = ThreadPoolExecutor(threads, thread_name_prefix="read")
+    pending: deque[tuple[T, Future]] = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) >= QUEUE_DEPTH:
+                (done, future) = pending.popleft()
+                yield (done, future.result())
+        while pending:
+            (done, future) = pending.popleft()
+            yield (done, future.result())
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _mib(size: int) -> str:
+    """Human readable size."""
+    return f"{size / 1024 / 1024:.1f} MiB"
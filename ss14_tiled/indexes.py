@@ -0,0 +1,84 @@
+"""Checks and repairs of the tile set indexes ("dist/.data/*.json").
+
+Repairs never change the id of a tile, so maps made with older tile sets keep working.
+"""
+import json
+import os
+from pathlib import Path
+
+from .shared import TOMBSTONE, CacheJSON, Image
+
+
+def index_files(dist: Path) -> list[Path]:
+    """The indexes of all tile sets in `dist`."""
+    return sorted(x for x in (dist / ".data").glob("*.json")
+                  if x.name != "manifest.json" and not x.name.startswith("."))
+
+
+def check_indexes(dist: Path, fix: bool = False) -> list[str]:
+    """Everything that is wrong with the indexes in `dist`, repaired right away with `fix`.
+
+    - Ids and images of different lengths: cut to the shorter one.
+    - Images that do not exist: become tombstones.
+    - Tiles that are in there more than once with different images: all get the image of
+      the first one (or of the first with an image), so every id keeps showing the tile.
+    - Images that no index uses: deleted.
+    """
+    problems = []
+    used = set()
+    for path in index_files(dist):
+        data = json.loads(path.read_text("UTF-8"))
+        ids: list[str] = data["ids"]
+        images = [Image(x["source"], x["width"], x["height"]) for x in data["images"]]
+        problems_before = len(problems)
+        if len(ids) != len(images):
+            problems.append(f"{path.name}: {len(ids)} ids, but {len(images)} images")
+            (ids, images) = (ids[:len(images)], images[:len(ids)])
+
+        for (i, (tile_id, image)) in enumerate(zip(ids, images)):
+            if not image.tombstone and not (dist / image.source).is_file():
+                problems.append(f"{path.name}: image of tile {i + 1} ('{tile_id}') is missing")
+                images[i] = TOMBSTONE
+
+        # Tiles from older versions can be in there more than once, all show the same.
+        shown: dict[str, Image] = {}
+        for (tile_id, image) in zip(ids, images):
+            if tile_id and (tile_id not in shown or shown[tile_id].tombstone):
+                shown[tile_id] = image
+        for (i, tile_id) in enumerate(ids):
+            if tile_id and images[i] != shown[tile_id]:
+                problems.append(f"{path.name}: tile {i + 1} ('{tile_id}') is a duplicate "
+                                "with another image")
+                images[i] = shown[tile_id]
+
+        used.update((dist / x.source).resolve() for x in images if not x.tombstone)
+        if fix and len(problems) > problems_before:
+            CacheJSON(ids, images).write_json(path)
+
+    for image in sorted((dist / ".images").rglob("*")):
+        if image.is_file() and image.resolve() not in used:
+            problems.append(f"{image.relative_to(dist).as_posix()} is not used by any tile")
+            if fix:
+                image.unlink()
+    return problems
+
+
+def remove_unused_images(dist: Path) -> int:
+    """Delete the images that no index uses anymore, returns how many.
+
+    Images are shared between tiles (and tile sets), so an old image can only go
+    once nothing points at it. Empty directories go as well.
+    """
+    used = set()
+    for path in index_files(dist):
+        used.update(dist / x["source"] for x in json.loads(path.read_text("UTF-8"))["images"]
+                    if x["source"])
+    removed = 0
+    for (directory, _, files) in os.walk(dist / ".images", topdown=False):
+        for name in files:
+            if Path(directory, name) not in used:
+                Path(directory, name).unlink()
+                removed += 1
+        if directory != str(dist / ".images") and not os.listdir(directory):
+            os.rmdir(directory)
+    return removed
@@ -0,0 +1,3 @@
+"""Convert maps between Tiled and SS14, using the generated tile sets."""
+from .export import MapExport, export_map
+from .importer import MapImport, import_map
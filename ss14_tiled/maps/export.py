@@ -0,0 +1,284 @@
+"""Tiled map (".tmx") -> SS14 map (".yml").
+
+The map is streamed, only the tiles (as compact chunks), entities and decals are kept.
+Every tile layer is drawn onto a single grid, upper layers over lower ones.
+Entities and decals can be placed in tile layers as well as in object layers.
+
+Tiled has y pointing down and SS14 up, so pixel (x, y) is at (x / 32, -y / 32)
+and the tile in column c and row r is tile (c, -r - 1). Flipped tiles are not flipped.
+The offsets of groups and layers are added, tile layers snap to whole tiles.
+"""
+import base64
+import gzip
+import math
+import xml.etree.ElementTree as ET
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TextIO
+
+import numpy as np
+
+from .. import profiling
+from .tilesets import (CHUNK_DTYPES, CHUNK_SIZE, DIRECTION_ANGLES, SPACE, TileRef, Tileset,
+                       TilesetIndex, format_angle, format_number, normalize_angle)
+
+# Elements that can have an offset, which applies to everything inside them.
+OFFSET_TAGS = ("group", "layer", "objectgroup", "imagelayer")
+# Version of the map files and of the tile chunks that are written.
+MAP_FORMAT = 6
+CHUNK_VERSION = 6
+TILE_DTYPE = CHUNK_DTYPES[CHUNK_VERSION]
+
+
+@dataclass
+class MapExport:
+    """Everything that ends up in the SS14 map."""
+    tile_width: int = 32
+    tile_height: int = 32
+    tilemap: dict[str, int] = field(default_factory=lambda: {SPACE: 0})
+    # (x, y) of the chunk -> tile map indices, indexed by [y][x] inside the chunk.
+    chunks: dict[tuple[int, int], np.ndarray] = field(default_factory=dict)
+    # Prototype -> [(x, y, angle)], x and y of the center.
+    entities: dict[str, list[tuple[float, float, float]]] = field(default_factory=dict)
+    # (id, color, angle) -> [(x, y)], x and y of the bottom left corner.
+    decals: dict[tuple[str, str, float], list[tuple[float, float]]] = field(default_factory=dict)
+    unknown: int = 0
+
+    def place(self, ref: TileRef, x: float, y: float, size: tuple[float, float],
+              rotation: float = 0):
+        """Add an entity or decal, with the bottom left corner at pixel (x, y).
+
+        Like Tiled, the `rotation` is clockwise in degrees around that corner.
+        """
+        (width, height) = size
+        theta = math.radians(rotation)
+        (dx, dy) = (width / 2, -height / 2)
+        center_x = (x + dx * math.cos(theta) - dy * math.sin(theta)) / self.tile_width
+        center_y = -(y + dx * math.sin(theta) + dy * math.cos(theta)) / self.tile_height
+        if ref.kind == "entity":
+            angle = normalize_angle(DIRECTION_ANGLES.get(ref.direction, 0.0) - theta)
+            self.entities.setdefault(ref.id, []).append((center_x, center_y, angle))
+        elif ref.kind == "decal":
+            self.decals.setdefault((ref.id, ref.color, normalize_angle(-theta)), []).append(
+                (center_x - width / 2 / self.tile_width,
+                 center_y - height / 2 / self.tile_height))
+
+    def add_cells(self, gids: np.ndarray, index: TilesetIndex, column: int, row: int):
+        """Add a block of cells of a tile layer, the top left one being at `column` and `row`."""
+        (unique, inverse) = np.unique(gids, return_inverse=True)
+        inverse = inverse.reshape(gids.shape)
+        values = np.full(len(unique), -1, dtype=np.int32)
+        for (i, gid) in enumerate(unique):
+            ref = index.resolve(int(gid))
+            if ref is None:
+                self.unknown += int(np.count_nonzero(inverse == i)) if gid else 0
+            elif ref.kind == "tile":
+                values[i] = self.tilemap.setdefault(ref.id, len(self.tilemap))
+            else:
+                for (r, c) in zip(*np.nonzero(inverse == i)):
+                    self.place(ref, (column + int(c)) * self.tile_width,
+                               (row + int(r) + 1) * self.tile_height, (ref.width, ref.height))
+
+        cells = values[inverse]
+        (rows, columns) = np.nonzero(cells >= 0)
+        xs = columns + column
+        ys = -(rows + row) - 1
+        for (chunk_x, chunk_y) in set(zip(xs // CHUNK_SIZE, ys // CHUNK_SIZE)):
+            chunk = self.chunks.get((int(chunk_x), int(chunk_y)))
+            if chunk is None:
+                chunk = np.zeros((CHUNK_SIZE, CHUNK_SIZE), dtype=np.int32)
+                self.chunks[(int(chunk_x), int(chunk_y))] = chunk
+            mask = (xs // CHUNK_SIZE == chunk_x) & (ys // CHUNK_SIZE == chunk_y)
+            chunk[ys[mask] % CHUNK_SIZE, xs[mask] % CHUNK_SIZE] = cells[rows[mask], columns[mask]]
+
+
+def export_map(tmx: Path, output: Path) -> MapExport:
+    """Convert a Tiled map that uses the generated tile sets into an SS14 map."""
+    result = MapExport()
+    reader = _TmxReader(tmx, result)
+    # Open elements, to drop the handled ones from their parent.
+    stack: list[ET.Element] = []
+    with profiling.span("read_tmx"):
+        for (event, elem) in ET.iterparse(tmx, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                reader.start(elem)
+                continue
+            stack.pop()
+            if reader.end(elem):
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+
+    with profiling.span("write_map"), output.open("w", encoding="UTF-8", newline="\n") as file:
+        write_map(result, file)
+    return result
+
+
+class _TmxReader:
+    """Takes in the elements of a map as they are parsed."""
+
+    def __init__(self, tmx: Path, result: MapExport):
+        self.tmx = tmx
+        self.result = result
+        self.index = TilesetIndex()
+        self.layer: ET.Element | None = None
+        self.data: ET.Element | None = None
+        self.infinite = False
+        # Pixel offset of the open groups and layers, summed up.
+        self.offsets = [(0.0, 0.0)]
+
+    def start(self, elem: ET.Element):
+        """An element was opened, only its attributes are there yet."""
+        if elem.tag in OFFSET_TAGS:
+            (x, y) = self.offsets[-1]
+            self.offsets.append((x + float(elem.get("offsetx", 0)),
+                                 y + float(elem.get("offsety", 0))))
+        if elem.tag == "map":
+            if elem.get("orientation", "orthogonal") != "orthogonal":
+                raise ValueError("Only orthogonal maps can be exported.")
+            self.result.tile_width = int(elem.get("tilewidth"))
+            self.result.tile_height = int(elem.get("tileheight"))
+            self.infinite = elem.get("infinite") == "1"
+        elif elem.tag == "layer":
+            self.layer = elem
+        elif elem.tag == "data":
+            self.data = elem
+
+    def end(self, elem: ET.Element) -> bool:
+        """An element was closed, returns whether it was handled (and can be dropped)."""
+        (column, row) = self.cell_offset()
+        if elem.tag in OFFSET_TAGS:
+            self.offsets.pop()
+        if elem.tag == "tileset" and self.layer is None:
+            self.index.add(int(elem.get("firstgid")), _load_tileset(self.tmx, elem))
+        elif elem.tag == "chunk" and self.data is not None:
+            gids = _decode(elem, self.data, int(elem.get("width")), int(elem.get("height")))
+            self.result.add_cells(gids, self.index, column + int(elem.get("x")),
+                                  row + int(elem.get("y")))
+        elif elem.tag == "data":
+            if not self.infinite and self.layer is not None:
+                # Finite maps have all cells in one go.
+                gids = _decode(elem, elem, int(self.layer.get("width")),
+                               int(self.layer.get("height")))
+                self.result.add_cells(gids, self.index, column, row)
+            self.data = None
+        elif elem.tag == "layer":
+            self.layer = None
+        elif elem.tag == "object" and elem.get("gid"):
+            _add_object(self.result, self.index, elem, self.offsets[-1])
+        else:
+            return elem.tag in ("object", "objectgroup")
+        return True
+
+    def cell_offset(self) -> tuple[int, int]:
+        """The offset of the open layer, in whole tiles."""
+        (x, y) = self.offsets[-1]
+        return (round(x / self.result.tile_width), round(y / self.result.tile_height))
+
+
+def _load_tileset(tmx: Path, elem: ET.Element) -> Tileset:
+    """Load the index of an external tile set."""
+    source = elem.get("source")
+    if source is None:
+        raise ValueError("Embedded tile sets are not supported, only the generated ones.")
+    return Tileset.from_tsx(tmx.parent / source, source)
+
+
+def _decode(elem: ET.Element, data: ET.Element, width: int, height: int) -> np.ndarray:
+    """The gids of a <chunk> or <data>, shaped (height, width)."""
+    encoding = data.get("encoding")
+    if encoding is None:
+        gids = np.array([int(x.get("gid", 0)) for x in elem.iter("tile")], dtype=np.uint32)
+    elif encoding == "csv":
+        gids = np.fromstring(elem.text or "", dtype=np.uint32, sep=",")
+    elif encoding == "base64":
+        raw = base64.b64decode((elem.text or "").strip())
+        compression = data.get("compression")
+        if compression == "zlib":
+            raw = zlib.decompress(raw)
+        elif compression == "gzip":
+            raw = gzip.decompress(raw)
+        elif compression:
+            raise ValueError(f"Unsupported compression '{compression}', use zlib or gzip.")
+        gids = np.frombuffer(raw, dtype="<u4")
+    else:
+        raise ValueError(f"Unsupported encoding '{encoding}'.")
+    return gids.reshape((height, width))
+
+
+def _add_object(result: MapExport, index: TilesetIndex, elem: ET.Element,
+                offset: tuple[float, float]):
+    """Add a tile object, moved by the pixel `offset` of its layer."""
+    ref = index.resolve(int(elem.get("gid")))
+    if ref is None or ref.kind == "tile":
+        result.unknown += 1
+        return
+    size = (float(elem.get("width", ref.width)), float(elem.get("height", ref.height)))
+    (x, y) = (offset[0] + float(elem.get("x", 0)), offset[1] + float(elem.get("y", 0)))
+    result.place(ref, x, y, size, float(elem.get("rotation", 0)))
+
+
+def write_map(result: MapExport, file: TextIO):
+    """Write the SS14 map YAML, one grid on one map and everything on that grid."""
+    file.write(f"meta:\n  format: {MAP_FORMAT}\n  postmapinit: false\ntilemap:\n")
+    for (name, i) in result.tilemap.items():
+        file.write(f"  {i}: {name}\n")
+
+    file.write("entities:\n- proto: \"\"\n  entities:\n"
+               "  - uid: 1\n    components:\n"
+               "    - type: MetaData\n      name: Map Entity\n"
+               "    - type: Transform\n"
+               "    - type: Map\n      mapPaused: True\n"
+               "    - type: PhysicsMap\n"
+               "    - type: GridTree\n"
+               "    - type: MovedGrids\n"
+               "    - type: Broadphase\n"
+               "    - type: OccluderTree\n"
+               "  - uid: 2\n    components:\n"
+               "    - type: MetaData\n      name: grid\n"
+               "    - type: Transform\n      pos: 0,0\n      parent: 1\n"
+               "    - type: MapGrid\n      chunks:\n")
+    for ((x, y), chunk) in sorted(result.chunks.items()):
+        tiles = np.zeros(CHUNK_SIZE * CHUNK_SIZE, dtype=TILE_DTYPE)
+        tiles["id"] = chunk.ravel()
+        encoded = base64.b64encode(tiles.tobytes()).decode("ascii")
+        file.write(f"        {x},{y}:\n          ind: {x},{y}\n"
+                   f"          tiles: {encoded}\n          version: {CHUNK_VERSION}\n")
+    if not result.chunks:
+        file.write("        {}\n")
+    file.write("    - type: Broadphase\n"
+               "    - type: Physics\n      bodyStatus: InAir\n      fixedRotation: False\n"
+               "      bodyType: Dynamic\n"
+               "    - type: Fixtures\n      fixtures: {}\n"
+               "    - type: OccluderTree\n")
+    _write_decals(result, file)
+
+    uid = 3
+    for (prototype, placed) in sorted(result.entities.items()):
+        file.write(f"- proto: {prototype}\n  entities:\n")
+        for (x, y, angle) in placed:
+            file.write(f"  - uid: {uid}\n    components:\n    - type: Transform\n")
+            if angle:
+                file.write(f"      rot: {format_angle(angle)}\n")
+            file.write(f"      pos: {format_number(x)},{format_number(y)}\n      parent: 2\n")
+            uid += 1
+
+
+def _write_decals(result: MapExport, file: TextIO):
+    """The DecalGrid of the grid, one node per id, color and angle."""
+    file.write("    - type: DecalGrid\n      chunkCollection:\n        version: 2\n        nodes:")
+    if not result.decals:
+        file.write(" []\n")
+        return
+    file.write("\n")
+    uid = 0
+    for ((decal, color, angle), placed) in sorted(result.decals.items()):
+        file.write("        - node:\n")
+        if angle:
+            file.write(f"            angle: {format_angle(angle)}\n")
+        file.write(f"            color: '{color}'\n            id: {decal}\n          decals:\n")
+        for (x, y) in placed:
+            file.write(f"            {uid}: {format_number(x)},{format_number(y)}\n")
+            uid += 1
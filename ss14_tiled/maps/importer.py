@@ -0,0 +1,418 @@
+"""SS14 map (".yml") -> Tiled map (".tmx").
+
+Every grid becomes a group with its tiles, decals and entities, moved to where the grid is.
+The tile chunks are decoded in batches while the map is read and kept in temporary files,
+then written as chunks of an infinite map. Only a batch of them is in memory at any time.
+"""
+import base64
+import math
+import os
+import tempfile
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Generator, Iterator, TextIO
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+import yaml
+
+from .. import profiling
+from ..generate.prototypes import SafeLoadIgnoreUnknown
+from .tilesets import (CHUNK_SIZE, DIRECTION_ANGLES, SPACE, GidLookup, TileRef, Tileset,
+                       chunk_dtype, find_tilesets, format_number, normalize_angle,
+                       normalize_color, parse_angle, parse_pair)
+
+# How many chunks are decoded at once.
+BATCH_SIZE = 256
+TILE_SIZE = 32
+# A decoded chunk in the temporary files, its tile ids are not looked up yet.
+_CHUNK = np.dtype([("x", "<i8"), ("y", "<i8"), ("ids", "<i8", (CHUNK_SIZE, CHUNK_SIZE))])
+
+
+@dataclass
+class MapImport:
+    """What was imported, and what was not."""
+    chunks: int = 0
+    entities: int = 0
+    decals: int = 0
+    # Tiles, entities and decals without a tile in the generated tile sets.
+    unknown: int = 0
+    # Entities inside of others, e.g. in lockers.
+    contained: int = 0
+    # Grids whose rotation got lost.
+    rotated: int = 0
+
+
+class _ChunkSpool:
+    """The chunks of a grid, decoded in batches (of the same version) into a temporary file."""
+
+    def __init__(self):
+        self._file: BinaryIO | None = None
+        self._pending: dict[int, list[dict]] = {}
+
+    def add(self, chunk: dict):
+        """Take in a chunk as it is in the map."""
+        version = int(chunk.get("version", 0))
+        batch = self._pending.setdefault(version, [])
+        batch.append(chunk)
+        if len(batch) >= BATCH_SIZE:
+            self._decode(version, self._pending.pop(version))
+
+    def _decode(self, version: int, batch: list[dict]):
+        """Decode the tile ids of a batch and append them to the file."""
+        with profiling.span("decode_chunks", chunks=len(batch)):
+            records = np.empty(len(batch), _CHUNK)
+            raw = b"".join(base64.b64decode(x["tiles"]) for x in batch)
+            records["ids"] = np.frombuffer(raw, chunk_dtype(version))["id"].reshape(
+                (-1, CHUNK_SIZE, CHUNK_SIZE))
+            positions = [parse_pair(x["ind"]) for x in batch]
+            records["x"] = [int(x) for (x, _) in positions]
+            records["y"] = [int(y) for (_, y) in positions]
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        self._file.write(records.tobytes())
+
+    def batches(self) -> Iterator[np.ndarray]:
+        """All the chunks, a batch at a time. Closes the file afterwards."""
+        for (version, batch) in self._pending.items():
+            self._decode(version, batch)
+        self._pending.clear()
+        if self._file is None:
+            return
+        try:
+            self._file.seek(0)
+            while data := self._file.read(BATCH_SIZE * _CHUNK.itemsize):
+                yield np.frombuffer(data, _CHUNK)
+        finally:
+            self._file.close()
+            self._file = None
+
+
+@dataclass
+class _Grid:
+    """A grid and everything on it, entities as (prototype, position, rotation)."""
+    uid: str
+    name: str
+    components: dict[str, dict]
+    entities: list[tuple[str, str, str | None]]
+    chunks: _ChunkSpool = field(default_factory=_ChunkSpool)
+
+
+def import_map(yml: Path, output: Path, dist: Path) -> MapImport:
+    """Convert an SS14 map into a Tiled map that uses the generated tile sets in `dist`."""
+    tilesets = [Tileset.from_tsx(x, Path(os.path.relpath(x, output.parent)).as_posix())
+                for x in find_tilesets(dist)]
+    lookup = GidLookup.from_tilesets(tilesets)
+    result = MapImport()
+
+    with profiling.span("read_map"):
+        (tilemap, grids, on_map, result.contained) = _read_grids(yml)
+
+    objects = sum(len(x.entities) for x in grids.values()) + len(on_map.entities) + sum(
+        len(node.get("decals") or {}) for grid in grids.values() for node in _decal_nodes(grid))
+    with output.open("w", encoding="UTF-8", newline="\n") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<map version="1.10" orientation="orthogonal" renderorder="right-down" '
+                   f'width="{CHUNK_SIZE}" height="{CHUNK_SIZE}" tilewidth="{TILE_SIZE}" '
+                   f'tileheight="{TILE_SIZE}" infinite="1" '
+                   f'nextlayerid="{4 * len(grids) + 2}" nextobjectid="{objects + 1}">\n')
+        for (firstgid, tileset) in zip(lookup.firstgids, tilesets):
+            file.write(f' <tileset firstgid="{firstgid}" source={quoteattr(tileset.source)}/>\n')
+
+        writer = _Writer(file, lookup, result)
+        for grid in grids.values():
+            writer.grid(grid, tilemap)
+        if on_map.entities:
+            writer.layer_id += 1
+            file.write(f' <objectgroup id="{writer.layer_id}" name="Map">\n')
+            writer.entities(on_map.entities)
+            file.write(' </objectgroup>\n')
+        file.write('</map>\n')
+    return result
+
+
+def _read_grids(yml: Path) -> tuple[dict[int, str], dict[str, _Grid], _Grid, int]:
+    """The tile map, the grids, the entities directly on the map and how many are contained.
+
+    Entities are placed on the grid (or map) they are parented to.
+    """
+    tilemap: dict[int, str] = {}
+    grids: dict[str, _Grid] = {}
+    spools: dict[str, _ChunkSpool] = {}
+    maps: list[str] = []
+    parents: dict[str, list[tuple[str, str, str | None]]] = {}
+    with yml.open("rb") as file:
+        for (key, value) in _read_map(file):
+            if key == "chunk":
+                (entity, chunk) = value
+                spools.setdefault(entity, _ChunkSpool()).add(chunk)
+            elif key == "tilemap":
+                tilemap = {int(k): v for (k, v) in value.items()}
+            elif key == "entities":
+                (prototype, entity, components) = value
+                if "MapGrid" in components:
+                    name = (components.get("MetaData") or {}).get("name") or f"Grid {entity}"
+                    grid = _Grid(entity, name, components, [], spools.pop(entity, _ChunkSpool()))
+                    # Only there if they could not be streamed, e.g. if they came before "type".
+                    chunks = components["MapGrid"].pop("chunks", None) or {}
+                    for chunk in chunks.values() if isinstance(chunks, dict) else chunks:
+                        grid.chunks.add(chunk)
+                    grids[entity] = grid
+                elif "Map" in components:
+                    maps.append(entity)
+                elif prototype:
+                    transform = components.get("Transform") or {}
+                    parents.setdefault(transform.get("parent"), []).append(
+                        (prototype, transform.get("pos", "0,0"), transform.get("rot")))
+    for grid in grids.values():
+        grid.entities = parents.pop(grid.uid, [])
+    on_map = _Grid("", "Map", {}, [x for uid in maps for x in parents.pop(uid, [])])
+    return (tilemap, grids, on_map, sum(len(x) for x in parents.values()))
+
+
+def _read_map(file: BinaryIO) -> Iterator[tuple[str, object]]:
+    """The top level keys of a map and their values, entities one by one.
+
+    Entities come as (prototype, uid, {type: component}), the chunks of grids on their own
+    as (uid, chunk) and before their grid. Only the events of the parser are used and
+    everything stays a string, which is a lot faster than loading the whole map.
+    """
+    events = iter(yaml.parse(file, Loader=SafeLoadIgnoreUnknown))
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+    for key in events:
+        if not isinstance(key, yaml.ScalarEvent):
+            break
+        value = next(events, None)
+        if key.value != "entities" or not isinstance(value, yaml.SequenceStartEvent):
+            yield (key.value, _compose(events, value))
+            continue
+        for event in events:
+            if isinstance(event, yaml.SequenceEndEvent):
+                break
+            yield from _read_group(events, event)
+
+
+def _read_group(events: Iterator[yaml.Event],
+                start: yaml.Event) -> Iterator[tuple[str, object]]:
+    """The entities of one prototype, see `_read_map`."""
+    if not isinstance(start, yaml.MappingStartEvent):
+        _compose(events, start)
+        return
+    (prototype, entities) = ("", [])
+    for key in events:
+        if isinstance(key, yaml.MappingEndEvent):
+            break
+        value = next(events, None)
+        if key.value == "entities" and isinstance(value, yaml.SequenceStartEvent):
+            for item in events:
+                if isinstance(item, yaml.SequenceEndEvent):
+                    break
+                entities.append((yield from _read_entity(events, item)))
+        elif key.value == "proto":
+            prototype = _compose(events, value) or ""
+        else:
+            _compose(events, value)
+    for (uid, components) in entities:
+        yield ("entities", (prototype, uid, components))
+
+
+def _read_entity(events: Iterator[yaml.Event], start: yaml.Event
+                 ) -> Generator[tuple[str, object], None, tuple[str | None, dict]]:
+    """An entity as (uid, {type: component}), yields the chunks of its grid on the way."""
+    if not isinstance(start, yaml.MappingStartEvent):
+        _compose(events, start)
+        return (None, {})
+    (uid, components) = (None, {})
+    for key in events:
+        if isinstance(key, yaml.MappingEndEvent):
+            break
+        value = next(events, None)
+        if key.value == "components" and isinstance(value, yaml.SequenceStartEvent):
+            for item in events:
+                if isinstance(item, yaml.SequenceEndEvent):
+                    break
+                component = yield from _read_component(events, item, uid)
+                if isinstance(component, dict):
+                    components[component.get("type")] = component
+        elif key.value == "uid":
+            uid = _compose(events, value)
+        else:
+            _compose(events, value)
+    return (uid, components)
+
+
+def _read_component(events: Iterator[yaml.Event], start: yaml.Event, uid: str | None
+                    ) -> Generator[tuple[str, object], None, object]:
+    """A component, the chunks of a grid are yielded instead of kept.
+
+    That needs the uid and the type of the component to come first, like SS14 writes them.
+    """
+    if uid is None or not isinstance(start, yaml.MappingStartEvent):
+        return _compose(events, start)
+    component = {}
+    for key in events:
+        if isinstance(key, yaml.MappingEndEvent):
+            break
+        value = next(events, None)
+        if key.value == "chunks" and component.get("type") == "MapGrid":
+            for chunk in _items(events, value):
+                yield ("chunk", (uid, chunk))
+        else:
+            component[key.value] = _compose(events, value)
+    return component
+
+
+def _items(events: Iterator[yaml.Event], start: yaml.Event) -> Iterator[object]:
+    """The values of a mapping or the items of a sequence, one at a time."""
+    if isinstance(start, yaml.MappingStartEvent):
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                break
+            yield _compose(events, next(events, None))
+    elif isinstance(start, yaml.SequenceStartEvent):
+        for item in events:
+            if isinstance(item, yaml.SequenceEndEvent):
+                break
+            yield _compose(events, item)
+    else:
+        _compose(events, start)
+
+
+def _compose(events: Iterator[yaml.Event], event: yaml.Event) -> object:
+    """Build a node from the parser events, starting at `event`."""
+    if isinstance(event, yaml.ScalarEvent):
+        return event.value
+    if isinstance(event, yaml.MappingStartEvent):
+        mapping = {}
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                break
+            mapping[key.value] = _compose(events, next(events))
+        return mapping
+    if isinstance(event, yaml.SequenceStartEvent):
+        sequence = []
+        for item in events:
+            if isinstance(item, yaml.SequenceEndEvent):
+                break
+            sequence.append(_compose(events, item))
+        return sequence
+    return None  # Aliases, SS14 does not write them.
+
+
+def _decal_nodes(grid: _Grid) -> list[dict]:
+    """The decal nodes of a grid, grouped by id, color and angle."""
+    collection = (grid.components.get("DecalGrid") or {}).get("chunkCollection") or {}
+    return collection.get("nodes") or []
+
+
+class _Writer:
+    """Writes the layers of the grids, keeping track of the ids."""
+
+    def __init__(self, file: TextIO, lookup: GidLookup, result: MapImport):
+        self.file = file
+        self.lookup = lookup
+        self.result = result
+        self.layer_id = 0
+        self.object_id = 0
+
+    def grid(self, grid: _Grid, tilemap: dict[int, str]):
+        """A group with a tile layer and object layers for the decals and entities."""
+        (x, y) = parse_pair((grid.components.get("Transform") or {}).get("pos", "0,0"))
+        if parse_angle((grid.components.get("Transform") or {}).get("rot")):
+            self.result.rotated += 1
+        self.layer_id += 1
+        self.file.write(f' <group id="{self.layer_id}" name={quoteattr(grid.name)} '
+                        f'offsetx="{format_number(x * TILE_SIZE)}" '
+                        f'offsety="{format_number(-y * TILE_SIZE)}">\n')
+
+        self.layer_id += 1
+        self.file.write(f'  <layer id="{self.layer_id}" name="Tiles" '
+                        f'width="{CHUNK_SIZE}" height="{CHUNK_SIZE}">\n'
+                        '   <data encoding="base64" compression="zlib">\n')
+        with profiling.span("write_chunks"):
+            self.chunks(grid.chunks, tilemap)
+        self.file.write('   </data>\n  </layer>\n')
+
+        self.layer_id += 1
+        self.file.write(f'  <objectgroup id="{self.layer_id}" name="Decals">\n')
+        for node in _decal_nodes(grid):
+            self.decals(node)
+        self.file.write('  </objectgroup>\n')
+
+        self.layer_id += 1
+        self.file.write(f'  <objectgroup id="{self.layer_id}" name="Entities">\n')
+        self.entities(grid.entities)
+        self.file.write('  </objectgroup>\n </group>\n')
+
+    def chunks(self, chunks: _ChunkSpool, tilemap: dict[int, str]):
+        """Look up the tiles of the decoded chunks, a batch at a time, and write them."""
+        size = max(tilemap, default=0) + 1
+        lut = np.zeros(size, dtype="<u4")
+        unknown = np.zeros(size, dtype=bool)
+        for (index, name) in tilemap.items():
+            lut[index] = self.lookup.tiles.get(name, 0)
+            unknown[index] = name != SPACE and not lut[index]
+
+        for batch in chunks.batches():
+            ids = batch["ids"].copy()
+            ids[(ids < 0) | (ids >= size)] = 0
+            # SS14 has y pointing up, Tiled down.
+            gids = lut[ids][:, ::-1]
+            self.result.unknown += int(np.count_nonzero(unknown[ids]))
+            self.result.chunks += len(batch)
+            for (x, y, tiles) in zip(batch["x"], batch["y"], gids):
+                encoded = base64.b64encode(zlib.compress(tiles.tobytes())).decode("ascii")
+                self.file.write(f'    <chunk x="{x * CHUNK_SIZE}" '
+                                f'y="{-(y + 1) * CHUNK_SIZE}" width="{CHUNK_SIZE}" '
+                                f'height="{CHUNK_SIZE}">{encoded}</chunk>\n')
+
+    def decals(self, node: dict):
+        """All decals of a node, at their bottom left corner."""
+        info = node.get("node") or {}
+        found = self.lookup.decals.get((str(info.get("id")),
+                                        normalize_color(info.get("color", "#FFFFFFFF"))))
+        decals = node.get("decals") or {}
+        if found is None:
+            self.result.unknown += len(decals)
+            return
+        (gid, ref) = found
+        angle = parse_angle(info.get("angle"))
+        for position in decals.values():
+            (x, y) = parse_pair(position)
+            self.tile_object(gid, ref, ((x + ref.width / TILE_SIZE / 2) * TILE_SIZE,
+                                        -(y + ref.height / TILE_SIZE / 2) * TILE_SIZE), -angle)
+            self.result.decals += 1
+
+    def entities(self, entities: list[tuple[str, str, str | None]]):
+        """Entities at their center, with the sprite of the nearest direction."""
+        for (prototype, position, rotation) in entities:
+            options = self.lookup.entities.get(prototype)
+            if not options:
+                self.result.unknown += 1
+                continue
+            angle = parse_angle(rotation)
+            (gid, ref) = min(options, key=lambda x, angle=angle: abs(normalize_angle(
+                DIRECTION_ANGLES.get(x[1].direction, 0.0) - angle)))
+            (x, y) = parse_pair(position)
+            self.tile_object(gid, ref, (x * TILE_SIZE, -y * TILE_SIZE),
+                             DIRECTION_ANGLES.get(ref.direction, 0.0) - angle)
+            self.result.entities += 1
+
+    def tile_object(self, gid: int, ref: TileRef, center: tuple[float, float], rotation: float):
+        """A tile object, centered on the pixel `center`.
+
+        Like in Tiled, the `rotation` is clockwise around the bottom left corner (but in radians).
+        """
+        rotation = normalize_angle(rotation)
+        (dx, dy) = (ref.width / 2, -ref.height / 2)
+        x = center[0] - (dx * math.cos(rotation) - dy * math.sin(rotation))
+        y = center[1] - (dx * math.sin(rotation) + dy * math.cos(rotation))
+        self.object_id += 1
+        self.file.write(f'   <object id="{self.object_id}" gid="{gid}" x="{format_number(x)}" '
+                        f'y="{format_number(y)}" width="{ref.width}" height="{ref.height}"')
+        if rotation:
+            self.file.write(f' rotation="{format_number(math.degrees(rotation))}"')
+        self.file.write('/>\n')
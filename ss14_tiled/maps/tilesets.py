@@ -0,0 +1,181 @@
+"""What the tiles of the generated tile sets stand for, and where things go on a map."""
+import math
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from ..generate.decals import parse_hex
+from ..generate.entities import DIRECTIONS
+from ..shared import CacheJSON
+
+# Tiled keeps the flipping in the upper bits of a gid.
+GID_MASK = 0x0FFFFFFF
+# SS14 grids are split into chunks of 16x16 tiles.
+CHUNK_SIZE = 16
+# The tile outside of all grids, always index 0 of the tile map.
+SPACE = "Space"
+# Layout of a single tile in the chunks of a grid, by version of the chunk.
+CHUNK_DTYPES = {
+    5: np.dtype([("id", "<u2"), ("flags", "u1"), ("variant", "u1")]),
+    6: np.dtype([("id", "<i4"), ("flags", "u1"), ("variant", "u1")]),
+    7: np.dtype([("id", "<i4"), ("flags", "u1"), ("variant", "u1"), ("rotation", "u1")]),
+}
+
+# Angle of each sprite direction in radians, counter-clockwise (south is 0 in SS14).
+DIRECTION_ANGLES = {"S": 0.0, "SE": math.pi / 4, "E": math.pi / 2, "NE": 3 * math.pi / 4,
+                    "N": math.pi, "NW": -3 * math.pi / 4, "W": -math.pi / 2, "SW": -math.pi / 4}
+assert set(DIRECTION_ANGLES) == set(DIRECTIONS)
+
+
+@dataclass(frozen=True)
+class TileRef:
+    """What a single tile of a tile set stands for."""
+    kind: str  # "tile", "decal" or "entity"
+    id: str  # prototype id
+    direction: str = "S"  # entities only
+    color: str = "#FFFFFFFF"  # decals only
+    width: int = 32
+    height: int = 32
+
+
+@dataclass
+class Tileset:
+    """A generated tile set, as referenced from a map."""
+    source: str
+    tiles: list[TileRef | None]  # tile id i+1 is tiles[i], None if it was removed
+
+    @staticmethod
+    def from_tsx(path: Path, source: str | None = None) -> "Tileset":
+        """Load the index of a tile set generated by this project ("<dir>/.data/<name>.json")."""
+        cache = CacheJSON.from_json(path.parent / ".data" / (path.stem + ".json"))
+        color = "#FFFFFFFF"
+        if path.stem == "tiles":
+            kind = "tile"
+        elif path.stem.startswith("decals"):
+            kind = "decal"
+            value = ET.parse(path).find("./properties/property[@name='color_value']")
+            if value is not None:
+                color = normalize_color(value.get("value"))
+        elif path.stem.startswith("entities_"):
+            kind = "entity"
+        else:
+            raise ValueError(f"'{path}' is not a tile set made by ss14_tiled.")
+
+        tiles = []
+        for (tile_id, image) in zip(cache.ids, cache.images):
+            if image.tombstone:
+                tiles.append(None)
+                continue
+            (prototype, direction) = (tile_id, "S")
+            if kind == "entity":
+                (prototype, direction) = tile_id.rsplit("_", 1)
+            tiles.append(TileRef(kind, prototype, direction, color,
+                                 int(image.width), int(image.height)))
+        return Tileset(source or path.name, tiles)
+
+
+class TilesetIndex:
+    """Resolves gids of a map, built from its <tileset>-elements."""
+
+    def __init__(self):
+        self.firstgids: list[int] = []
+        self.tilesets: list[Tileset] = []
+
+    def add(self, firstgid: int, tileset: Tileset):
+        """Register a tile set, in the order of the map."""
+        self.firstgids.append(firstgid)
+        self.tilesets.append(tileset)
+
+    def resolve(self, gid: int) -> TileRef | None:
+        """What a gid stands for, None for empty cells and unknown tiles."""
+        gid &= GID_MASK
+        if not gid:
+            return None
+        for i in range(len(self.firstgids) - 1, -1, -1):
+            if gid >= self.firstgids[i]:
+                tiles = self.tilesets[i].tiles
+                index = gid - self.firstgids[i] - 1
+                return tiles[index] if 0 <= index < len(tiles) else None
+        return None
+
+
+@dataclass
+class GidLookup:
+    """Gids of everything in the generated tile sets, the other way round of `TilesetIndex`."""
+    firstgids: list[int] = field(default_factory=list)
+    tiles: dict[str, int] = field(default_factory=dict)
+    decals: dict[tuple[str, str], tuple[int, TileRef]] = field(default_factory=dict)
+    entities: dict[str, list[tuple[int, TileRef]]] = field(default_factory=dict)
+
+    @staticmethod
+    def from_tilesets(tilesets: list[Tileset]) -> "GidLookup":
+        """Number the tile sets one after the other, like they are added to a map."""
+        lookup = GidLookup()
+        firstgid = 1
+        for tileset in tilesets:
+            lookup.firstgids.append(firstgid)
+            for (i, ref) in enumerate(tileset.tiles):
+                gid = firstgid + i + 1
+                if ref is None:
+                    continue
+                if ref.kind == "tile":
+                    lookup.tiles.setdefault(ref.id, gid)
+                elif ref.kind == "decal":
+                    lookup.decals.setdefault((ref.id, ref.color), (gid, ref))
+                else:
+                    lookup.entities.setdefault(ref.id, []).append((gid, ref))
+            # The tile ids start at 1.
+            firstgid += len(tileset.tiles) + 1
+        return lookup
+
+
+def chunk_dtype(version: int) -> np.dtype:
+    """Layout of the tiles in a chunk, versions before 6 had 16 bit ids."""
+    return CHUNK_DTYPES[min(max(version, 5), 7)]
+
+
+def find_tilesets(dist: Path) -> list[Path]:
+    """The generated tile sets in a directory: tiles, then decals, then entities."""
+    order = {"tiles": 0, "decals": 1, "entities": 2}
+    paths = [x for x in dist.glob("*.tsx") if (x.parent / ".data" / f"{x.stem}.json").exists()]
+    return sorted(paths, key=lambda x: (order.get(x.stem.split("_")[0], 3), x.stem))
+
+
+def normalize_color(value: str) -> str:
+    """Any SS14 hex color as "#RRGGBBAA"."""
+    return "#" + "".join(f"{x:02X}" for x in parse_hex(value))
+
+
+def format_number(value: float) -> str:
+    """Like SS14 writes coordinates: "1.5", "-2" and so on."""
+    text = repr(round(value, 6) + 0.0)
+    return text[:-2] if text.endswith(".0") else text
+
+
+def format_angle(radians: float) -> str:
+    """Angles are saved with their unit."""
+    return f"{radians!r} rad"
+
+
+def normalize_angle(angle: float) -> float:
+    """Keep angles in (-pi, pi], without rounding errors around 0."""
+    angle = math.remainder(angle, 2 * math.pi)
+    if abs(angle) < 1e-9:
+        return 0.0
+    return math.pi if math.isclose(angle, -math.pi) else angle
+
+
+def parse_angle(value: str | float | None) -> float:
+    """An angle in radians, from "1.5 rad", "90 deg" or just a number."""
+    if value is None:
+        return 0.0
+    (number, *unit) = str(value).split()
+    return math.radians(float(number)) if unit == ["deg"] else float(number)
+
+
+def parse_pair(value: str) -> tuple[float, float]:
+    """Coordinates like "1.5,-2"."""
+    (x, y) = str(value).split(",")
+    return (float(x), float(y))
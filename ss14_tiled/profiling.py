@@ -0,0 +1,133 @@
+"""Optional timing spans and counters, dumped as a summary and a Chrome trace.
+
+Everything is a no-op until `enable` is called, so the spans can stay in hot code.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+
+class Profiler:
+    """Collects the spans (as trace events) and counters of a single process."""
+
+    def __init__(self):
+        self.events: list[dict] = []
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, args: dict):
+        """Time the body of the with-statement."""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            # perf_counter is system-wide, so the workers line up in the trace.
+            event = {"name": name, "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+                     "pid": os.getpid(), "tid": threading.get_native_id()}
+            if args:
+                event["args"] = args
+            self.events.append(event)
+
+    def count(self, name: str, value: int):
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] += value
+
+
+_PROFILER: Profiler | None = None
+_NO_SPAN = nullcontext()
+
+
+def enable():
+    """Start collecting, e.g. in the main process and again in every worker."""
+    global _PROFILER  # pylint: disable=global-statement
+    _PROFILER = Profiler()
+
+
+def disable():
+    """Stop collecting and forget everything."""
+    global _PROFILER  # pylint: disable=global-statement
+    _PROFILER = None
+
+
+def enabled() -> bool:
+    """Whether anything is collected."""
+    return _PROFILER is not None
+
+
+def span(name: str, **args):
+    """Context manager that times its body, if enabled."""
+    if _PROFILER is None:
+        return _NO_SPAN
+    return _PROFILER.span(name, args)
+
+
+def count(name: str, value: int = 1):
+    """Add to a counter, if enabled."""
+    if _PROFILER is not None:
+        _PROFILER.count(name, value)
+
+
+def drain() -> tuple[list[dict], dict[str, int]] | None:
+    """Take everything collected so far, e.g. to send it from a worker to the main process."""
+    if _PROFILER is None:
+        return None
+    with _PROFILER._lock:  # pylint: disable=protected-access
+        data = (_PROFILER.events, dict(_PROFILER.counters))
+        _PROFILER.events = []
+        _PROFILER.counters = Counter()
+    return data
+
+
+def merge(data: tuple[list[dict], dict[str, int]] | None):
+    """Add what `drain` returned in another process."""
+    if _PROFILER is None or data is None:
+        return
+    (events, counters) = data
+    _PROFILER.events.extend(events)
+    for (name, value) in counters.items():
+        _PROFILER.count(name, value)
+
+
+def summary() -> dict:
+    """Total time per span and all counters.
+
+    Nested spans are included in their parents and the workers add up,
+    so the totals can be more than the wall time.
+    """
+    spans: dict[str, dict] = {}
+    for event in _PROFILER.events if _PROFILER else []:
+        entry = spans.setdefault(event["name"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] += event["dur"] / 1e6
+        entry["max_seconds"] = max(entry["max_seconds"], event["dur"] / 1e6)
+    for entry in spans.values():
+        entry["seconds"] = round(entry["seconds"], 6)
+        entry["max_seconds"] = round(entry["max_seconds"], 6)
+    spans = dict(sorted(spans.items(), key=lambda x: -x[1]["seconds"]))
+    counters = dict(sorted(_PROFILER.counters.items())) if _PROFILER else {}
+    return {"spans": spans, "counters": counters}
+
+
+def write(prefix: Path) -> tuple[Path, Path]:
+    """Write "<prefix>.json" (the summary) and "<prefix>.trace.json".
+
+    The trace can be opened with https://ui.perfetto.dev/ or chrome://tracing.
+    """
+    summary_out = prefix.with_name(prefix.name + ".json")
+    trace_out = prefix.with_name(prefix.name + ".trace.json")
+    summary_out.write_text(json.dumps(summary(), indent=2), "UTF-8")
+
+    events = _PROFILER.events if _PROFILER else []
+    names = [{"name": "process_name", "ph": "M", "pid": pid,
+              "args": {"name": "main" if pid == os.getpid() else f"worker {pid}"}}
+             for pid in sorted({x["pid"] for x in events})]
+    trace_out.write_text(json.dumps({"traceEvents": names + events,
+                                     "displayTimeUnit": "ms"}), "UTF-8")
+    return (summary_out, trace_out)
@@ -1,9 +1,26 @@
 """Shared stuffs and utility functions."""
+import hashlib
 import json
+import os
 import sys
+import threading
 import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from . import profiling
+from .atlas import atlas_dir, pack_atlas, remove_atlas
+from .images import ImageWriter
+
+if TYPE_CHECKING:
+    from .generate.rsi import RSICache
+
+# Bump this whenever the rendering changes, so old outputs get re-rendered.
+MANIFEST_VERSION = 2
 
 
 def eprint(*args, **kwargs):
@@ -18,12 +35,40 @@ class Image:
     width: str
     height: str
 
+    @property
+    def tombstone(self) -> bool:
+        """Whether the tile was removed (but keeps its id)."""
+        return not self.source
+
+
+TOMBSTONE = Image("", "0", "0")
+
 
 @dataclass
 class CacheJSON:
-    """Cache file content."""
+    """Cache file content.
+
+    Tile id i+1 of the tile set is `ids[i]`. Ids are only ever appended, so maps keep
+    pointing at the same tiles. Removed tiles become tombstones and keep their id.
+    A tile that is in there more than once (from older versions) is updated everywhere.
+    """
     ids: list[str]
     images: list[Image]
+    _index: dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _duplicates: dict[str, list[int]] = field(default_factory=dict, init=False, repr=False,
+                                              compare=False)
+
+    def __post_init__(self):
+        for (i, tile_id) in enumerate(self.ids):
+            if tile_id and self._index.setdefault(tile_id, i) != i:
+                self._duplicates.setdefault(tile_id, []).append(i)
+
+    def __contains__(self, tile_id: str) -> bool:
+        return tile_id in self._index
+
+    def index(self, tile_id: str) -> int | None:
+        """Position of a tile in the lists, None if it is not in there."""
+        return self._index.get(tile_id)
 
     @staticmethod
     def from_dict(d: dict) -> "CacheJSON":
@@ -43,9 +88,174 @@ class CacheJSON:
             assert len(existing.ids) == len(existing.images)
         return existing
 
+    def write_json(self, path: Path):
+        """Save the cache, atomically."""
+        write_atomic(path, json.dumps({"ids": self.ids, "images": self.images}, default=vars))
+
+    def put(self, tile_id: str, image: Image) -> Image | None:
+        """Add or update the image of a tile without changing the index.
+
+        Returns the old image, if there was one.
+        """
+        index = self._index.get(tile_id)
+        if index is None:
+            self._index[tile_id] = len(self.ids)
+            self.ids.append(tile_id)
+            self.images.append(image)
+            return None
+        (old, self.images[index]) = (self.images[index], image)
+        for duplicate in self._duplicates.get(tile_id, ()):
+            self.images[duplicate] = image
+        return old
+
+
+@dataclass(frozen=True)
+class Selection:
+    """Part of the tile sets to generate, each field narrows it down (empty means any)."""
+    # "decals", "entities" and/or "tiles". Only "entities" if just groups are given.
+    generators: frozenset[str] = frozenset()
+    # Names of entity tile sets, e.g. "Walls".
+    groups: frozenset[str] = frozenset()
+    # Glob patterns of prototype ids, e.g. "Wall*".
+    ids: tuple[str, ...] = ()
+    # Exact manifest keys, e.g. "entities/Foo" (used by the watch mode).
+    keys: frozenset[str] | None = None
+
+    def runs(self, generator: str) -> bool:
+        """Whether a generator has anything to do."""
+        if self.generators:
+            return generator in self.generators
+        return not self.groups or generator == "entities"
+
+    def __call__(self, key: str) -> bool:
+        """Whether the output with that manifest key is selected (ignoring the groups)."""
+        if self.keys is not None and key not in self.keys:
+            return False
+        (kind, _, prototype_id) = key.partition("/")
+        return self.runs(kind.split("_")[0]) and \
+            (not self.ids or any(fnmatchcase(prototype_id, x) for x in self.ids))
+
+
+@dataclass
+class Options:
+    """Knobs for the generators."""
+    jobs: int = 1
+    force: bool = False
+    rules: dict = field(default_factory=dict)
+    atlas: bool = False
+    encoding: str = "default"
+    # What to generate, everything if None.
+    only: Selection | None = None
+    # Caches that outlive a single build (in watch mode), otherwise every build starts cold.
+    caches: "Caches | None" = None
+
+    def selected(self, key: str) -> bool:
+        """Whether the output with that manifest key is to be generated."""
+        return self.only is None or self.only(key)
+
+
+class FileHasher:
+    """Content hashes of files, each file is only read once."""
+
+    def __init__(self):
+        self._digests: dict[Path, str | None] = {}
+
+    def __call__(self, path: Path) -> str | None:
+        """Hash of the file, or None if it does not exist."""
+        if path not in self._digests:
+            try:
+                with open(path, "rb") as file:
+                    self._digests[path] = hashlib.file_digest(file, _blake2b).hexdigest()
+            except FileNotFoundError:
+                self._digests[path] = None
+        return self._digests[path]
+
+    def forget(self, path: Path):
+        """Hash the file again the next time, e.g. after it changed."""
+        self._digests.pop(path, None)
+
+
+@dataclass
+class Caches:
+    """File hashes and RSIs, kept across builds."""
+    hasher: FileHasher
+    rsis: "RSICache"
+
+
+def hash_object(obj) -> str:
+    """Hash of something JSON-like, e.g. a prototype."""
+    return _blake2b(json.dumps(obj, default=str).encode("UTF-8")).hexdigest()
+
+
+def _blake2b(data: bytes = b""):
+    """Short hashes are plenty to tell files apart."""
+    return hashlib.blake2b(data, digest_size=16)
+
+
+@dataclass
+class ManifestEntry:
+    """What went into and came out of rendering one prototype."""
+    inputs: dict[str, str | None]
+    outputs: dict[str, str]  # tile-id -> image source
+
+
+@dataclass
+class BuildManifest:
+    """Provenance of all the rendered images, used to skip unchanged ones."""
+    entries: dict[str, ManifestEntry] = field(default_factory=dict)
+
+    @staticmethod
+    def from_json(path: Path) -> "BuildManifest":
+        """Load the manifest, or start a new one if it is missing or outdated."""
+        path.parent.mkdir(exist_ok=True)
+        if not path.exists():
+            return BuildManifest()
+        data = json.loads(path.read_text("UTF-8"))
+        if data.get("version") != MANIFEST_VERSION:
+            return BuildManifest()
+        return BuildManifest({k: ManifestEntry(v["inputs"], v["outputs"])
+                              for (k, v) in data["entries"].items()})
+
+    def write_json(self, path: Path):
+        """Save the manifest."""
+        data = {"version": MANIFEST_VERSION, "entries": self.entries}
+        write_atomic(path, json.dumps(data, default=vars))
+
+    def is_current(self, key: str, inputs: dict, cache: "CacheJSON", out: Path) -> bool:
+        """Whether the outputs of `key` exist and were made from the same inputs."""
+        entry = self.entries.get(key)
+        if entry is None or entry.inputs != inputs:
+            return False
+        return all(tile_id in cache and (out / source).exists()
+                   for (tile_id, source) in entry.outputs.items())
+
+    def record(self, key: str, inputs: dict, outputs: dict[str, str]):
+        """Remember what `key` was rendered from."""
+        self.entries[key] = ManifestEntry(inputs, outputs)
 
-def create_tsx(cache: CacheJSON, name: str, output: Path, extra: dict = None):
-    """All the XML writing."""
+
+def write_atomic(path: Path, data: str | bytes):
+    """Replace a file in one go, so an interrupted build never leaves half a file behind."""
+    if isinstance(data, str):
+        data = data.encode("UTF-8")
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def create_tsx(cache: CacheJSON, name: str, output: Path, extra: dict = None,
+               atlas: ImageWriter | None = None):
+    """All the XML writing.
+
+    With an `atlas`-writer, the sprites are packed into a few sheets in "./.atlas/<name>/",
+    without one these sheets are removed.
+    """
     root_element = ET.Element("tileset", name=name)
 
     if extra:
@@ -53,13 +263,60 @@ def create_tsx(cache: CacheJSON, name: str, output: Path, extra: dict = None):
         for (key, value) in extra.items():
             ET.SubElement(properties, "property", name=key, value=value)
 
-    for i, image in enumerate(cache.images):
+    if atlas:
+        with profiling.span("pack_atlas", tile_set=name):
+            _add_atlas(root_element, cache, output, atlas)
+    else:
+        for i, image in enumerate(cache.images):
+            if image.tombstone:
+                continue
+            ET.SubElement(
+                ET.SubElement(root_element, "tile", id=str(i+1)),
+                "image", source=image.source,
+                width=str(image.width), height=str(image.height))
+    write_atomic(output, ET.tostring(root_element, encoding="UTF-8", xml_declaration=True))
+    if not atlas:
+        # From an earlier build with atlases, the tile set does not use them anymore.
+        remove_atlas(output)
+
+
+def _add_atlas(root_element: ET.Element, cache: CacheJSON, output: Path,
+               writer: ImageWriter):
+    """Pack the sprites and reference them from the tile set."""
+    atlas = pack_atlas([None if x.tombstone else output.parent / x.source for x in cache.images],
+                       atlas_dir(output), writer)
+
+    def source(sheet: Path) -> str:
+        return "./" + sheet.relative_to(output.parent).as_posix()
+
+    for (i, placed) in enumerate(atlas.placements):
+        if placed is None and not cache.images[i].tombstone:
+            eprint(f"Could not read '{cache.images[i].source}'!")
+
+    if atlas.grid:
+        # A regular tile set, which Tiled loads a lot faster.
+        (sheet,) = atlas.sheets.values()
+        placed = next(x for x in atlas.placements if x)
+        root_element.set("tilewidth", str(placed.width))
+        root_element.set("tileheight", str(placed.height))
+        root_element.set("tilecount", str(len(cache.images) + 1))
+        root_element.set("columns", str(sheet.columns))
+        ET.SubElement(root_element, "image", source=source(sheet.path),
+                      width=str(sheet.width), height=str(sheet.height))
+        return
+
+    # Sprites of different sizes, an image collection with sub-rectangles (Tiled >= 1.9).
+    root_element.set("columns", "0")
+    for i, placed in enumerate(atlas.placements):
+        if placed is None:
+            continue
+        sheet = atlas.sheets[placed.sheet]
         ET.SubElement(
-            ET.SubElement(root_element, "tile", id=str(i+1)),
-            "image", source=image.source,
-            width=str(image.width), height=str(image.height))
-    ET.ElementTree(root_element).write(output,
-                                       encoding="UTF-8", xml_declaration=True)
+            ET.SubElement(root_element, "tile", id=str(i+1),
+                          x=str(placed.x), y=str(placed.y),
+                          width=str(placed.width), height=str(placed.height)),
+            "image", source=source(sheet.path),
+            width=str(sheet.width), height=str(sheet.height))
 
 
 def add_transparent_image(background, foreground):
@@ -85,6 +342,94 @@ def add_transparent_image(background, foreground):
                            * (1 - alpha_background)) * 255
 
 
+# A class for the buffers it keeps, `composite_layers` is the function to use.
+class Compositor:  # pylint: disable=too-few-public-methods
+    """Alpha compositing of whole layer stacks in reusable float32 buffers.
+
+    Uses the same formula as `add_transparent_image` and truncates after every layer
+    like it does, but in float32 instead of float64. So every channel can be off by one
+    per composited layer, e.g. up to 3 for a stack of 4.
+    That is straight (not premultiplied) alpha on purpose: premultiplied blending would
+    round differently and change the pixels of semi-transparent sprites.
+    The buffers are planar (one plane per channel), which keeps every step contiguous.
+    """
+
+    def __init__(self):
+        self._shape = None
+        self._canvas = self._color = self._padded = None
+        self._alpha_fg = self._inverse = self._weight = None
+
+    def _prepare(self, height: int, width: int):
+        """(Re-)Allocate the buffers, only if the size changed."""
+        if self._shape == (height, width):
+            return
+        self._shape = (height, width)
+        self._canvas = np.empty((4, height, width), dtype=np.float32)
+        self._color = np.empty((3, height, width), dtype=np.float32)
+        self._padded = np.empty((height, width, 4), dtype=np.uint8)
+        (self._alpha_fg, self._inverse, self._weight) = (
+            np.empty((height, width), dtype=np.float32) for _ in range(3))
+
+    def composite(self, layers: list[np.ndarray],
+                  shape: tuple[int, int] | None = None) -> np.ndarray:
+        """Draw the BGRA layers on top of each other, smaller ones get centered.
+
+        The result is as big as the biggest layer, or `shape` (height, width) if given.
+        """
+        (height, width) = shape or (max(x.shape[0] for x in layers),
+                                    max(x.shape[1] for x in layers))
+        self._prepare(height, width)
+        (canvas, color) = (self._canvas, self._color)
+        (alpha_fg, inverse, weight) = (self._alpha_fg, self._inverse, self._weight)
+        (bg_color, bg_alpha) = (canvas[:3], canvas[3])
+
+        np.copyto(canvas, self._planes(layers[0]))
+        for layer in layers[1:]:
+            layer = self._planes(layer)
+            np.multiply(layer[3], 1 / 255, out=alpha_fg)
+            np.subtract(1, alpha_fg, out=inverse)
+
+            # colors = a_fg * fg + a_bg * bg * (1 - a_fg)
+            np.multiply(bg_alpha, 1 / 255, out=weight)
+            np.multiply(weight, inverse, out=weight)
+            np.multiply(bg_color, weight, out=bg_color)
+            np.multiply(layer[:3], alpha_fg, out=color)
+            np.add(bg_color, color, out=bg_color)
+
+            # alpha = (1 - (1 - a_fg) * (1 - a_bg)) * 255 = 255 - (255 - bg) * (1 - a_fg)
+            np.subtract(255, bg_alpha, out=bg_alpha)
+            np.multiply(bg_alpha, inverse, out=bg_alpha)
+            np.subtract(255, bg_alpha, out=bg_alpha)
+
+            # Truncate like the assignment to uint8 does.
+            np.floor(canvas, out=canvas)
+
+        return np.ascontiguousarray(canvas.transpose(1, 2, 0), dtype=np.uint8)
+
+    def _planes(self, img: np.ndarray) -> np.ndarray:
+        """Planar view of a layer, centered on a transparent canvas if it is smaller."""
+        (height, width) = img.shape[:2]
+        if (height, width) != self._shape:
+            padded = self._padded
+            padded.fill(0)
+            top = (padded.shape[0] - height) // 2
+            left = (padded.shape[1] - width) // 2
+            padded[top:top + height, left:left + width] = img
+            img = padded
+        return img.transpose(2, 0, 1)
+
+
+_COMPOSITORS = threading.local()
+
+
+def composite_layers(layers: list[np.ndarray],
+                     shape: tuple[int, int] | None = None) -> np.ndarray:
+    """Composite a stack of BGRA layers with the compositor of the current thread."""
+    if not hasattr(_COMPOSITORS, "compositor"):
+        _COMPOSITORS.compositor = Compositor()
+    return _COMPOSITORS.compositor.composite(layers, shape)
+
+
 def remove_prefix(string: str, prefix: str):
     """Remove a prefix from a string if it exists."""
     if string.startswith(prefix):
@@ -0,0 +1,165 @@
+"""A fake (but reproducible) SS14 resource tree, e.g. for the benchmarks.
+
+    python3 -m ss14_tiled.synthetic /tmp/ss14 --scale 10
+"""
+import argparse
+import json
+import math
+from pathlib import Path
+
+import cv2
+import numpy as np
+import yaml
+
+from .generate.rules import DEFAULT_GROUPS
+
+# Per 1x scale.
+RSIS = 10
+ENTITIES = 100
+DECALS = 20
+TILES = 10
+# (name, directions, frames per direction) of every entity RSI.
+STATES = [("base", 1, 1), ("on", 1, 2), ("dir", 4, 1), ("eight", 8, 1), ("anim", 4, 3)]
+# Not scaled, the tinting is per color and decal anyway.
+PALETTES = {"Base": {"white": "#FFFFFF", "red": "#FF000080", "blue": "#00F"},
+            "Other": {"half": "#8888", "dark": "#123456"}}
+
+
+def make_tree(root: Path, scale: int = 1, seed: int = 0) -> dict[str, int]:
+    """Create "<root>/Resources" with prototypes, RSIs, decals, palettes and tiles.
+
+    Returns how many of each were created.
+    """
+    rng = np.random.default_rng(seed)
+    resources = root / "Resources"
+    prototypes = resources / "Prototypes"
+
+    rsis = [f"Objects/synthetic_{i}.rsi" for i in range(RSIS * scale)]
+    for rsi in rsis:
+        _make_rsi(resources / "Textures" / rsi, STATES, rng)
+    entities = _entities(rsis, ENTITIES * scale, rng)
+    _dump(prototypes / "Entities" / "synthetic.yml", entities)
+
+    decal_rsis = [f"Decals/synthetic_{i}.rsi" for i in range(math.ceil(DECALS * scale / 10))]
+    for rsi in decal_rsis:
+        _make_rsi(resources / "Textures" / rsi, [(f"decal_{i}", 1, 1) for i in range(10)], rng)
+    _dump(prototypes / "Decals" / "synthetic.yml", [
+        {"type": "decal", "id": f"SyntheticDecal{i}",
+         "sprite": {"sprite": decal_rsis[i // 10], "state": f"decal_{i % 10}"}}
+        for i in range(DECALS * scale)])
+    _dump(prototypes / "Palettes" / "synthetic.yml", [
+        {"type": "palette", "id": name, "name": name, "colors": colors}
+        for (name, colors) in PALETTES.items()])
+
+    tiles = []
+    for i in range(TILES * scale):
+        variants = int(rng.integers(1, 5))
+        _write_png(resources / "Textures" / "Tiles" / f"synthetic_{i}.png",
+                   _noise(rng, 32, 32 * variants))
+        tiles.append({"type": "tile", "id": f"SyntheticFloor{i}",
+                      "sprite": f"/Textures/Tiles/synthetic_{i}.png", "variants": variants})
+    tiles.append({"type": "tile", "id": "Space"})
+    _dump(prototypes / "Tiles" / "synthetic.yml", tiles)
+
+    return {"rsis": len(rsis) + len(decal_rsis), "entities": len(entities),
+            "decals": DECALS * scale, "tiles": len(tiles)}
+
+
+def _entities(rsis: list[str], count: int, rng: np.random.Generator) -> list[dict]:
+    """Abstract bases of the default groups, with chains of entities below them."""
+    bases = sorted({x for group in DEFAULT_GROUPS for x in group["ancestors"]}) + ["BaseThing"]
+    entities = [{"type": "entity", "id": x, "abstract": True,
+                 "components": [{"type": "Transform"}, {"type": "Sprite", "sprite": rsis[0]}]}
+                for x in bases]
+
+    for i in range(count):
+        entity = {"type": "entity", "id": f"Synthetic{i}", "name": f"synthetic {i}"}
+        # Inherit from a recent entity (long chains), a base or both.
+        parents = []
+        if i and rng.random() < 0.6:
+            parents.append(f"Synthetic{max(0, i - int(rng.integers(1, 10)))}")
+        if not parents or rng.random() < 0.1:
+            parents.append(str(rng.choice(bases)))
+        entity["parent"] = parents[0] if len(parents) == 1 else parents
+
+        sprite = {"type": "Sprite", "sprite": str(rng.choice(rsis))}
+        if rng.random() < 0.5:
+            sprite["state"] = str(rng.choice([x[0] for x in STATES]))
+        else:
+            # Everything in a layer stack needs the same number of directions.
+            states = [x[0] for x in STATES if x[1] == 1]
+            if rng.random() < 0.5:
+                states = [x[0] for x in STATES if x[1] == 4]
+            sprite["layers"] = [{"state": str(rng.choice(states))}
+                                for _ in range(int(rng.integers(1, 5)))]
+            if len(sprite["layers"]) > 1 and rng.random() < 0.3:
+                sprite["layers"][-1]["visible"] = False
+        entity["components"] = [sprite]
+        if rng.random() < 0.3:
+            entity["components"].append({"type": "Physics"})
+
+        roll = rng.random()
+        if roll < 0.05:
+            entity["suffix"] = "DEBUG"
+        elif roll < 0.1:
+            entity["categories"] = ["HideSpawnMenu"]
+        elif roll < 0.12:
+            # Diagonals get rotated into 4 directions, like the walls with a single one.
+            entity["suffix"] = "Diagonal"
+            sprite.pop("state", None)
+            sprite["layers"] = [{"state": "base"}]
+        entities.append(entity)
+    return entities
+
+
+def _make_rsi(path: Path, states: list[tuple[str, int, int]], rng: np.random.Generator,
+              size: int = 32):
+    """An RSI with all directions and frames of a state in a square-ish grid."""
+    path.mkdir(parents=True, exist_ok=True)
+    meta = {"version": 1, "license": "CC0-1.0", "copyright": "synthetic",
+            "size": {"x": size, "y": size}, "states": []}
+    for (name, directions, frames) in states:
+        state = {"name": name}
+        if directions != 1:
+            state["directions"] = directions
+        if frames != 1:
+            state["delays"] = [[0.1] * frames for _ in range(directions)]
+        meta["states"].append(state)
+
+        columns = math.ceil(math.sqrt(directions * frames))
+        rows = math.ceil(directions * frames / columns)
+        _write_png(path / f"{name}.png", _noise(rng, rows * size, columns * size))
+    (path / "meta.json").write_text(json.dumps(meta), "UTF-8")
+
+
+def _noise(rng: np.random.Generator, height: int, width: int) -> np.ndarray:
+    """Random BGRA image, with some fully transparent pixels like real sprites."""
+    img = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    img[rng.random((height, width)) < 0.4, 3] = 0
+    return img
+
+
+def _write_png(path: Path, img: np.ndarray):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    cv2.imwrite(path, img)
+
+
+def _dump(path: Path, prototypes: list[dict]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(yaml.safe_dump(prototypes, sort_keys=False), "UTF-8")
+
+
+def main():
+    """Create a synthetic tree from the command line."""
+    parser = argparse.ArgumentParser(prog="python3 -m ss14_tiled.synthetic",
+                                     description="Create a fake SS14 resource tree.")
+    parser.add_argument("root", type=Path, help="Where to create the \"Resources\"-directory.")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Multiplier for the number of prototypes and sprites.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(make_tree(args.root, args.scale, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,41 @@
 """Some tests."""
+import copy
+import base64
+import io
+import json
+import math
+import os
+import pickle
+import tempfile
+import zlib
 import unittest
+from unittest import mock
+from contextlib import redirect_stderr
+from pathlib import Path
 
+import cv2
+import numpy as np
+import yaml
 from deepdiff import DeepDiff
 
-from .generate.entities import merge_entity
+from . import profiling
+from .atlas import pack_atlas
+from .generate import build
+from .generate.decals import color_luts, create_decals, decal_colors, parse_hex
+from .generate.entities import (RenderSpec, entity_inputs, find_entities, merge_entity,
+                                render_entity, resolve_entities)
+from .generate.prototypes import PrototypeIndex, load_cached, load_file, load_files
+from .generate.rsi import LRUCache, RSICache, RSIMeta
+from .generate.rules import (ancestor_index, filter_entities, group_entities, load_rules,
+                             select_entities)
+from .generate.watch import Session
+from .images import ImageWriter, WriteStats, prefetch
+from .indexes import check_indexes, remove_unused_images
+from .maps import export_map, import_map
+from .maps.export import TILE_DTYPE
+from .shared import (BuildManifest, CacheJSON, FileHasher, Image, Options, Selection,
+                     add_transparent_image, composite_layers, create_tsx)
+from .synthetic import make_tree
 
 
 class TestMergeEntity(unittest.TestCase):
@@ -117,6 +149,818 @@ class TestMergeEntity(unittest.TestCase):
         diff = DeepDiff(actual, expected, ignore_order=True)
         assert not diff
 
+    def test_copy_on_write(self):
+        """Untouched components are shared, the inputs stay as they are."""
+        child = {
+            "id": "B",
+            "parent": ["A"],
+            "components": [{"type": "test_2", "a": 2}, {"type": "test_2", "b": 3}]
+        }
+        parent = {
+            "id": "A",
+            "parent": [],
+            "components": [{"type": "test_1"}, {"type": "test_2", "a": 1, "c": 1}]
+        }
+        before = copy.deepcopy((child, parent))
+        actual = merge_entity(child, parent)
+        assert (child, parent) == before
+        assert actual["components"][0] is parent["components"][0]
+        assert actual["components"][1] == {"type": "test_2", "a": 2, "b": 3, "c": 1}
+
+
+class TestResolveEntities(unittest.TestCase):
+    """Tests for the inheritance resolution."""
+
+    def test_broken(self):
+        """Missing parents and cycles are left out instead of looping forever."""
+        entities = {key: {"id": key, "parent": parents, "components": [{"type": key}]}
+                    for (key, parents) in (("A", []), ("B", ["A"]), ("C", ["B", "A"]),
+                                           ("M", ["Missing"]), ("N", ["M"]),
+                                           ("X", ["Y"]), ("Y", ["X"]), ("Z", ["Y", "A"]),
+                                           ("S", ["S"]))}
+        actual = resolve_entities(entities)
+        assert sorted(actual) == ["A", "B", "C"]
+        assert sorted(x["type"] for x in actual["C"]["components"]) == ["A", "B", "C"]
+
+
+class TestRenderSpec(unittest.TestCase):
+    """Tests for the compact render specs."""
+
+    def test_of(self):
+        """Only the visible layers are kept, equal stacks are shared."""
+        sprite = {"type": "Sprite", "sprite": "a.rsi", "layers": [
+            {"state": "base"}, {"state": "hidden", "visible": False},
+            {"sprite": "b.rsi", "state": True}, {"map": ["enum.X"]}]}
+        shared = {}
+        spec = RenderSpec.of({"id": "A", "components": [sprite]}, shared)
+        other = RenderSpec.of({"id": "B", "suffix": "Diagonal", "components": [sprite]}, shared)
+        assert [(x.rsi, x.state, x.has_state, x.custom) for x in spec.layers] == [
+            ("a.rsi", "base", True, False), ("b.rsi", True, True, False),
+            ("a.rsi", None, False, True)]
+        assert spec.layers is other.layers
+        assert (spec.diagonal, other.diagonal) == (False, True)
+        assert spec.digest() != other.digest()
+        assert RenderSpec.of({"id": "C", "components": []}).layers is None
+
+        copied = pickle.loads(pickle.dumps(spec))
+        assert (copied.id, copied.layers, copied.digest()) == (spec.id, spec.layers, spec.digest())
+
+    def test_outside_textures(self):
+        """Sprites outside of the textures are reported as missing, not fatal."""
+        sprite = {"type": "Sprite", "sprite": "/Objects/missing.rsi", "state": "base"}
+        spec = RenderSpec.of({"id": "A", "components": [sprite]})
+        with tempfile.TemporaryDirectory() as tmp:
+            rsis = RSICache(Path(tmp))
+            inputs = entity_inputs(spec, rsis, FileHasher())
+            assert inputs["/Objects/missing.rsi/meta.json"] is None
+            assert "Textures/Objects/a.rsi/meta.json" in entity_inputs(
+                RenderSpec.of({"id": "B", "components": [sprite | {"sprite": "Objects/a.rsi"}]}),
+                rsis, FileHasher())
+            with io.StringIO() as warnings, redirect_stderr(warnings):
+                assert not render_entity(spec, rsis, Path(tmp), ImageWriter())
+                assert "'A' is missing RSI" in warnings.getvalue()
+
+
+class TestFilterEntities(unittest.TestCase):
+    """Tests for the entity filter."""
+
+    def test_rules(self):
+        """The default and the extra rules are all applied."""
+        def entity(key, *components, **extra):
+            return {"id": key, "components": [{"type": x} for x in ("Sprite",) + components],
+                    **extra}
+
+        entities = {x["id"]: x for x in (
+            entity("Kept", "Item", suffix="Empty"),
+            entity("Abstract", abstract=True),
+            entity("NoSprite") | {"components": []},
+            entity("Debug", suffix="DEBUG, Full"),
+            entity("Hidden", categories=["HideSpawnMenu"]),
+            entity("Despawn", "TimedDespawn"),
+            entity("Fork", "Item", suffix="Test"),
+            entity("ForkKept", suffix="Test"),
+        )}
+        rules = {"exclude": [{"component": "Item", "suffix": "Test"}]}
+        assert list(filter_entities(entities)) == ["Kept", "Fork", "ForkKept"]
+        assert list(filter_entities(entities, rules)) == ["Kept", "ForkKept"]
+
+    def test_load(self):
+        """Empty keys in a rules file are no rules, anything but a list of rules is an error."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "rules.yml"
+            path.write_text("exclude:\ngroups:\n")
+            assert load_rules(path) == {"exclude": [], "groups": []}
+            for text in ("exclude: GhostRole\n", "groups: [Walls]\n"):
+                path.write_text(text)
+                with self.assertRaisesRegex(ValueError, text.split(":", 1)[0]):
+                    load_rules(path)
+
+
+class TestGroupEntities(unittest.TestCase):
+    """Tests for splitting the entities into tile sets."""
+
+    def test_groups(self):
+        """Grandparents count and extra groups come after the default ones."""
+        entities = {key: {"id": key, "parent": parents} for (key, parents) in (
+            ("BaseWall", []), ("WallMid", ["BaseWall"]), ("WallSolid", ["WallMid"]),
+            ("Airlock", []), ("BaseMachine", []), ("Lathe", ["BaseMachine"]),
+            ("Thing", ["Missing"]), ("Rock", []))}
+        ancestors = ancestor_index(entities)
+        assert ancestors["WallSolid"] == {"WallMid", "BaseWall"}
+        assert ancestors["Thing"] == {"Missing"}
+
+        rules = {"groups": [{"name": "Machines", "ancestors": ["BaseMachine"]},
+                            {"name": "Walls", "ids": ["Rock"]}]}
+        groups = dict(group_entities(entities, rules, ancestors))
+        assert list(groups)[-2:] == ["Machines", "Other"]
+        assert sorted(groups["Walls"]) == ["Rock", "WallMid", "WallSolid"]
+        assert sorted(groups["Airlocks"]) == ["Airlock"]
+        assert sorted(groups["Machines"]) == ["Lathe"]
+        assert sorted(groups["Other"]) == ["BaseMachine", "BaseWall", "Thing"]
+
+    def test_select(self):
+        """Selected groups and ids come with the ancestors they need for resolving."""
+        entities = {key: {"id": key, "parent": parents} for (key, parents) in (
+            ("BaseWall", []), ("WallMid", ["BaseWall"]), ("WallSolid", ["WallMid"]),
+            ("Airlock", []), ("AirlockGlass", ["Airlock"]), ("Rock", []))}
+        ancestors = ancestor_index(entities)
+        walls = select_entities(entities, ancestors, Selection(groups=frozenset({"Walls"})))
+        assert list(walls) == ["BaseWall", "WallMid", "WallSolid"]
+        glass = select_entities(entities, ancestors, Selection(ids=("*Glass", "Rock")))
+        assert list(glass) == ["Airlock", "AirlockGlass", "Rock"]
+
+        only = Selection(frozenset({"decals"}), ids=("Wall*",))
+        assert only("decals_Base_red/WallDecal") and not only("decals/Rust")
+        assert not only("entities/WallSolid") and not only.runs("tiles")
+        assert Selection(groups=frozenset({"Walls"})).runs("entities")
+        assert not Selection(groups=frozenset({"Walls"})).runs("decals")
+
+
+class TestLoadFiles(unittest.TestCase):
+    """Tests for the prototype loader."""
+
+    def test_parallel(self):
+        """The process pool returns the same as the serial path, in order."""
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for i in range(8):
+                file = Path(tmp) / f"{i}.yml"
+                file.write_text(f"- type: entity\n  id: E{i}\n  x: !type:Unknown\n    a: 1\n",
+                                "UTF-8")
+                files.append(file)
+            (Path(tmp) / "empty.yml").write_text("", "UTF-8")
+            files.append(Path(tmp) / "empty.yml")
+
+            serial = load_files(files)
+            assert serial[0] == [{"type": "entity", "id": "E0", "x": None}]
+            assert serial[-1] == []
+            assert load_files(files, jobs=3) == serial
+            assert load_files(files, types=frozenset({"entity"})) == serial
+            assert load_files(files, types=frozenset({"tile"})) == [[]] * len(files)
+
+            # The type does not have to be the first key.
+            file = Path(tmp) / "late.yml"
+            file.write_text("- id: Late\n  type: entity\n- id: Quoted\n  type: 'tile'\n", "UTF-8")
+            assert [x["id"] for x in load_file(file, frozenset({"entity"}))] == ["Late", "Quoted"]
+            assert load_file(file, frozenset({"tile"})) == load_file(file)
+
+    def test_index(self):
+        """Prototypes are bucketed by type and can be looked up by id."""
+        index = PrototypeIndex()
+        for prototype in ({"type": "entity", "id": "A"}, {"type": "tile", "id": "A"},
+                          {"type": "entity", "id": "B"}, {"type": "entity", "id": "A", "x": 1},
+                          None, {"id": "no-type"}):
+            index.add(prototype)
+        assert [x["id"] for x in index.of_type("entity")] == ["A", "B", "A"]
+        assert index.get("entity", "A") == {"type": "entity", "id": "A", "x": 1}
+        assert index.get("tile", "A") == {"type": "tile", "id": "A"}
+        assert index.get("decal", "A") is None
+        assert not index.of_type("decal")
+
+    def test_cache(self):
+        """Only changed files are parsed again, a broken cache is simply rebuilt."""
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            cache = root / "prototypes.pickle"
+            files = [root / "a.yml", root / "b.yml"]
+            files[0].write_text("- type: entity\n  id: A\n", "UTF-8")
+            files[1].write_text("- type: tile\n  id: B\n", "UTF-8")
+            expected = load_files(files)
+            assert load_cached(root, files, cache, types=frozenset({"tile"})) == \
+                [[], expected[1]]
+            assert load_cached(root, files, cache) == expected
+
+            # Swap the parsed documents, to tell cached ones apart.
+            (version, entries) = pickle.loads(cache.read_bytes())
+            entries["a.yml"] = entries["a.yml"][:3] + (expected[1],)
+            cache.write_bytes(pickle.dumps((version, entries)))
+            assert load_cached(root, files, cache)[0] == expected[1]
+            os.utime(files[0], ns=(0, 0))  # Same content.
+            assert load_cached(root, files, cache)[0] == expected[1]
+            files[0].write_text("- type: entity\n  id: C\n", "UTF-8")
+            assert load_cached(root, files, cache)[0] == [{"type": "entity", "id": "C"}]
+
+            cache.write_bytes(b"garbage")
+            with redirect_stderr(io.StringIO()):
+                assert load_cached(root, files, cache) == load_files(files)
+            cache.write_bytes(pickle.dumps(((0,), entries)))
+            assert load_cached(root, files, cache) == load_files(files)
+
+
+class TestBuildManifest(unittest.TestCase):
+    """Tests for the incremental builds."""
+
+    def test_is_current(self):
+        """Only unchanged inputs with existing outputs count as current."""
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp)
+            source = out / "a.png"
+            source.write_bytes(b"a")
+            inputs = {"a.png": FileHasher()(source), "color": "#FFF"}
+            cache = CacheJSON(["A"], [Image("./a.png", "32", "32")])
+
+            manifest = BuildManifest()
+            assert not manifest.is_current("a", inputs, cache, out)
+            manifest.record("a", inputs, {"A": "./a.png"})
+            manifest.write_json(out / "manifest.json")
+            manifest = BuildManifest.from_json(out / "manifest.json")
+            assert manifest.is_current("a", inputs, cache, out)
+
+            source.write_bytes(b"b")
+            changed = {"a.png": FileHasher()(source), "color": "#FFF"}
+            assert changed != inputs
+            assert not manifest.is_current("a", changed, cache, out)
+            assert not manifest.is_current("a", inputs | {"color": "#000"}, cache, out)
+            assert not manifest.is_current("a", inputs, CacheJSON([], []), out)
+            source.unlink()
+            assert not manifest.is_current("a", inputs, cache, out)
+
+    def test_put(self):
+        """Updating an image keeps the index of the tile."""
+        cache = CacheJSON(["A", "B"], [Image("./a.png", "32", "32"), Image("./b.png", "32", "32")])
+        assert cache.put("C", Image("./c.png", "32", "32")) is None
+        assert cache.put("A", Image("./a.webp", "64", "32")).source == "./a.png"
+        assert cache.ids == ["A", "B", "C"]
+        assert [x.source for x in cache.images] == ["./a.webp", "./b.png", "./c.png"]
+        assert (cache.index("C"), cache.index("D")) == (2, None)
+
+
+class TestIndexes(unittest.TestCase):
+    """Tests for checking and repairing the tile set indexes."""
+
+    def test_compact(self):
+        """Missing images become tombstones, duplicates keep their ids, unused images go."""
+        with tempfile.TemporaryDirectory() as tmp:
+            dist = Path(tmp)
+            (dist / ".images" / "tiles").mkdir(parents=True)
+            (dist / ".data").mkdir()
+            for name in ("a", "b", "unused"):
+                (dist / ".images" / "tiles" / f"{name}.png").write_bytes(b"")
+            images = [Image(f"./.images/tiles/{x}.png", "32", "32") for x in "abbc"]
+            CacheJSON(["A", "B", "A", "C"], images).write_json(dist / ".data" / "tiles.json")
+            BuildManifest().write_json(dist / ".data" / "manifest.json")
+
+            assert len(check_indexes(dist)) == 3
+            assert len(check_indexes(dist, fix=True)) == 3
+            assert not check_indexes(dist)
+            assert not (dist / ".images" / "tiles" / "unused.png").exists()
+
+            cache = CacheJSON.from_json(dist / ".data" / "tiles.json")
+            assert cache.ids == ["A", "B", "A", "C"]
+            assert [x.tombstone for x in cache.images] == [False, False, False, True]
+            assert cache.images[2] == cache.images[0]
+            # Duplicates are updated together.
+            cache.put("A", Image("./.images/tiles/b.png", "32", "32"))
+            assert cache.images[0] == cache.images[2] != images[0]
+            # A tile that comes back gets its old id.
+            cache.put("C", Image("./.images/tiles/c.png", "32", "32"))
+            assert cache.index("C") == 3
+            assert not list(dist.glob(".data/.*"))
+
+    def test_remove_unused(self):
+        """Images stay as long as any tile set uses them."""
+        with tempfile.TemporaryDirectory() as tmp:
+            dist = Path(tmp)
+            (dist / ".images" / "ab").mkdir(parents=True)
+            (dist / ".images" / "old").mkdir()
+            (dist / ".data").mkdir()
+            for name in ("ab/shared", "ab/unused", "old/a"):
+                (dist / ".images" / f"{name}.png").write_bytes(b"")
+            shared = Image("./.images/ab/shared.png", "32", "32")
+            CacheJSON(["A", "B"], [shared, shared]).write_json(dist / ".data" / "tiles.json")
+            CacheJSON(["A"], [shared]).write_json(dist / ".data" / "decals.json")
+
+            assert remove_unused_images(dist) == 2
+            assert [x.relative_to(dist).as_posix() for x in dist.rglob("*.png")] == \
+                [".images/ab/shared.png"]
+            assert not (dist / ".images" / "old").exists()
+            assert not check_indexes(dist)
+
+
+class TestDecalColors(unittest.TestCase):
+    """Tests for tinting the decals."""
+
+    def test_batch(self):
+        """All colors at once match scaling each channel and rounding."""
+        colors = ["#FFF", "#FF000080", "#00F", "#8888", "#123456"]
+        img = np.random.default_rng(0).integers(0, 256, (8, 8, 4), dtype=np.uint8)
+        tinted = decal_colors(img, color_luts(colors))
+        assert tinted.shape == (len(colors), 8, 8, 4)
+        assert tinted.dtype == np.uint8
+        assert (tinted[0] == img).all()
+
+        for (color, actual) in zip(colors, tinted):
+            (red, green, blue, alpha) = parse_hex(color)
+            scale = np.array([blue, green, red, alpha]) / 255
+            expected = np.rint(img * scale).astype(np.uint8)
+            assert (actual == expected).all(), color
+
+    def test_outside_resources(self):
+        """Decals with sprites outside of the resources are reported and skipped."""
+        prototypes = PrototypeIndex()
+        prototypes.add({"type": "decal", "id": "Outside",
+                        "sprite": {"sprite": "/Decals/x.rsi", "state": "a"}})
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp) / "dist"
+            out.mkdir()
+            with io.StringIO() as warnings, redirect_stderr(warnings):
+                stats = create_decals(Path(tmp), out, prototypes, BuildManifest(), Options())
+                assert "'Outside' has a sprite outside of the resources" in warnings.getvalue()
+            assert not stats.written
+            assert "Outside" not in CacheJSON.from_json(out / ".data" / "decals.json")
+
+
+class TestCompositeLayers(unittest.TestCase):
+    """Tests for compositing the sprite layers."""
+
+    def test_reference(self):
+        """Stays within one per layer of `add_transparent_image`."""
+        rng = np.random.default_rng(0)
+        for count in range(1, 5):
+            layers = [rng.integers(0, 256, (16, 16, 4), dtype=np.uint8) for _ in range(count)]
+            # Fully transparent and opaque pixels are the common case.
+            layers[-1][:4, :, 3] = 0
+            layers[-1][4:8, :, 3] = 255
+            expected = layers[0].copy()
+            for layer in layers[1:]:
+                add_transparent_image(expected, layer)
+            actual = composite_layers(layers)
+            assert actual.dtype == np.uint8
+            diff = np.abs(actual.astype(int) - expected)
+            assert diff.max() <= count - 1, count
+            assert (actual[4:8] == layers[-1][4:8]).all()
+
+    def test_center(self):
+        """Smaller layers are centered on the bigger ones."""
+        big = np.zeros((4, 4, 4), dtype=np.uint8)
+        small = np.full((2, 2, 4), 255, dtype=np.uint8)
+        actual = composite_layers([small, big])
+        assert actual.shape == (4, 4, 4)
+        assert (actual[1:3, 1:3] == 255).all()
+        assert not actual[0].any()
+        assert (composite_layers([big, small]) == actual).all()
+
+    def test_cached(self):
+        """Stacks built on cached prefixes are the same as composited in one go."""
+        rng = np.random.default_rng(0)
+        layers = {key: rng.integers(0, 256, (size, size + 1, 4), dtype=np.uint8)
+                  for (key, size) in (("a", 8), ("b", 5), ("c", 8), ("d", 3), ("e", 6))}
+        rsis = RSICache(Path("."))
+        for stack in ("ab", "abc", "abd", "ab", "abcde", "abcd", "e", "ea"):
+            stack = [(x, layers[x]) for x in stack]
+            shape = (max(x.shape[0] for (_, x) in stack), max(x.shape[1] for (_, x) in stack))
+            actual = rsis.composite(stack, shape)
+            assert not actual.flags.writeable
+            assert (actual == composite_layers([x for (_, x) in stack])).all()
+        assert rsis.composites.hits == 2  # "ab" again, and "abcd" below "abcde".
+
+
+class TestRSICache(unittest.TestCase):
+    """Tests for the RSI caches."""
+
+    def test_lru(self):
+        """The least recently used values are evicted first, bounded by size."""
+        cache = LRUCache(10, len)
+        assert cache.get("a", lambda: "aaaa") == "aaaa"
+        assert cache.get("b", lambda: "bbbb") == "bbbb"
+        assert cache.get("a", lambda: "new") == "aaaa"
+        cache.get("c", lambda: "cccc")
+        assert cache.size == 8
+        assert cache.get("b", lambda: "b") == "b"
+        assert cache.get("a", lambda: "new") == "aaaa"
+        cache.get("big", lambda: "x" * 11)
+        assert cache.get("a", lambda: "new") == "aaaa"
+        assert (cache.hits, cache.misses) == (3, 5)
+
+    def test_states(self):
+        """States are found by name, and YAML booleans by the first fitting name."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "meta.json"
+            path.write_text('\uFEFF{"size": {"x": 32, "y": 32}, "states": ['
+                            '{"name": "base"}, {"name": "On"}, {"name": "yes"}, {"name": "no"},'
+                            '{"name": "base", "directions": 4}]}', "UTF-8")
+            meta = RSIMeta.from_json(path)
+            assert meta.find_state("base") == {"name": "base"}
+            assert meta.find_state(True) == {"name": "On"}
+            assert meta.find_state(False) == {"name": "no"}
+            assert meta.find_state("missing") is None
+
+
+class TestImageWriter(unittest.TestCase):
+    """Tests for writing the images."""
+
+    def test_skip_unchanged(self):
+        """Identical images are not written again, the stats add up."""
+        img = np.zeros((4, 4, 4), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "a.png"
+            writer = ImageWriter()
+            assert writer.write(path, img)
+            mtime = path.stat().st_mtime_ns
+            assert not writer.write(path, img)
+            assert path.stat().st_mtime_ns == mtime
+            img[0, 0] = 255
+            assert writer.write(path, img)
+            assert (writer.stats.written, writer.stats.skipped) == (2, 1)
+
+            other = ImageWriter("max")
+            assert other.write(path, img)
+            other.stats.add(writer.stats)
+            assert (other.stats.written, other.stats.skipped) == (3, 1)
+            assert other.stats.bytes_written == path.stat().st_size + writer.stats.bytes_written
+
+    def test_store(self):
+        """Identical images are stored once, under a name that depends on the encoding too."""
+        img = np.zeros((4, 4, 4), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = ImageWriter(threads=2)
+            first = writer.store_later(Path(tmp), img)
+            assert writer.store_later(Path(tmp), img[:, :].copy()) == first
+            assert writer.store_later(Path(tmp), img[:2]) != first
+            writer.flush()
+            assert (writer.stats.written, writer.stats.deduplicated) == (2, 1)
+            assert writer.stats.dedup_ratio == 1.5
+            assert "dedup ratio 1.50" in str(writer.stats)
+            assert "composite cache" not in str(writer.stats)
+            writer.stats.add(WriteStats(from_composite_cache=2))
+            assert "2 entities from the composite cache" in str(writer.stats)
+
+            again = ImageWriter()
+            assert again.store_later(Path(tmp), img) == first
+            assert (again.stats.written, again.stats.skipped) == (0, 1)
+            assert ImageWriter("max").store_later(Path(tmp), img) != first
+            assert not list(Path(tmp).rglob("*.tmp"))
+
+    def test_encodings(self):
+        """All encodings are lossless, at least for the visible pixels."""
+        img = np.random.default_rng(0).integers(0, 256, (8, 8, 4), dtype=np.uint8)
+        visible = img[:, :, 3] > 0
+        with tempfile.TemporaryDirectory() as tmp:
+            for encoding in ("default", "fast", "max", "webp"):
+                writer = ImageWriter(encoding)
+                path = Path(tmp) / ("a" + writer.suffix)
+                writer.write(path, img)
+                assert (cv2.imread(path, cv2.IMREAD_UNCHANGED)[visible] == img[visible]).all(), \
+                    encoding
+        with self.assertRaises(ValueError):
+            ImageWriter("jpeg")
+
+    def test_pipeline(self):
+        """Prefetched results stay in order, background writes are all done after a flush."""
+        items = list(range(100))
+        assert list(prefetch(items, lambda x: x * 2)) == [(x, x * 2) for x in items]
+        assert list(prefetch(items, lambda x: x * 2, threads=0)) == [(x, x * 2) for x in items]
+        with tempfile.TemporaryDirectory() as tmp:
+            writer = ImageWriter(threads=3)
+            for (i, img) in prefetch(items, lambda x: np.full((2, 2, 4), x, dtype=np.uint8)):
+                writer.write_later(Path(tmp) / f"{i}.png", img)
+            writer.flush()
+            assert writer.stats.written == len(items)
+            assert (cv2.imread(Path(tmp) / "99.png", cv2.IMREAD_UNCHANGED) == 99).all()
+
+            writer.write_later(Path(tmp) / "missing" / "a.png", np.zeros((2, 2, 4), np.uint8))
+            with self.assertRaises(OSError):
+                writer.flush()
+
+
+class TestSynthetic(unittest.TestCase):
+    """Tests for the synthetic resource tree."""
+
+    def test_make_tree(self):
+        """The tree is reproducible and has everything the generators look at."""
+        with tempfile.TemporaryDirectory() as tmp:
+            counts = make_tree(Path(tmp) / "a")
+            make_tree(Path(tmp) / "b")
+            for name in ("Entities", "Decals", "Palettes", "Tiles"):
+                path = Path("Resources/Prototypes") / name / "synthetic.yml"
+                assert (Path(tmp) / "a" / path).read_text() == (Path(tmp) / "b" / path).read_text()
+
+            prototypes = PrototypeIndex.from_root(Path(tmp) / "a")
+            entities = find_entities(prototypes)
+            assert len(entities) == counts["entities"]
+            assert 0 < len(filter_entities(entities)) < len(entities)
+            assert len(prototypes.of_type("decal")) == counts["decals"]
+            assert prototypes.of_type("palette")
+
+
+class TestProfiling(unittest.TestCase):
+    """Tests for the spans and counters."""
+
+    def tearDown(self):
+        profiling.disable()
+
+    def test_disabled(self):
+        """Nothing is collected without enabling it."""
+        with profiling.span("a"):
+            profiling.count("b")
+        assert profiling.drain() is None
+        assert profiling.summary() == {"spans": {}, "counters": {}}
+
+    def test_enabled(self):
+        """Spans and counters end up in the summary and the trace, also from workers."""
+        profiling.enable()
+        with profiling.span("a", id="x"):
+            profiling.count("b", 2)
+        worker = profiling.drain()
+        assert [x["name"] for x in worker[0]] == ["a"]
+        assert worker[0][0]["args"] == {"id": "x"}
+        assert not profiling.summary()["counters"]
+
+        profiling.merge(worker)
+        profiling.merge(worker)
+        summary = profiling.summary()
+        assert summary["spans"]["a"]["count"] == 2
+        assert summary["counters"] == {"b": 4}
+        with tempfile.TemporaryDirectory() as tmp:
+            (_, trace_out) = profiling.write(Path(tmp) / "profile")
+            events = json.loads(trace_out.read_text())["traceEvents"]
+            assert [x["ph"] for x in events] == ["M", "X", "X"]
+
+
+class TestAtlas(unittest.TestCase):
+    """Tests for packing sprites into sheets."""
+
+    def test_pack(self):
+        """Same sized sprites make a grid, where cell 0 and tombstones are left empty."""
+        with tempfile.TemporaryDirectory() as tmp:
+            rng = np.random.default_rng(0)
+            sprites = []
+            for (i, size) in enumerate((32, 32, 32, 64)):
+                sprites.append(Path(tmp) / f"{i}.png")
+                cv2.imwrite(sprites[-1], rng.integers(0, 256, (size, size, 4), dtype=np.uint8))
+
+            atlas = pack_atlas(sprites[:3], Path(tmp) / "grid")
+            assert atlas.grid
+            (sheet,) = atlas.sheets.values()
+            assert (sheet.width, sheet.height, sheet.columns) == (128, 32, 4)
+            assert [x.x for x in atlas.placements] == [32, 64, 96]
+
+            # A tombstone keeps its cell, but it stays empty.
+            atlas = pack_atlas([sprites[0], None, sprites[2]], Path(tmp) / "tombstone")
+            assert atlas.grid
+            (sheet,) = atlas.sheets.values()
+            assert (sheet.width, sheet.height, sheet.columns) == (128, 32, 4)
+            assert atlas.placements[1] is None
+            assert [x.x for x in atlas.placements if x] == [32, 96]
+            assert not cv2.imread(sheet.path, cv2.IMREAD_UNCHANGED)[:, 64:96].any()
+
+            atlas = pack_atlas(sprites, Path(tmp) / "mixed")
+            assert not atlas.grid
+            assert len(atlas.sheets) == 2
+            for (sprite, placed) in zip(sprites, atlas.placements):
+                sheet = cv2.imread(placed.sheet, cv2.IMREAD_UNCHANGED)
+                cell = sheet[placed.y:placed.y + placed.height, placed.x:placed.x + placed.width]
+                assert (cell == cv2.imread(sprite, cv2.IMREAD_UNCHANGED)).all()
+
+    def test_switch_off(self):
+        """Writing a tile set without an atlas removes the sheets of the last one."""
+        with tempfile.TemporaryDirectory() as tmp:
+            dist = Path(tmp)
+            cv2.imwrite(dist / "a.png", np.zeros((32, 32, 4), dtype=np.uint8))
+            cache = CacheJSON(["A"], [Image("./a.png", "32", "32")])
+            create_tsx(cache, "Tiles", dist / "tiles.tsx", atlas=ImageWriter())
+            assert list((dist / ".atlas" / "tiles").iterdir())
+            assert ".atlas/tiles/" in (dist / "tiles.tsx").read_text()
+
+            create_tsx(cache, "Tiles", dist / "tiles.tsx")
+            assert not (dist / ".atlas").exists()
+            assert 'source="./a.png"' in (dist / "tiles.tsx").read_text()
+
+
+_MAP_TILESETS = ('<tileset firstgid="1" source="dist/tiles.tsx"/>'
+                 '<tileset firstgid="10" source="dist/entities_Other.tsx"/>'
+                 '<tileset firstgid="20" source="dist/decals_Base_red.tsx"/>')
+# Tiles, an entity in a tile layer and a (rotated) entity and a decal as objects.
+_FINITE_LAYERS = ('<layer width="3" height="2"><data encoding="csv">2,3,0,\n0,2,12</data></layer>'
+                  '<objectgroup><object gid="13" x="0" y="128" width="64" height="64" '
+                  'rotation="90"/><object gid="21" x="32" y="32" width="32" height="32"/>'
+                  '</objectgroup>')
+
+
+class TestBuild(unittest.TestCase):
+    """Tests for whole builds."""
+
+    def test_parallel(self):
+        """Rendering in a process pool gives the same files as a serial build."""
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            make_tree(root)
+            trees = []
+            for jobs in (1, 2):
+                out = root / f"dist{jobs}"
+                (out / ".data").mkdir(parents=True)
+                build(root, out, PrototypeIndex.from_root(root), BuildManifest(),
+                      Options(jobs=jobs))
+                trees.append({x.relative_to(out).as_posix(): x.read_bytes()
+                              for x in sorted(out.rglob("*")) if x.is_file()})
+            assert any(x.endswith(".tsx") for x in trees[0])
+            assert any(x.startswith(".data/entities_") for x in trees[0])
+            assert trees[0] == trees[1]
+
+
+class TestWatch(unittest.TestCase):
+    """Tests for the watch mode."""
+
+    def test_update(self):
+        """Changes only affect the outputs that use them, including inheriting entities."""
+        with tempfile.TemporaryDirectory() as tmp:
+            make_tree(Path(tmp))
+            out = Path(tmp) / "dist"
+            session = Session(Path(tmp), out, Options(jobs=1))
+            session.build()
+            assert session.update(set()) == set()
+
+            yml = session.resources_dir / "Prototypes" / "Entities" / "synthetic.yml"
+            entities = yaml.safe_load(yml.read_text())
+            entities[0]["description"] = "Changed."
+            yml.write_text(yaml.safe_dump(entities))
+            affected = session.update({yml})
+            children = {x["id"] for x in entities if x.get("parent") == entities[0]["id"]}
+            assert children
+            assert {f"entities/{x}" for x in children | {entities[0]["id"]}} <= affected
+            assert all(x.startswith("entities/") for x in affected)
+            assert session.prototypes.get("entity", entities[0]["id"])["description"] == "Changed."
+
+            png = session.resources_dir / "Textures" / "Tiles" / "synthetic_0.png"
+            assert session.update({png}) == {"tiles/SyntheticFloor0"}
+            assert not session.build({"tiles/SyntheticFloor0"}).written
+            png.write_bytes(cv2.imencode(".png", np.zeros((32, 32, 4), np.uint8))[1].tobytes())
+            assert session.update({png}) == {"tiles/SyntheticFloor0"}
+            assert session.build({"tiles/SyntheticFloor0"}).written == 1
+
+
+def _export_map(tmp: str, attributes: str, layers: str) -> dict:
+    """Write the generated tile sets and a map using them, return the exported map."""
+    dist = Path(tmp) / "dist"
+    (dist / ".data").mkdir(parents=True)
+    tile_sets = {"tiles": (["FloorSteel", "FloorWhite"], [32, 32]),
+                 "entities_Other": (["Thing_S", "Thing_E", "Big_S"], [32, 32, 64]),
+                 "decals_Base_red": (["Arrow"], [32])}
+    for (name, (ids, sizes)) in tile_sets.items():
+        images = [{"source": f"./{x}.png", "width": str(size), "height": str(size)}
+                  for (x, size) in zip(ids, sizes)]
+        (dist / ".data" / f"{name}.json").write_text(json.dumps({"ids": ids, "images": images}))
+        (dist / f"{name}.tsx").write_text(
+            '<tileset name="x"><properties>'
+            '<property name="color_value" value="#FF000080"/></properties></tileset>')
+
+    tmx = Path(tmp) / "map.tmx"
+    tmx.write_text(f'<map orientation="orthogonal" tilewidth="32" tileheight="32" '
+                   f'{attributes}>{_MAP_TILESETS}{layers}</map>')
+    export_map(tmx, Path(tmp) / "map.yml")
+    return yaml.safe_load((Path(tmp) / "map.yml").read_text())
+
+
+def _map_chunks(exported: dict) -> dict[str, np.ndarray]:
+    """Tile map indices of every chunk of an exported map, indexed by [y][x]."""
+    grid = exported["entities"][0]["entities"][1]["components"]
+    chunks = next(x for x in grid if x["type"] == "MapGrid")["chunks"]
+    return {k: np.frombuffer(base64.b64decode(v["tiles"]), TILE_DTYPE)["id"].reshape(16, 16)
+            for (k, v) in chunks.items()}
+
+
+class TestExportMap(unittest.TestCase):
+    """Tests for converting Tiled maps to SS14."""
+
+    def test_finite(self):
+        """Tiles, entities in a tile layer and tile objects."""
+        with tempfile.TemporaryDirectory() as tmp:
+            exported = _export_map(
+                tmp, 'width="3" height="2"',
+                '<layer width="3" height="2"><data encoding="csv">2,3,0,\n0,2,12</data></layer>'
+                '<objectgroup><object gid="13" x="0" y="128" width="64" height="64" '
+                'rotation="90"/><object gid="21" x="32" y="32" width="32" height="32"/>'
+                '</objectgroup>')
+
+        assert exported["tilemap"] == {0: "Space", 1: "FloorSteel", 2: "FloorWhite"}
+        chunk = _map_chunks(exported)["0,-1"]
+        # Row 0 of Tiled is y = -1, which is the last row of the chunk below y = 0.
+        assert (chunk[15, 0], chunk[15, 1], chunk[15, 2], chunk[14, 1]) == (1, 2, 0, 1)
+        assert np.count_nonzero(chunk) == 3
+
+        placed = {x["proto"]: x["entities"][0]["components"][0] for x in exported["entities"]}
+        assert placed["Thing"]["pos"] == "2.5,-1.5"
+        assert math.isclose(float(placed["Thing"]["rot"].split()[0]), math.pi / 2)
+        assert placed["Big"]["pos"] == "1,-5"
+        assert math.isclose(float(placed["Big"]["rot"].split()[0]), -math.pi / 2)
+
+        grid = exported["entities"][0]["entities"][1]["components"]
+        (node,) = next(x for x in grid if x["type"] == "DecalGrid")["chunkCollection"]["nodes"]
+        assert node["node"] == {"color": "#FF000080", "id": "Arrow"}
+        assert node["decals"] == {0: "1,-1"}
+
+    def test_infinite(self):
+        """Compressed chunks, with negative coordinates."""
+        gids = np.zeros((16, 16), dtype="<u4")
+        gids[0, 0] = 3
+        gids[15, 15] = 2 | 0x80000000  # flipped horizontally
+        data = base64.b64encode(zlib.compress(gids.tobytes())).decode()
+        with tempfile.TemporaryDirectory() as tmp:
+            exported = _export_map(
+                tmp, 'infinite="1"',
+                '<layer><data encoding="base64" compression="zlib">'
+                f'<chunk x="-16" y="0" width="16" height="16">{data}</chunk></data></layer>')
+
+        assert exported["tilemap"] == {0: "Space", 1: "FloorWhite", 2: "FloorSteel"}
+        chunks = _map_chunks(exported)
+        assert list(chunks) == ["-1,-1"]
+        assert (chunks["-1,-1"][15, 0], chunks["-1,-1"][0, 15]) == (1, 2)
+        assert len(exported["entities"]) == 1
+
+
+class TestImportMap(unittest.TestCase):
+    """Tests for converting SS14 maps to Tiled."""
+
+    def test_round_trip(self):
+        """Exporting an imported map gives back the same tiles, decals and entities."""
+        with tempfile.TemporaryDirectory() as tmp:
+            exported = _export_map(tmp, 'width="3" height="2"', _FINITE_LAYERS)
+            result = import_map(Path(tmp) / "map.yml", Path(tmp) / "again.tmx",
+                                Path(tmp) / "dist")
+            assert (result.chunks, result.entities, result.decals, result.unknown) == (1, 2, 1, 0)
+            assert 'source="dist/tiles.tsx"' in (Path(tmp) / "again.tmx").read_text()
+            export_map(Path(tmp) / "again.tmx", Path(tmp) / "again.yml")
+            again = yaml.safe_load((Path(tmp) / "again.yml").read_text())
+
+        def tiles(exported: dict) -> dict[str, np.ndarray]:
+            names = np.array(list(exported["tilemap"].values()))
+            return {k: names[v] for (k, v) in _map_chunks(exported).items()}
+
+        assert not DeepDiff(tiles(exported), tiles(again))
+        assert not DeepDiff(exported["entities"], again["entities"])
+
+    def test_grid_offset(self):
+        """The offset of a grid's group moves its tiles, entities and decals on the way back."""
+        with tempfile.TemporaryDirectory() as tmp:
+            exported = _export_map(tmp, 'width="3" height="2"', _FINITE_LAYERS)
+            grid = exported["entities"][0]["entities"][1]["components"]
+            next(x for x in grid if x["type"] == "Transform")["pos"] = "16,-32"
+            (Path(tmp) / "moved.yml").write_text(yaml.safe_dump(exported))
+            import_map(Path(tmp) / "moved.yml", Path(tmp) / "moved.tmx", Path(tmp) / "dist")
+            assert 'offsetx="512" offsety="1024"' in (Path(tmp) / "moved.tmx").read_text()
+            export_map(Path(tmp) / "moved.tmx", Path(tmp) / "again.yml")
+            again = yaml.safe_load((Path(tmp) / "again.yml").read_text())
+
+        assert list(_map_chunks(exported)) == ["0,-1"]
+        assert list(_map_chunks(again)) == ["1,-3"]
+        assert (_map_chunks(exported)["0,-1"] == _map_chunks(again)["1,-3"]).all()
+
+        def positions(exported: dict) -> list[tuple[float, float]]:
+            placed = [x["entities"][0]["components"][0]["pos"] for x in exported["entities"][1:]]
+            grid = exported["entities"][0]["entities"][1]["components"]
+            (node,) = next(x for x in grid if x["type"] == "DecalGrid")["chunkCollection"]["nodes"]
+            placed += node["decals"].values()
+            return [tuple(float(x) for x in pos.split(",")) for pos in placed]
+
+        assert positions(again) == [(x + 16, y - 32) for (x, y) in positions(exported)]
+
+    def test_chunk_batches(self):
+        """Chunks are decoded in batches as they are read, in any order of the keys."""
+        def chunk(x: int, version: int) -> str:
+            dtype = TILE_DTYPE if version >= 6 else np.dtype([("id", "<u2"), ("rest", "<u2")])
+            tiles = np.zeros(256, dtype)
+            tiles["id"][0] = 1
+            encoded = base64.b64encode(tiles.tobytes()).decode()
+            return f"{{ind: '{x},0', tiles: {encoded}, version: {version}}}"
+
+        chunks = ", ".join(f"'{x},0': {chunk(x, 5 + x % 2)}" for x in range(5))
+        streamed = f"- type: MapGrid\n      chunks: {{{chunks}}}"
+        composed = f"- chunks: [{', '.join(chunk(x, 5 + x % 2) for x in range(5))}]\n" \
+            "      type: MapGrid"
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch("ss14_tiled.maps.importer.BATCH_SIZE", 2):
+            _export_map(tmp, 'width="3" height="2"', _FINITE_LAYERS)
+            outputs = []
+            for grid in (streamed, composed):
+                yml = Path(tmp) / "grid.yml"
+                yml.write_text("tilemap: {0: Space, 1: FloorWhite}\nentities:\n- proto: ''\n"
+                               f"  entities:\n  - uid: 1\n    components:\n    {grid}\n")
+                result = import_map(yml, Path(tmp) / "grid.tmx", Path(tmp) / "dist")
+                assert (result.chunks, result.unknown) == (5, 0)
+                outputs.append(sorted((Path(tmp) / "grid.tmx").read_text().splitlines()))
+            assert outputs[0] == outputs[1]
+            assert sum("<chunk " in x for x in outputs[0]) == 5
+
 
 if __name__ == "__main__":
     unittest.main()